@@ -18,8 +18,13 @@ class Application(tornado.web.Application):
     def __init__(self, conf, board):
         handlers = [
             (r"/gcode", web.GcodeHandler, dict(board=board)),
+            (r"/gcode/simulate", web.SimulateHandler),
+            (r"/raster", web.RasterHandler, dict(board=board)),
             (r"/status", web.StatusHandler, dict(board=board)),
+            (r"/status/underruns", web.UnderrunsHandler, dict(board=board)),
+            (r"/status/websocket", web.WebsocketStatsHandler, dict(board=board)),
             (r"/ws/status", web.StatusWebsocket, dict(board=board)),
+            (r"/ws/position", web.PositionWebsocket, dict(board=board)),
             (r"/firmware/(build|flash|flash_release|reset)", web.FirmwareHandler, dict(board=board, conf=conf)),
             (r"/config", web.ConfigHandler, dict(board=board, conf=conf)),
             (r"/(.*)", tornado.web.StaticFileHandler, {
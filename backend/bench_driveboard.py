@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Streaming benchmark for Driveboard, against the firmware emulator
+
+Sends a job through DriveboardGcode and Driveboard to the in-process
+firmware emulator (see emulator.py), as the /gcode handler does, and
+reports the sustained bytes/s over the serial link, the firmware
+buffer underruns, the time the machine waited for moves, and the
+IOLoop latency while streaming.
+
+The emulated machine runs --speedup times faster than real time, with
+a correspondingly faster serial link.
+"""
+import time
+import logging
+import argparse
+import cProfile as profile
+import pstats
+import os
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+import gcode
+import emulator
+from bench_gcode import synthetic_job
+
+argparser = argparse.ArgumentParser(description='Benchmark streaming to the firmware emulator.')
+argparser.add_argument('gcode_file', nargs='?', default=None,
+                       help='gcode job (default: a synthetic job)')
+argparser.add_argument('-n', '--lines', type=int, default=5000,
+                       help='number of lines in the synthetic job (default: 5000)')
+argparser.add_argument('-s', '--speedup', type=float, default=50.0,
+                       help='emulated time per real time (default: 50)')
+argparser.add_argument('-b', '--baudrate', type=int, default=57600,
+                       help='serial baudrate (default: 57600)')
+argparser.add_argument('-f', '--fault', action='append', default=[],
+                       metavar='NAME@SECONDS', help='inject a fault, see emulator.FAULTS (repeatable)')
+argparser.add_argument('-p', '--profile', dest='profile', action='store_true',
+                       default=False, help='run with profiling')
+args = argparser.parse_args()
+
+
+class LatencyMonitor:
+    """Measures how late a 10 ms timer fires on the IOLoop"""
+
+    interval = 0.01
+
+    def __init__(self):
+        self.samples = []
+        self.running = False
+
+    @gen.coroutine
+    def run(self):
+        io_loop = IOLoop.current()
+        self.running = True
+        while self.running:
+            t = io_loop.time()
+            yield gen.sleep(self.interval)
+            self.samples.append(io_loop.time() - t - self.interval)
+
+    def report(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return 'no samples'
+        return 'median %.1f ms, p99 %.1f ms, max %.1f ms' % (
+            1000*samples[len(samples)//2], 1000*samples[len(samples)*99//100], 1000*samples[-1])
+
+
+@gen.coroutine
+def stream(lines):
+    board = gcode.DriveboardGcode(None, None, board=emulator.EmulatedDriveboard(
+        args.baudrate, speedup=args.speedup))
+    driveboard = board.driveboard
+    error = board.connect()
+    if error:
+        raise RuntimeError(error)
+    while driveboard.greeting_timeout is not None or not board.get_status()['ready']:
+        yield gen.sleep(0.05)
+    emu = driveboard.emulator
+    for fault in args.fault:
+        name, _, seconds = fault.partition('@')
+        IOLoop.current().call_later(float(seconds or 0), emu.inject, name)
+
+    monitor = LatencyMonitor()
+    monitor.run()
+    bytes_before = driveboard.fwbuf_bytes_queued
+    busy_before = emu.firmware.busy_time
+    t0 = time.time()
+    for line in lines:
+        resp = board.gcode_line(line)
+        if resp.startswith('error:'):
+            raise RuntimeError(resp)
+        # stay responsive, as GcodeHandler
+        yield gen.moment
+    t_queued = time.time() - t0
+    yield gen.sleep(0.2)
+    while True:
+        status = board.get_status()
+        if status['ready'] or status['stops'] or not status['serial_connected']:
+            break
+        yield gen.sleep(0.01)
+    dt = time.time() - t0
+    monitor.running = False
+
+    firmware = emu.firmware
+    nbytes = driveboard.fwbuf_bytes_queued - bytes_before
+    link = args.baudrate / 20.0 * args.speedup  # doubled bytes
+    print('%d lines queued in %.2f s, streamed in %.2f s' % (len(lines), t_queued, dt))
+    print('%d bytes, %.0f bytes/s (%.0f%% of the link)' % (nbytes, nbytes / dt, 100 * nbytes / dt / link))
+    print('machine busy %.1f s (estimated %.1f s), %.1f s waiting for moves in %d starvations' % (
+        firmware.busy_time - busy_before, status['queue']['time_total'], firmware.starved_time, firmware.starvations))
+    print('%d underruns, %.1f moves planned ahead on average, %d chunk acks dropped' % (
+        firmware.underruns, firmware.lookahead_sum / max(1, firmware.moves_started), emu.acks_dropped))
+    job_underruns = dict(board.get_status()['job_underruns'])
+    print('job underruns %d (%s)' % (job_underruns.pop('total'), ', '.join(
+        '%s %d' % item for item in sorted(job_underruns.items()))))
+    if status['stops'] or status['error_report']:
+        print('stops %s, error report %r' % (status['stops'], status['error_report']))
+    print('IOLoop latency %s' % monitor.report())
+
+
+def main():
+    if args.gcode_file:
+        with open(args.gcode_file) as f:
+            lines = f.read().splitlines()
+    else:
+        lines = synthetic_job(args.lines)
+    IOLoop.current().run_sync(lambda: stream(lines), timeout=3600)
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.ERROR)
+    if args.profile:
+        profile.run("main()", 'profile.tmp')
+        p = pstats.Stats('profile.tmp')
+        p.sort_stats('cumulative').print_stats(20)
+        os.remove('profile.tmp')
+    else:
+        main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Microbenchmark for DriveboardGcode.gcode_line
+
+Parses a synthetic vector job and reports lines per second. The
+driveboard is replaced by a stand-in that only counts the calls, so
+this measures gcode parsing, not the wire encoding (use --encode
+to include driveboard.encode_move). The planner model (for the job
+time estimate) is included: the moves queued by gcode_line are planned
+every planner.PLAN_BATCH moves, and the rest by the status update at
+the end, which is timed as well.
+"""
+import random
+import time
+import cProfile as profile
+import pstats
+import os
+import argparse
+
+import gcode
+import driveboard
+
+
+class CountingDriveboard:
+    fw_stopped = False
+
+    def __init__(self, encode=False):
+        self.encode = encode
+        self.params = 0
+        self.commands = 0
+        self.fwbuf_bytes_queued = 0
+
+    def is_connected(self):
+        return True
+
+    def send_param(self, param, val):
+        self.params += 1
+
+    def send_command(self, cmd):
+        self.commands += 1
+
+    def send_move(self, params, command=None):
+        self.params += len(params)
+        if command is not None:
+            self.commands += 1
+        if self.encode:
+            self.fwbuf_bytes_queued += len(driveboard.encode_move(params, command))
+
+    def send_raster_data(self, data):
+        pass
+
+
+def synthetic_job(n):
+    """Mostly short G1 segments, with seeks and intensity changes"""
+    random.seed(0)
+    lines = ['G90', 'M80', 'G0F8000', 'G1F2000', 'S200']
+    x, y = 0.0, 0.0
+    while len(lines) < n:
+        r = random.random()
+        if r < 0.05:
+            x, y = random.uniform(0, 1220), random.uniform(0, 610)
+            lines.append('G0X%.3fY%.3f' % (x, y))
+        elif r < 0.06:
+            lines.append('S%d' % random.randint(0, 255))
+        elif r < 0.07:
+            lines.append('G1 X%.3f Y%.3f F%d ; with spaces' % (x, y, random.randint(1000, 3000)))
+        else:
+            x += random.uniform(-1, 1)
+            y += random.uniform(-1, 1)
+            lines.append('G1X%.3fY%.3f' % (x, y))
+    lines.append('M81')
+    return lines[:n]
+
+
+def main(args):
+    lines = synthetic_job(args.lines)
+
+    best = None
+    for _ in range(args.runs):
+        board = gcode.DriveboardGcode(None, None, board=CountingDriveboard(args.encode))
+        t0 = time.time()
+        for line in lines:
+            resp = board.gcode_line(line)
+            if resp.startswith('error:'):
+                raise RuntimeError(resp)
+        board.planner.update(0, False)
+        dt = time.time() - t0
+        if best is None or dt < best:
+            best = dt
+
+    counts = board.driveboard
+    print('%d lines in %.3f s (%.0f lines/s, best of %d), %d params, %d commands, %d bytes encoded' % (
+        len(lines), best, len(lines) / best, args.runs, counts.params, counts.commands,
+        counts.fwbuf_bytes_queued))
+    done, total = board.planner.progress()
+    print('estimated job time %.0f s' % total)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Benchmark gcode parsing.')
+    argparser.add_argument('-n', '--lines', type=int, default=100000,
+                           help='number of lines in the synthetic job (default: 100000)')
+    argparser.add_argument('-r', '--runs', type=int, default=5,
+                           help='time this many runs, report the fastest (default: 5)')
+    argparser.add_argument('-e', '--encode', dest='encode', action='store_true',
+                           default=False, help='also encode the firmware bytes')
+    argparser.add_argument('-p', '--profile', dest='profile', action='store_true',
+                           default=False, help='run with profiling')
+    args = argparser.parse_args()
+
+    if args.profile:
+        profile.run("main(args)", 'profile.tmp')
+        p = pstats.Stats('profile.tmp')
+        p.sort_stats('cumulative').print_stats(20)
+        os.remove('profile.tmp')
+    else:
+        main(args)
@@ -7,12 +7,16 @@ command buffer, reports error and status.
 import os
 import time
 import ast
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import struct
 import serial
 import logging
+from tornado import gen, locks
 from tornado.ioloop import IOLoop, PeriodicCallback
 
+from ringbuffer import RingBuffer
+import underruns
+
 # firmware constants, need to match device firmware
 # (maybe they should be reported by the firmware's superstatus)
 
@@ -23,6 +27,15 @@ PULSE_SECONDS = 31.875e-6  # see laser.c
 MINIMUM_PULSE_TICKS = 3  # unit: PULSE_SECONDS
 MAXIMUM_PULSE_TICKS = 127  # unit: PULSE_SECONDS
 ACCELERATION = 1800000.0  # mm/min^2, divide by (60*60) to get mm/sec^2
+JUNCTION_DEVIATION = 0.006  # mm, see config.h
+PLANNER_BLOCKS = 10-1  # BLOCK_BUFFER_SIZE in planner.c, one slot is kept free
+
+# below this many bytes ahead of the firmware, queuing more data comes
+# before other IOLoop work (see needs_refill)
+REFILL_WATERMARK = FIRMBUF_SIZE
+# flow control for the code queuing a job (see queue_full)
+QUEUE_HIGH_WATERMARK = 256*1024  # bytes in firmbuf_queue
+QUEUE_LOW_WATERMARK = 128*1024
 
 # "import" firmware protocol constants
 markers_tx = {}
@@ -52,6 +65,58 @@ def import_firmware_constants():
 
 import_firmware_constants()
 
+MOVE_TYPES = {
+    'CMD_LINE_SEEK': 'seek',
+    'CMD_LINE_BURN': 'burn',
+    'CMD_LINE_RASTER': 'raster',
+}
+
+
+# a parameter: its value in four bytes of 7 bits each (with the data
+# bit set), least significant first, then the marker. The four bytes
+# as an int, for 14 bits of the value each:
+param_low_bytes = [(num & 0x7f) | (num & 0x3f80) << 1 | 0x8080 for num in range(1 << 14)]
+param_high_bytes = [bits << 16 for bits in param_low_bytes]
+# struct.Struct for the parameters (and command) of encode_move, by the
+# number of values
+move_structs = {}
+
+def encode_move(params, command=None):
+    """Encode a list of (param_name, value) and a command in one go
+
+    Returns the bytes for the firmware buffer, the same as sending
+    each parameter with send_param() and then send_command().
+    """
+    values = []
+    append = values.append
+    for param, val in params:
+        # num to be [-134217.728, 134217.727], [-2**27, 2**27-1]
+        # three decimals are retained
+        num = round((val+134217.728)*1000)
+        append(param_low_bytes[num & 0x3fff] | param_high_bytes[num >> 14 & 0x3fff])
+        append(name_to_marker[param])
+    if command is not None:
+        append(name_to_marker[command])
+    packer = move_structs.get(len(values))
+    if packer is None:
+        packer = move_structs[len(values)] = struct.Struct('<' + 'IB'*len(params) + 'B'*(command is not None))
+    return packer.pack(*values)
+
+
+def double_bytes(data):
+    """By protocol every byte is sent twice (see serial.c)"""
+    doubled = bytearray(2*len(data))
+    doubled[0::2] = data
+    doubled[1::2] = data
+    return doubled
+
+
+# raster data: pulse durations, clamped to 127, with the data bit set
+RASTER_TABLE = bytes(min(i, 127) + 128 for i in range(256))
+
+def encode_raster_data(data):
+    return data.translate(RASTER_TABLE)
+
 
 class Driveboard:
     def __init__(self, serial_port, baudrate):
@@ -59,14 +124,17 @@ class Driveboard:
         self.baudrate = baudrate
 
         self.io_loop = IOLoop.current()
-        self.serial_write_queue = bytearray()
+        self.serial_write_queue = RingBuffer()
         self.device = None
 
         self.read_hist = bytearray()
         self.pdata = []
 
         self.firmbuf_used = 0
-        self.firmbuf_queue = bytearray()
+        self.firmbuf_queue = RingBuffer()
+        self.fwbuf_bytes_queued = 0  # total, since startup
+        self.queue_low = locks.Condition()  # see wait_queue_low()
+        self.underrun_log = underruns.UnderrunLog()
         self.paused = False
         self.jobsize = 0
 
@@ -77,13 +145,23 @@ class Driveboard:
         self.last_status_request = 0.0
         self.last_status_report = 0.0
         self.status_raw = OrderedDict()  # preserve knowledge which STOPERROR_* was first
+        # per unanswered status request: (command, firmware buffer bytes
+        # sent before it), see _request_status()
+        self.status_requests = deque(maxlen=8)
+        self.superstatus_reply = False  # the status being received has INFO_VERSION
         polling_interval = 100  # milliseconds
-        PeriodicCallback(self._status_timer_cb, polling_interval).start()
+        self.status_timer = PeriodicCallback(self._status_timer_cb, polling_interval)
+        self.status_timer.start()
 
         # for stop/resume timing
         self.fw_stopped = False
         self.fw_resuming = False
 
+        # see add_status_listener() and add_position_listener()
+        self.status_listeners = []
+        self.status_transitions = None
+        self.position_listeners = []
+
         # initialize self.status
         self._update_status()
 
@@ -91,22 +169,22 @@ class Driveboard:
         self.serial_write_queue.clear()
         self.read_hist.clear()
         self.firmbuf_queue.clear()
+        self.queue_low.notify_all()
         self.firmbuf_used = 0
         self.pdata = []
         self.firmver = None
         self.send_command('CMD_RESET_PROTOCOL')
-        self.send_command('CMD_SUPERSTATUS')
+        self._request_status('CMD_SUPERSTATUS')
 
     def connect(self):
         if self.device is not None:
             return ''
         try:
             logging.info('opening serial port %r baudrate %s', self.serial_port, self.baudrate)
-            self.device = serial.Serial(self.serial_port, self.baudrate)
-            self.device.timeout = 0
-            self.device.write_timeout = 0
-            self.device.nonblocking()
+            self.device = self._open_serial()
             self.protocol_errors = 0
+            self.underrun_log.reset()
+            self.status_requests.clear()  # not answered by this port
             self.io_loop.add_handler(self.device, self._serial_event, IOLoop.READ)
         except serial.SerialException as e:
             self.disconnect_reason = str(e)
@@ -119,6 +197,13 @@ class Driveboard:
         self.disconnect_reason = None
         return ''
 
+    def _open_serial(self):
+        device = serial.Serial(self.serial_port, self.baudrate)
+        device.timeout = 0
+        device.write_timeout = 0
+        device.nonblocking()
+        return device
+
     def disconnect(self, reason):
         logging.error(reason)
         self.disconnect_reason = reason
@@ -128,6 +213,7 @@ class Driveboard:
         self.io_loop.remove_handler(self.device)
         self.device.close()
         self.device = None
+        self.queue_low.notify_all()
 
     def is_connected(self):
         return bool(self.device)
@@ -143,6 +229,14 @@ class Driveboard:
         # start sending again
         self._send_fwbuf()
 
+    def fwbuf_bytes_processed(self):
+        """Number of fwbuf_bytes_queued that the firmware has taken from its buffer
+
+        Only counted in TX_CHUNK_SIZE steps (CMD_CHUNK_PROCESSED).
+        """
+        waiting = len(self.firmbuf_queue) + max(0, self.firmbuf_used)
+        return max(0, self.fwbuf_bytes_queued - waiting)
+
     def get_status(self):
         if self.last_status_report < time.time() - 0.5:
             # no firmware status updates (e.g. disconnected)
@@ -175,20 +269,23 @@ class Driveboard:
             data_pretty = bytes(pretty(i) for i in data)
             logging.info('_serial_write %r', data_pretty)
 
-        for b in data:
-            # by protocol send twice
-            self.serial_write_queue.append(b)
-            self.serial_write_queue.append(b)
-        if self.serial_write_queue:
-            n = self.device.write(self.serial_write_queue)
-
-            # del self.serial_write_queue[:n]
-            #
-            # workaround for Python 3.4.2 bug
-            # (bytearray del[] bug http://bugs.python.org/issue23985)
-            self.serial_write_queue = self.serial_write_queue[n:]
-
-            if self.serial_write_queue:
+        queue = self.serial_write_queue
+        if data:
+            queue.extend(double_bytes(data))
+
+        if queue:
+            # write without copying the queue (peek() may return only
+            # the first part if the queued data wraps around)
+            while queue:
+                out = queue.peek()
+                size = len(out)
+                n = self.device.write(out)
+                out.release()
+                queue.consume(n)
+                if n < size:
+                    break
+
+            if queue:
                 # usually never reached (because fw_buffer < serial_buffer)
                 #logging.warning('%d bytes still waiting in queue after tx', len(queue))
                 self.io_loop.update_handler(self.device, IOLoop.READ | IOLoop.WRITE)
@@ -199,7 +296,9 @@ class Driveboard:
         data = self.device.read(2000)
         if not data:
             raise RuntimeError('no read data - maybe serial port was closed?')
+        self._serial_received(data)
 
+    def _serial_received(self, data):
         # for error diagnostics
         self.read_hist.extend(data)
         # del self.read_hist[:-80]
@@ -258,12 +357,23 @@ class Driveboard:
         elif byte == INFO_VERSION:
             # superstatus, only received once
             self.firmver = value / 100.0
+            self.superstatus_reply = True
         else:
             self.status_raw[byte] = value
 
     def _on_status_end(self):
+        underrun_count = self.status_raw.get(INFO_BUFFER_UNDERRUN)
+        if underrun_count is not None:
+            self.underrun_log.on_report(underrun_count, self.fwbuf_bytes_processed())
         self._update_status(self.status_raw)
         self.status_raw.clear()
+        # the status is only about the bytes sent before the request
+        sent = self._answered_status_request(
+            'CMD_SUPERSTATUS' if self.superstatus_reply else 'CMD_STATUS')
+        self.superstatus_reply = False
+        if self.status['ready'] and sent is not None and sent >= self.fwbuf_bytes_queued:
+            # processed bytes are only counted in TX_CHUNK_SIZE steps
+            self.underrun_log.end_job(self.fwbuf_bytes_queued - TX_CHUNK_SIZE + 1)
 
         if self.fw_resuming:
             # The firmware may report "stopped" status once more after
@@ -283,9 +393,11 @@ class Driveboard:
             # and discarded by the firmware. The user might press
             # "resume" while old commands are still being sent.
             self.firmbuf_queue.clear()
+            self.queue_low.notify_all()
 
     def _update_status(self, status_raw={}):
-        if status_raw:
+        new_report = bool(status_raw)
+        if new_report:
             # new firmware status is available
             self.last_status_report = time.time()
 
@@ -325,7 +437,9 @@ class Driveboard:
                 'y': r.pop(INFO_POS_Y, 0.0),
                 'z': r.pop(INFO_POS_Z, 0.0)
                 },
-            'underruns': r.pop(INFO_BUFFER_UNDERRUN, 0.0),
+            # only reported when changed, see UnderrunLog
+            'underruns': r.pop(INFO_BUFFER_UNDERRUN, self.underrun_log.count or 0.0),
+            'job_underruns': self.underrun_log.summary(),
             'stackclear': r.pop(INFO_STACK_CLEARANCE, 999999.0),
             'delayed_microsteps': r.pop(INFO_DELAYED_MICROSTEPS, 0.0),
 
@@ -351,6 +465,11 @@ class Driveboard:
             else:
                 logging.warning('unhandled marker_rx %r value %r', name, value)
 
+        if new_report:
+            pos = self.status['pos']
+            for callback in self.position_listeners:
+                callback(self.last_status_report, pos['x'], pos['y'], pos['z'])
+
         # check if driveboard has crashed or disconnected
         status_report_missing = False
         if self.device and self.last_status_report < time.time() - 0.5:
@@ -379,7 +498,31 @@ class Driveboard:
             self.previous_error_report = report
             logging.warning('error_report changed: %r --> %r', previous_report, report)
 
-        # TODO maybe: push notifications to websocket right away
+        # push important changes right away (e.g. to the websocket)
+        status = self.status
+        transitions = (status['ready'], status['paused'], status['serial_connected'],
+                       tuple(status['stops']), report,
+                       status['info']['door_open'], status['info']['chiller_off'])
+        if transitions != self.status_transitions:
+            self.status_transitions = transitions
+            for callback in self.status_listeners:
+                self.io_loop.add_callback(callback)
+
+    def add_status_listener(self, callback):
+        """Call callback() on important status changes
+
+        That is ready/busy, pause, (dis)connect, stop errors, the error
+        report and the door/chiller flags. The callback runs on the
+        IOLoop, after the status was updated.
+        """
+        self.status_listeners.append(callback)
+
+    def add_position_listener(self, callback):
+        """Call callback(timestamp, x, y, z) for every status from the firmware
+
+        The callback runs right away, it must be quick.
+        """
+        self.position_listeners.append(callback)
 
     def send_command(self, cmd):
         cmd = name_to_marker[cmd]
@@ -397,58 +540,92 @@ class Driveboard:
             self._send_fwbuf(bytes([cmd]))
 
     def send_param(self, param, val):
-        param = name_to_marker[param]
-        # num to be [-134217.728, 134217.727], [-2**27, 2**27-1]
-        # three decimals are retained
-        num = int(round(((val+134217.728)*1000)))
-        data = struct.pack(
-            'BBBBB',
-            (num&127)+128,
-            ((num&(127<<7))>>7)+128,
-            ((num&(127<<14))>>14)+128,
-            ((num&(127<<21))>>21)+128,
-            param)
-        self._send_fwbuf(data)
+        self._send_fwbuf(encode_move([(param, val)]))
+
+    def send_move(self, params, command=None):
+        """Send several parameters and a (buffered) command at once"""
+        if command in MOVE_TYPES and not self.fw_stopped:
+            self.underrun_log.on_move(self.fwbuf_bytes_queued, MOVE_TYPES[command])
+        self._send_fwbuf(encode_move(params, command))
 
     def send_raster_data(self, data):
-        # data = numpy.frombuffer(data, 'uint8')
-        # data.clip(0, 127)
-        # data += 128
-        # self._send_fwbuf(data.tobytes())
-        data = bytearray(data)
-        for i in range(len(data)):
-            if data[i] > 127:
-                data[i] = 127
-            else:
-                data[i] = data[i] + 128
-        self._send_fwbuf(data)
+        self._send_fwbuf(encode_raster_data(data))
+
+    def needs_refill(self):
+        """Whether less than REFILL_WATERMARK bytes are ahead of the firmware
+
+        Code queuing a job (e.g. GcodeHandler) should then queue more
+        before yielding to other work on the IOLoop, or the firmware
+        may run out of data.
+        """
+        return (self.device is not None and not self.paused and not self.fw_stopped
+                and len(self.firmbuf_queue) + self.firmbuf_used < REFILL_WATERMARK)
+
+    def queue_full(self):
+        """Whether firmbuf_queue is above QUEUE_HIGH_WATERMARK
+
+        Code queuing a job should then wait_queue_low() before queuing
+        more, so the memory use does not grow with the job size.
+        """
+        return len(self.firmbuf_queue) > QUEUE_HIGH_WATERMARK
+
+    @gen.coroutine
+    def wait_queue_low(self):
+        """Wait until firmbuf_queue is below QUEUE_LOW_WATERMARK (or cleared)"""
+        while self.device and len(self.firmbuf_queue) >= QUEUE_LOW_WATERMARK:
+            yield self.queue_low.wait()
 
     def _send_fwbuf(self, data=b''):
         if self.fw_stopped:
             # while stopped, the firmware will discard all queued
             # bytes anyway; keep the queues empty for clean resume
             return
-        self.firmbuf_queue += data
+        self.fwbuf_bytes_queued += len(data)
         if self.paused:
+            self.firmbuf_queue.extend(data)
             return
 
         # transfer firmbuf_queue to the driveboard (if space is available)
         available = FIRMBUF_SIZE - self.firmbuf_used
 
-        if available > 0 and self.firmbuf_queue:
-            out = self.firmbuf_queue[:available]
-            # del self.firmbuf_queue[:available]
-            #
-            # workaround for Python 3.4.2 bug
-            # (bytearray del[] bug http://bugs.python.org/issue23985)
-            self.firmbuf_queue = self.firmbuf_queue[available:]
+        if not self.firmbuf_queue and len(data) <= available:
+            # nothing queued, no need to go through the queue
+            out = data
+        else:
+            self.firmbuf_queue.extend(data)
+            if available <= 0:
+                return
+            out = self.firmbuf_queue.read(available)
+            if len(self.firmbuf_queue) < QUEUE_LOW_WATERMARK:
+                self.queue_low.notify_all()
+        if out:
             self.firmbuf_used += len(out)
             self._serial_write(out)
 
     def _status_timer_cb(self):
         if self.device:
-            self.send_command('CMD_STATUS')
-            self.last_status_request = time.time()
+            self._request_status('CMD_STATUS')
+
+    def _request_status(self, command):
+        """Send CMD_STATUS or CMD_SUPERSTATUS, remember what it is about"""
+        self.status_requests.append((command, self.fwbuf_bytes_queued - len(self.firmbuf_queue)))
+        self.send_command(command)
+        self.last_status_request = time.time()
+
+    def _answered_status_request(self, command):
+        """Forget the oldest request of this kind, return its bytes sent
+
+        The firmware answers requests that arrive close together with a
+        single status, and also reports a status when it starts. So
+        replies are only matched to a request of the same kind (a
+        superstatus has INFO_VERSION). Returns None for an unrequested
+        status.
+        """
+        for i, (requested, sent) in enumerate(self.status_requests):
+            if requested == command:
+                del self.status_requests[i]
+                return sent
+        return None
 
     def _on_startup_greeting(self, value):
         if abs(value - 201.456) > 0.001:
@@ -0,0 +1,370 @@
+"""In-process firmware emulator, for testing the backend without hardware
+
+EmulatedDriveboard is a Driveboard whose serial port is a loop://
+port (see serial/urlhandler/protocol_loop.py) with a FirmwareEmulator
+on the other end. Unlike the offline simulator (simulator.py) it runs
+in its own thread, in real time:
+
+- the serial link carries baudrate/10 bytes per second
+- the received bytes are checked and parsed as by the firmware (see
+  simulator.Firmware), at most FIRMBUF_SIZE of them are buffered, and
+  CMD_CHUNK_PROCESSED is sent for every TX_CHUNK_SIZE bytes read
+- moves wait for a free block of the planner and take the time
+  of the planner model (planner.py)
+- CMD_STATUS and CMD_SUPERSTATUS are answered with a status frame
+
+The emulated time can run faster than the clock (speedup), the link
+then is faster by the same factor. Faults are injected with
+FirmwareEmulator.inject(), see FAULTS.
+
+Usage:
+board = EmulatedDriveboard(speedup=10.0)
+board.connect()
+...
+board.emulator.inject('drop_ack', count=2)
+"""
+import os
+import time
+import queue
+import logging
+import threading
+
+import serial
+from serial.urlhandler import protocol_loop
+
+import driveboard
+import simulator
+
+
+FAULTS = {
+    'corrupt': 'flip a bit of the next count received bytes',
+    'drop_ack': 'do not send the next count CMD_CHUNK_PROCESSED',
+    'stall': 'do not read from the serial buffer for seconds',
+    'mute': 'do not answer status requests for seconds',
+    'limit': 'stop with STOPERROR_LIMIT_HIT_X1',
+    'door': 'report the door open for seconds',
+    'chiller': 'report the chiller off for seconds',
+    'reset': 'reboot, as after a watchdog reset',
+}
+
+STARTUP_GREETING = 201.456  # serial_init() in serial.c
+CONTROL_BYTES = bytes(range(32))
+
+
+class EmulatedFirmware(simulator.Firmware):
+    """Firmware that executes its moves in (emulated) time
+
+    A move starts when the previous one is done. The protocol loop
+    waits while the planner has no free block.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.clock = 0.0  # emulated seconds
+        self.running = None  # [seconds left, target] of the executing move
+        self.pos = [0.0, 0.0, 0.0]  # after the last completed move
+        self.busy_time = 0.0  # emulated seconds executing moves
+        self.targets = {}  # byte_end -> target of the moves in the planner
+        self.stall_until = 0.0
+        self.mute_until = 0.0
+        self.door_until = 0.0
+        self.chiller_until = 0.0
+        # the stepper had no block while more moves were on the way
+        self.starvations = 0
+        self.starved_time = 0.0
+        self.starved_since = None
+        # moves started, and the sum of the moves behind them in the
+        # planner (the fewer, the slower the moves get)
+        self.moves_started = 0
+        self.lookahead_sum = 0
+        # data bytes sent by the backend, more moves are on the way
+        # while this is ahead of bytes_read
+        self.bytes_announced = 0
+        # the protocol loop starts waiting for data right away
+        self.underruns = 1
+        self.underruns_reported = False
+
+    def blocks_used(self):
+        return len(self.planner.lookahead) + (self.running is not None)
+
+    def _waiting(self, command):
+        if command in simulator.MOVE_TYPES:
+            return self.blocks_used() >= driveboard.PLANNER_BLOCKS
+        if command in (driveboard.CMD_HOMING, driveboard.CMD_SET_OFFSET_TABLE,
+                       driveboard.CMD_SET_OFFSET_CUSTOM):
+            # planner_line() would call finish(), the moves run first
+            return self.blocks_used() > 0
+        return False
+
+    def _read_commands(self):
+        if self.clock < self.stall_until:
+            return
+        bytes_read = self.bytes_read
+        super()._read_commands()
+        if self.bytes_read != bytes_read and not self.rx_buffer and not self.waiting:
+            # serial_protocol_read() in serial.c waits for more data
+            self.underruns += 1
+            self.underruns_reported = False
+
+    def _plan(self, move):
+        self.targets[self.bytes_read] = list(self.target)
+        super()._plan(move)
+        if self.bytes_read not in self.unplanned:
+            del self.targets[self.bytes_read]  # no motion
+
+    def _on_planned(self, byte_end, seconds):
+        super()._on_planned(byte_end, seconds)
+        self.moves_started += 1
+        self.lookahead_sum += len(self.planner.lookahead)
+        self._start(seconds, self.targets.pop(byte_end))
+
+    def _homing(self):
+        seconds = self.homing_time
+        super()._homing()
+        self._start(self.homing_time - seconds, [0.0, 0.0, 0.0])
+
+    def _start(self, seconds, target):
+        self.running = [seconds, target]
+        if self.starved_since is not None:
+            self.starvations += 1
+            self.starved_time += self.clock - self.starved_since
+            self.starved_since = None
+
+    def _stop(self, code):
+        super()._stop(code)
+        self.running = None
+        self.targets.clear()
+        self.starved_since = None
+
+    def position(self):
+        return self.pos
+
+    def idle(self):
+        return super().idle() and self.running is None
+
+    def status_frame(self, superstatus=False):
+        if self.clock < self.mute_until:
+            return b''
+        self.door_open = self.clock < self.door_until
+        self.chiller_off = self.clock < self.chiller_until
+        return super().status_frame(superstatus)
+
+    def advance(self, seconds):
+        """Let the emulated time pass, return the bytes to send back"""
+        out = bytearray()
+        while True:
+            if self.running is None:
+                if self.stop_code is None and self.planner.lookahead:
+                    self.planner.plan_next()  # calls _start()
+                    continue
+                self.clock += seconds
+                return out
+            left, target = self.running
+            if left > seconds:
+                self.running[0] = left - seconds
+                self.clock += seconds
+                self.busy_time += seconds
+                return out
+            seconds -= left
+            self.clock += left
+            self.busy_time += left
+            self.pos = target
+            self.running = None
+            # a block is free, the protocol loop reads the next command
+            out += self.process()
+            if not self.planner.lookahead and self.stop_code is None and self.more_data():
+                self.starved_since = self.clock
+
+    def more_data(self):
+        return bool(self.rx_buffer) or self.bytes_read < self.bytes_announced
+
+
+class FirmwareEmulator(threading.Thread):
+    """The thread running EmulatedFirmware, see the module docstring"""
+
+    def __init__(self, port, baudrate, speedup=1.0, tick=0.002):
+        super().__init__(name='FirmwareEmulator', daemon=True)
+        self.port = port
+        self.bytes_per_second = baudrate / 10.0 * speedup
+        self.speedup = speedup
+        self.tick = tick
+        self.lock = threading.Lock()
+        self.line = bytearray()  # written by the backend, not yet transmitted
+        self.faults = []  # from inject(), not applied yet
+        self.corrupt = 0
+        self.drop_acks = 0
+        self.acks_dropped = 0
+        self.stopping = False
+        self.firmware = EmulatedFirmware()
+
+    def write(self, data):
+        data = bytes(data)
+        singles = data[0::2]
+        with self.lock:
+            self.line += data
+            self.firmware.bytes_announced += len(singles.translate(None, CONTROL_BYTES))
+
+    def inject(self, fault, seconds=1.0, count=1):
+        """Make the firmware misbehave, see FAULTS
+
+        Thread-safe, the fault is applied with the next tick.
+        """
+        if fault not in FAULTS:
+            raise ValueError('unknown fault %r' % fault)
+        with self.lock:
+            self.faults.append((fault, seconds, count))
+
+    def stop(self):
+        self.stopping = True
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def run(self):
+        self.port.deliver(simulator.encode_param(driveboard.INFO_STARTUP_GREETING, STARTUP_GREETING))
+        budget = 0.0
+        last = time.monotonic()
+        while not self.stopping:
+            time.sleep(self.tick)
+            now = time.monotonic()
+            elapsed = now - last
+            last = now
+            with self.lock:
+                faults = self.faults
+                self.faults = []
+                budget += elapsed * self.bytes_per_second
+                n = min(int(budget), len(self.line))
+                data = bytes(self.line[:n])
+                del self.line[:n]
+                if not self.line:
+                    budget = 0.0
+                else:
+                    budget -= n
+            out = bytearray()
+            for fault, seconds, count in faults:
+                out += self._apply(fault, seconds, count)
+            firmware = self.firmware
+            if data:
+                if self.corrupt:
+                    data = bytearray(data)
+                    for i in range(min(self.corrupt, len(data))):
+                        data[i] ^= 0x40
+                    self.corrupt -= i + 1
+                firmware.receive(data)
+            out += firmware.process()
+            out += firmware.advance(elapsed * self.speedup)
+            if self.drop_acks:
+                n = out.count(driveboard.CMD_CHUNK_PROCESSED)
+                dropped = min(n, self.drop_acks)
+                out = out.replace(bytes((driveboard.CMD_CHUNK_PROCESSED,)), b'', dropped)
+                self.drop_acks -= dropped
+                self.acks_dropped += dropped
+            if out:
+                self.port.deliver(out)
+
+    def _apply(self, fault, seconds, count):
+        logging.info('emulator: injecting %s', fault)
+        firmware = self.firmware
+        until = firmware.clock + seconds * self.speedup
+        if fault == 'corrupt':
+            self.corrupt += count
+        elif fault == 'drop_ack':
+            self.drop_acks += count
+        elif fault == 'stall':
+            firmware.stall_until = until
+        elif fault == 'mute':
+            firmware.mute_until = until
+        elif fault == 'limit':
+            firmware._stop(driveboard.STOPERROR_LIMIT_HIT_X1)
+        elif fault == 'door':
+            firmware.door_until = until
+        elif fault == 'chiller':
+            firmware.chiller_until = until
+        elif fault == 'reset':
+            with self.lock:
+                del self.line[:]
+                self.firmware = EmulatedFirmware()
+            return simulator.encode_param(driveboard.INFO_STARTUP_GREETING, STARTUP_GREETING)
+        return b''
+
+
+class EmulatedSerial(protocol_loop.Serial):
+    """loop:// port with a FirmwareEmulator on the other end
+
+    Writes go to the emulator, reads return what it sent back. For
+    the IOLoop, fileno() is readable while there is something to read.
+    """
+
+    def __init__(self, emulator_args, *args, **kwargs):
+        self.emulator_args = emulator_args
+        self.emulator = None
+        self.notify_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def open(self):
+        super().open()
+        self._notify_r, self._notify_w = os.pipe()
+        os.set_blocking(self._notify_r, False)
+        os.set_blocking(self._notify_w, False)
+        self.emulator = FirmwareEmulator(self, self._baudrate, **self.emulator_args)
+        self.emulator.start()
+
+    def close(self):
+        if self.is_open:
+            self.emulator.stop()
+            os.close(self._notify_r)
+            os.close(self._notify_w)
+        super().close()
+
+    def fileno(self):
+        return self._notify_r
+
+    def nonblocking(self):
+        pass  # reads never block with timeout 0
+
+    def write(self, data):
+        if not self.is_open:
+            raise serial.portNotOpenError
+        self.emulator.write(data)
+        return len(data)
+
+    def read(self, size=1):
+        # clear the notification first, bytes delivered later notify again
+        with self.notify_lock:
+            try:
+                os.read(self._notify_r, 4096)
+            except BlockingIOError:
+                pass
+            return super().read(size)
+
+    def deliver(self, data):
+        """Called by the emulator with the bytes it sends"""
+        with self.notify_lock:
+            try:
+                for byte in data:
+                    self.queue.put_nowait(bytes((byte,)))
+            except queue.Full:
+                logging.error('emulator: backend not reading, bytes lost')
+            try:
+                os.write(self._notify_w, b'.')
+            except BlockingIOError:
+                pass  # already readable
+
+
+class EmulatedDriveboard(driveboard.Driveboard):
+    """Driveboard connected to a FirmwareEmulator, see the module docstring"""
+
+    def __init__(self, baudrate=57600, **emulator_args):
+        super().__init__('loop://', baudrate)
+        self.emulator_args = emulator_args
+
+    @property
+    def emulator(self):
+        if self.device is None:
+            return None
+        return self.device.emulator
+
+    def _open_serial(self):
+        device = EmulatedSerial(self.emulator_args, None, self.baudrate, timeout=0, write_timeout=0)
+        device.port = self.serial_port
+        device.open()
+        return device
@@ -1,14 +1,45 @@
 import driveboard
+import planner
 import pulseraster
 import json
 import re
 import base64
 
+# A gcode word is an uppercase letter followed by its value. The value
+# is everything up to the next letter; int()/float() validate it later.
+re_words = re.compile(r'([A-Z])([^A-Z]*)').findall
+
+# Fast path for the bulk of a vector job: G0/G1 moves with their
+# parameters in canonical order (e.g. "G1X10.5Y20"). Lines that do not
+# match go through the generic tokenizer and produce the same result.
+re_move = re.compile(r'G0?([01])\s*(?:X([^A-Z]+))?(?:Y([^A-Z]+))?(?:Z([^A-Z]+))?'
+                     r'(?:F([^A-Z]+))?(?:S([^A-Z]+))?').fullmatch
+
+MOVE_COMMANDS = ('CMD_LINE_SEEK', 'CMD_LINE_BURN', 'CMD_LINE_RASTER')
+
+# commands without parameters or modal state
+SIMPLE_COMMANDS = {
+    'M80': 'CMD_AIR_ENABLE',
+    'M81': 'CMD_AIR_DISABLE',
+    'M82': 'CMD_AUX1_ENABLE',
+    'M83': 'CMD_AUX1_DISABLE',
+    'M84': 'CMD_AUX2_ENABLE',
+    'M85': 'CMD_AUX2_DISABLE',
+    'G54': 'CMD_SEL_OFFSET_TABLE',
+    'G55': 'CMD_SEL_OFFSET_CUSTOM',
+    'G30': 'CMD_HOMING',
+}
+
+class GcodeError(Exception):
+    pass
+
 class DriveboardGcode:
     version = '# LasaurGrbl2 (pulseraster)'
 
-    def __init__(self, serial_port, baudrate):
-        self.driveboard = driveboard.Driveboard(serial_port, baudrate)
+    def __init__(self, serial_port, baudrate, board=None):
+        if board is None:
+            board = driveboard.Driveboard(serial_port, baudrate)
+        self.driveboard = board
 
         # modal state of the gcode protocol (last used parameter)
         self.relative = False
@@ -16,6 +47,17 @@ class DriveboardGcode:
         self.feedrate = 6000
         self.seekrate = 1500
 
+        # last intensity value and its pulse parameters
+        # (usually the same for many lines in a row)
+        self.intensity_cache = (None, None)
+
+        # execution time of the queued moves, for the job progress
+        self.planner = planner.PlannerModel()
+        self.planner_report = None  # last firmware status given to the planner
+        # a job upload is queued partially, see upload_progress()
+        self.uploading = False
+        self.upload_fraction = None
+
     def connect(self):
         self.driveboard.connect()
 
@@ -25,20 +67,86 @@ class DriveboardGcode:
     def is_connected(self):
         return self.driveboard.is_connected()
 
+    def add_status_listener(self, callback):
+        self.driveboard.add_status_listener(callback)
+
+    def add_position_listener(self, callback):
+        self.driveboard.add_position_listener(callback)
+
+    def needs_refill(self):
+        return self.driveboard.needs_refill()
+
+    def queue_full(self):
+        return self.driveboard.queue_full()
+
+    def wait_queue_low(self):
+        return self.driveboard.wait_queue_low()
+
+    def underrun_report(self):
+        return self.driveboard.underrun_log.report()
+
+    def upload_progress(self, fraction):
+        """A job upload is in progress, fraction of it is queued (None: unknown)"""
+        self.uploading = True
+        self.upload_fraction = fraction
+
+    def upload_done(self):
+        self.uploading = False
+        self.upload_fraction = None
+
     def get_status(self):
-        return self.driveboard.get_status()
+        """Driveboard status, with the job progress in execution time
+
+        In addition to the byte based queue.job_percent, queue contains
+        time_total and time_remaining (seconds) and time_percent, as
+        estimated by the planner model.
+
+        Large jobs are queued while they run (see
+        Driveboard.wait_queue_low), the planner model only knows the
+        queued part. Meanwhile queue.upload_percent is below 100 (or
+        None, if the upload size is unknown), and time_total is
+        extrapolated from the queued part.
+        """
+        board = self.driveboard
+        status = board.get_status()
+        if board.last_status_report != self.planner_report:
+            # a new status from the firmware, the queued moves are
+            # planned now (instead of for every gcode line)
+            self.planner_report = board.last_status_report
+            self.planner.update(board.fwbuf_bytes_processed(), status['ready'])
+        done, total = self.planner.progress()
+        status = dict(status)
+        queue = status['queue'] = dict(status['queue'])
+        queue['upload_percent'] = 100.0
+        if self.uploading:
+            fraction = self.upload_fraction
+            if fraction is None:
+                queue['upload_percent'] = None
+            else:
+                queue['upload_percent'] = round(100.0 * fraction, 1)
+                if fraction > 0:
+                    total = max(total, total / fraction)
+        queue['time_total'] = round(total, 1)
+        queue['time_remaining'] = round(total - done, 1)
+        if total > 0:
+            queue['time_percent'] = round(100.0 * done / total, 1)
+        else:
+            queue['time_percent'] = 100.0
+        return status
 
     def special_line(self, line):
         # those commands work even when disconnected:
         if line == '!' or line == '!stop':
             # instant stop
             self.driveboard.send_command('CMD_STOP')
+            self.planner.reset()
             return 'ok'
         elif line == '~' or line == '!resume':
             # recover from all stop conditions
             error = self.driveboard.connect()
             if error: return 'error:' + error
             self.driveboard.send_command('CMD_RESUME')
+            self.planner.reset()
             self.driveboard.unpause()
             return 'ok'
         elif line == '!pause':
@@ -51,18 +159,56 @@ class DriveboardGcode:
             return 'error:invalid command'
 
     def gcode_line(self, line):
-        line = line.split(';')[0].strip()  # remove gcode comments
+        if ';' in line:
+            line = line.split(';')[0]  # remove gcode comments
+        line = line.strip()
         if not line:
             return ''
 
-        if not self.driveboard.is_connected():
-            return 'error:' + self.driveboard.get_disconnect_reason()
+        board = self.driveboard
+        if not board.is_connected():
+            return 'error:' + board.get_disconnect_reason()
 
-        if self.driveboard.fw_stopped:
+        if board.fw_stopped:
             # firmware is discarding all queue commands, purging the current jobdata
             # so don't waste time parsing it
             return 'ok'
 
+        m = re_move(line)
+        if m is not None:
+            # fast path, same result as the generic code below
+            g, x, y, z, f, s = m.groups()
+            try:
+                if x is not None: x = float(x)
+                if y is not None: y = float(y)
+                if z is not None: z = float(z)
+                if f is not None: f = float(f)
+                if s is not None: s = float(s)
+            except ValueError:
+                return 'error:could not parse float in %r' % line
+            params = []
+            if x is not None: params.append(('PARAM_TARGET_X', x))
+            if y is not None: params.append(('PARAM_TARGET_Y', y))
+            if z is not None: params.append(('PARAM_TARGET_Z', z))
+            if g == '1':
+                if f is not None: self.feedrate = f
+                params.append(('PARAM_FEEDRATE', self.feedrate))
+                if s is not None:
+                    try:
+                        params.extend(self._pulse_params(s, line))
+                    except GcodeError as e:
+                        return 'error:' + str(e)
+                board.send_move(params, 'CMD_LINE_BURN')
+                self.planner.queue_move(x, y, z, self.feedrate, board.fwbuf_bytes_queued)
+            else:
+                if f is not None: self.seekrate = f
+                if s is not None:
+                    return 'error:unknown arguments %r in gcode line %r' % ({'S': s}, line)
+                params.append(('PARAM_FEEDRATE', self.seekrate))
+                board.send_move(params, 'CMD_LINE_SEEK')
+                self.planner.queue_move(x, y, z, self.seekrate, board.fwbuf_bytes_queued)
+            return 'ok'
+
         args = {}
 
         # parse and remove raster data
@@ -75,121 +221,192 @@ class DriveboardGcode:
                 return 'error: invalid base64 encoded data in gcode %r' % line
 
         # extract gcode parameters
-        parts = re.split(r'([A-Z])', line)
-        if parts[0] != '' or len(parts) < 3:
+        words = re_words(line)
+        if not words or not 'A' <= line[0] <= 'Z':
             return 'error:unknown gcode %r' % line
+        letter, value = words[0]
         try:
             # this way, we support both G00 and G0
-            cmd = (parts[1] + str(int(parts[2]))).strip()
+            cmd = letter + str(int(value))
         except ValueError:
             return 'error:could not parse int in %r' % line
-        parts = parts[3:]
 
-        while parts:
-            letter = parts.pop(0).strip()
+        for letter, value in words[1:]:
             try:
-                value = float(parts.pop(0))
+                args[letter] = float(value)
             except ValueError:
                 return 'error:could not parse float in %r' % line
-            args[letter] = value
 
-        # result of parsing
-        params = []
-        command = None
-        raster_data = None
-        intensity_value = None
+        handler = self.handlers.get(cmd)
+        if handler is None:
+            if cmd[0] == 'S':
+                handler = DriveboardGcode._set_intensity
+            else:
+                return 'error:unknown gcode command %r' % line
 
-        if cmd in ('G0', 'G1', 'G7'):
-            # move (G0: without lasing; G1: with lasing)
-            if 'X' in args: params.append(('PARAM_TARGET_X', args.pop('X')))
-            if 'Y' in args: params.append(('PARAM_TARGET_Y', args.pop('Y')))
-            if 'Z' in args: params.append(('PARAM_TARGET_Z', args.pop('Z')))
+        try:
+            params, command, raster_data = handler(self, cmd, args, line)
+        except GcodeError as e:
+            return 'error:' + str(e)
 
-            if cmd == 'G0':
-                self.seekrate = args.pop('F', self.seekrate)
-                params.append(('PARAM_FEEDRATE', self.seekrate))
-            else:
-                self.feedrate = args.pop('F', self.feedrate)
-                params.append(('PARAM_FEEDRATE', self.feedrate))
+        # execute
 
-            if cmd == 'G0':
-                command = 'CMD_LINE_SEEK'
-            elif cmd == 'G1':
+        board.send_move(params, command)
+        if raster_data:
+            board.send_raster_data(raster_data)
+        if command in MOVE_COMMANDS:
+            params = dict(params)
+            self.planner.queue_move(params.get('PARAM_TARGET_X'),
+                                    params.get('PARAM_TARGET_Y'),
+                                    params.get('PARAM_TARGET_Z'),
+                                    params['PARAM_FEEDRATE'], board.fwbuf_bytes_queued)
+        elif command == 'CMD_HOMING':
+            self.planner.set_position(0.0, 0.0, 0.0)
+        return 'ok'
+
+    def seek(self, x, y, feedrate):
+        """Same as the gcode line "G0 X<x> Y<y> F<feedrate>" """
+        board = self.driveboard
+        if not board.is_connected():
+            return 'error:' + board.get_disconnect_reason()
+        if board.fw_stopped:
+            return 'ok'
+        self.seekrate = feedrate
+        board.send_move([('PARAM_TARGET_X', x),
+                         ('PARAM_TARGET_Y', y),
+                         ('PARAM_FEEDRATE', feedrate)], 'CMD_LINE_SEEK')
+        self.planner.queue_move(x, y, None, feedrate, board.fwbuf_bytes_queued)
+        return 'ok'
+
+    def raster(self, x, y, feedrate, data):
+        """Same as the gcode line "G7 X<x> Y<y> F<feedrate> V1 D<data>"
+
+        Unlike in gcode, data is not base64 encoded.
+        """
+        board = self.driveboard
+        if not board.is_connected():
+            return 'error:' + board.get_disconnect_reason()
+        if board.fw_stopped:
+            return 'ok'
+        if not data:
+            return 'error:G7 command without raster data'
+        if len(data) > driveboard.RASTER_BYTES_MAX:
+            return 'error:G7 command only implemented for at most %d bytes of raster data' % driveboard.RASTER_BYTES_MAX
+        self.feedrate = feedrate
+        board.send_move([('PARAM_TARGET_X', x),
+                         ('PARAM_TARGET_Y', y),
+                         ('PARAM_FEEDRATE', feedrate),
+                         ('PARAM_RASTER_BYTES', len(data))], 'CMD_LINE_RASTER')
+        board.send_raster_data(data)
+        self.planner.queue_move(x, y, None, feedrate, board.fwbuf_bytes_queued)
+        return 'ok'
+
+    def _pulse_params(self, intensity_value, line):
+        """Convert an intensity to the pulse parameters to send"""
+        if intensity_value == self.intensity_cache[0]:
+            return self.intensity_cache[1]
+        try:
+            intensity = float(intensity_value)
+        except ValueError:
+            raise GcodeError('invalid intensity %r' % line)
+        if intensity < 0 or intensity > 255:
+            raise GcodeError('intensity out of range (0-255) %r' % line)
+        frequency, duration = pulseraster.intensity2pulse(intensity)
+        params = (('PARAM_PULSE_FREQUENCY', frequency),
+                  ('PARAM_PULSE_DURATION', duration))
+        self.intensity_cache = (intensity_value, params)
+        return params
+
+    # Command handlers, see the dispatch table below.
+    #
+    # They pop the arguments they understand and return a tuple
+    # (params, command, raster_data), or raise GcodeError.
+
+    def _check_args(self, args, line):
+        if args:
+            raise GcodeError('unknown arguments %r in gcode line %r' % (args, line))
+
+    def _move(self, cmd, args, line):
+        # move (G0: without lasing; G1: with lasing)
+        params = []
+        if 'X' in args: params.append(('PARAM_TARGET_X', args.pop('X')))
+        if 'Y' in args: params.append(('PARAM_TARGET_Y', args.pop('Y')))
+        if 'Z' in args: params.append(('PARAM_TARGET_Z', args.pop('Z')))
+
+        raster_data = None
+        intensity_value = None
+        if cmd == 'G0':
+            self.seekrate = args.pop('F', self.seekrate)
+            params.append(('PARAM_FEEDRATE', self.seekrate))
+            command = 'CMD_LINE_SEEK'
+        else:
+            self.feedrate = args.pop('F', self.feedrate)
+            params.append(('PARAM_FEEDRATE', self.feedrate))
+            if cmd == 'G1':
                 command = 'CMD_LINE_BURN'
                 intensity_value = args.pop('S', None)
-            elif cmd == 'G7':
+            else:
                 command = 'CMD_LINE_RASTER'
-                if args.pop('V') != 1:
-                    return 'error:G7 command of unknown version'
-                raster_data = args.pop('D')
+                if args.pop('V', None) != 1:
+                    raise GcodeError('G7 command of unknown version')
+                raster_data = args.pop('D', None)
                 if not raster_data:
-                    return 'error:G7 command without raster data'
+                    raise GcodeError('G7 command without raster data')
                 if len(raster_data) > driveboard.RASTER_BYTES_MAX:
-                    return 'error:G7 command only implemented for at most %d bytes of raster data' % driveboard.RASTER_BYTES_MAX
+                    raise GcodeError('G7 command only implemented for at most %d bytes of raster data' % driveboard.RASTER_BYTES_MAX)
                 params.append(('PARAM_RASTER_BYTES', len(raster_data)))
 
-        elif cmd == 'G90':
-            command = 'CMD_REF_ABSOLUTE'
-            self.relative = False
-        elif cmd == 'G91':
-            command = 'CMD_REF_RELATIVE'
-            self.relative = True
-        elif cmd == 'M80': command = 'CMD_AIR_ENABLE'
-        elif cmd == 'M81': command = 'CMD_AIR_DISABLE'
-        elif cmd == 'M82': command = 'CMD_AUX1_ENABLE'
-        elif cmd == 'M83': command = 'CMD_AUX1_DISABLE'
-        elif cmd == 'M84': command = 'CMD_AUX2_ENABLE'
-        elif cmd == 'M85': command = 'CMD_AUX2_DISABLE'
-        elif cmd == 'G10':
-            p = args.pop('P', None)
-            if p == 0:  # set table offset (G54)
-                which = 'TABLE'  # (never used by current frontend)
-            elif p == 1:  # set custom offset (G55)
-                which = 'CUSTOM'
-            else:
-                return 'error:set_offset G10 requires P0 or P1 parameter'
-
-            l = args.pop('L', None)
-            if l == 20:  # L20 - set to current location
-                command = 'CMD_SET_OFFSET_' + which
-            elif l != 2:
-                return 'error:set_offset G10 requires L2 or L20 parameter'
-            else:  # L2 - set to value
-                if 'X' in args: params.append(('PARAM_OFF' + which + '_X', args.pop('X')))
-                if 'Y' in args: params.append(('PARAM_OFF' + which + '_Y', args.pop('Y')))
-                if 'Z' in args: params.append(('PARAM_OFF' + which + '_Z', args.pop('Z')))
-                command = None  # sending the parameters is enough
-        elif cmd == 'G54':
-            command = 'CMD_SEL_OFFSET_TABLE'
-        elif cmd == 'G55':
-            command = 'CMD_SEL_OFFSET_CUSTOM'
-        elif cmd == 'G30':
-            command = 'CMD_HOMING'
-        elif cmd[0] == 'S':
-            # set intensity
-            intensity_value = line[1:]
+        self._check_args(args, line)
+        if intensity_value is not None:
+            params.extend(self._pulse_params(intensity_value, line))
+        return params, command, raster_data
+
+    def _set_reference(self, cmd, args, line):
+        self.relative = (cmd == 'G91')
+        self.planner.set_relative(self.relative)
+        self._check_args(args, line)
+        if self.relative:
+            return (), 'CMD_REF_RELATIVE', None
         else:
-            return 'error:unknown gcode command %r' % line
-        if args:
-            return 'error:unknown arguments %r in gcode line %r' % (args, line)
+            return (), 'CMD_REF_ABSOLUTE', None
 
-        if intensity_value is not None:
-            try:
-                intensity = float(intensity_value)
-            except ValueError:
-                return 'error:invalid intensity %r' % line
-            if intensity < 0 or intensity > 255:
-                return 'error:intensity out of range (0-255) %r' % line
-            frequency, duration = pulseraster.intensity2pulse(intensity)
-            params.append(('PARAM_PULSE_FREQUENCY', frequency))
-            params.append(('PARAM_PULSE_DURATION', duration))
+    def _set_offset(self, cmd, args, line):
+        params = []
+        p = args.pop('P', None)
+        if p == 0:  # set table offset (G54)
+            which = 'TABLE'  # (never used by current frontend)
+        elif p == 1:  # set custom offset (G55)
+            which = 'CUSTOM'
+        else:
+            raise GcodeError('set_offset G10 requires P0 or P1 parameter')
 
-        # execute
+        l = args.pop('L', None)
+        if l == 20:  # L20 - set to current location
+            command = 'CMD_SET_OFFSET_' + which
+        elif l != 2:
+            raise GcodeError('set_offset G10 requires L2 or L20 parameter')
+        else:  # L2 - set to value
+            if 'X' in args: params.append(('PARAM_OFF' + which + '_X', args.pop('X')))
+            if 'Y' in args: params.append(('PARAM_OFF' + which + '_Y', args.pop('Y')))
+            if 'Z' in args: params.append(('PARAM_OFF' + which + '_Z', args.pop('Z')))
+            command = None  # sending the parameters is enough
+        self._check_args(args, line)
+        return params, command, None
 
-        for name, value in params:
-            self.driveboard.send_param(name, value)
-        if command:
-            self.driveboard.send_command(command)
-        if raster_data:
-            self.driveboard.send_raster_data(raster_data)
-        return 'ok'
+    def _simple_command(self, cmd, args, line):
+        self._check_args(args, line)
+        return (), SIMPLE_COMMANDS[cmd], None
+
+    def _set_intensity(self, cmd, args, line):
+        self._check_args(args, line)
+        return self._pulse_params(line[1:], line), None, None
+
+    handlers = {
+        'G0': _move,
+        'G1': _move,
+        'G7': _move,
+        'G90': _set_reference,
+        'G91': _set_reference,
+        'G10': _set_offset,
+    }
+    handlers.update(dict.fromkeys(SIMPLE_COMMANDS, _simple_command))
@@ -9,49 +9,98 @@ __author__ = 'Stefan Hechenberger <stefan@nortd.com>'
 from .svg_reader import SVGReader
 from .dxf_reader import DXFReader
 from .ngc_reader import NGCReader
-from .path_optimizers import optimize_all
+from .path_optimizers import optimize_all, optimize_passes
+from .polylines import Polylines
 
 
-def read_svg(svg_string, target_size, tolerance, forced_dpi=None, optimize=True):
+# The optional progress argument of the read_* functions is a callback
+# progress(stage, fraction) that is called while parsing and while
+# optimizing, every few thousand elements or paths. It may raise an
+# exception to abort the import.
+#
+# tour_budget is the time in seconds spent on shortening the seek
+# moves between paths (see path_optimizers.improve_tour), after sorting
+# them greedily.
+#
+# read_svg also accepts a file object instead of a string, which is
+# parsed incrementally (see SVGReader.parse_stream).
+
+
+def read_svg(svg_string, target_size, tolerance, forced_dpi=None, optimize=True, progress=None, tour_budget=0):
+    if progress: progress('parsing', 0.0)
     svgReader = SVGReader(tolerance, target_size)
-    parse_results = svgReader.parse(svg_string, forced_dpi)
+    if hasattr(svg_string, 'read'):
+        parse_results = svgReader.parse_stream(svg_string, forced_dpi, _stage(progress, 'parsing'))
+    else:
+        parse_results = svgReader.parse(svg_string, forced_dpi)
     if optimize:
-        optimize_all(parse_results['boundarys'], tolerance)
+        optimize_all(parse_results['boundarys'], tolerance, progress, tour_budget)
     # {'boundarys':b, 'dpi':d, 'lasertags':l}
     return parse_results
 
 
-def read_dxf(dxf_string, tolerance, optimize=True):
+def read_dxf(dxf_string, tolerance, optimize=True, progress=None, tour_budget=0):
+    if progress: progress('parsing', 0.0)
     dxfReader = DXFReader(tolerance)
-    parse_results = dxfReader.parse(dxf_string)
+    parse_results = dxfReader.parse(dxf_string, _stage(progress, 'parsing'))
     if optimize:
-        optimize_all(parse_results['boundarys'], tolerance)
+        optimize_all(parse_results['boundarys'], tolerance, progress, tour_budget)
     # flip y-axis
-    min_x = None
-    min_y = None
-    for color,paths in parse_results['boundarys'].items():
-        for path in paths:
-            for vertex in path:
-                vertex[1] = 610.0 - vertex[1]
-                if min_x is None or vertex[0] < min_x:
-                    min_x = vertex[0]
-                if min_y is None or vertex[1] < min_y:
-                    min_y = vertex[1]
-
-
+    bounds = []
     for color,paths in parse_results['boundarys'].items():
-        for path in paths:
-            for vertex in path:
-                vertex[0] = vertex[0] - min_x
-                vertex[1] = vertex[1] - min_y
+        paths.transform([1,0,0,-1,0,610.0])
+        b = paths.bounds()
+        if b:
+            bounds.append(b)
+    if bounds:
+        min_x = min(b[0] for b in bounds)
+        min_y = min(b[1] for b in bounds)
+        for color,paths in parse_results['boundarys'].items():
+            paths.transform([1,0,0,1,-min_x,-min_y])
 
     return parse_results
 
 
-def read_ngc(ngc_string, tolerance, optimize=True):
+def read_ngc(ngc_string, tolerance, optimize=True, progress=None):
+    if progress: progress('parsing', 0.0)
     ngcReader = NGCReader(tolerance)
-    parse_results = ngcReader.parse(ngc_string)
+    parse_results = ngcReader.parse(ngc_string, _stage(progress, 'parsing'))
     # if optimize:
     #     optimize_all(parse_results['boundarys'], tolerance)
     return parse_results
 
+
+def _stage(progress, stage):
+    # progress(fraction) of the parsers, reported as progress(stage, fraction)
+    if progress:
+        return lambda fraction: progress(stage, fraction)
+    return None
+
+
+def to_json_results(parse_results):
+    """Convert the boundarys to lists of [x,y] vertices for JSON."""
+    res = dict(parse_results)
+    res['boundarys'] = dict((color, paths.tolist())
+                            for color, paths in parse_results['boundarys'].items())
+    return res
+
+
+def optimize_job(job, order_colors=False, tour_budget=0):
+    """Order the paths of a job in the frontend's format across passes.
+
+    job is {'passes':[{'colors':[..], ..}, ..],
+            'paths_by_color':{color:[[[x,y], ..], ..], ..}}
+    Returns (job, seek_before, seek_after), see optimize_passes.
+    """
+    boundarys = {}
+    for color, paths in job['paths_by_color'].items():
+        paths = [path for path in paths if path]  # empty paths are not cut
+        dims = len(paths[0][0]) if paths else 2
+        boundarys[color] = Polylines.from_list(paths, dims)
+    passes, boundarys, seek_before, seek_after = optimize_passes(
+        job['passes'], boundarys, order_colors=order_colors, tour_budget=tour_budget)
+    res = dict(job)
+    res['passes'] = passes
+    res['paths_by_color'] = dict((color, paths.tolist())
+                                 for color, paths in boundarys.items())
+    return res, seek_before, seek_after
@@ -17,6 +17,10 @@ class DXFGroupBuffer:
     def __iter__(self):
         return self
 
+    def tell(self):
+        """Number of characters read so far"""
+        return self.stringio.tell()
+
     def __next__(self):
         """
 
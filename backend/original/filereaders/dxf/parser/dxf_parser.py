@@ -7,6 +7,9 @@ import logging
 
 log = logging.getLogger(__name__)
 
+# group code/value pairs between two calls of the progress callback
+PROGRESS_GROUPS = 10000
+
 class DXFParser(dxf_handler.DXFHandler):
 
     GROUP_CODE_ENTITY_START     = 0
@@ -63,9 +66,14 @@ class DXFParser(dxf_handler.DXFHandler):
         self.sectionStarts = False
 
 
-    def parse(self, dxfstring, tolerance):
+    def parse(self, dxfstring, tolerance, progress=None):
+        """
+        :param progress: optional callback progress(fraction), called
+            while reading (up to 0.8) and rasterizing the entities
+        """
         from .dxf_group_buffer import DXFGroupBuffer
         from filereaders.dxf.dxf_document import DXFDocument
+        from filereaders.polylines import Polylines
 
         linecount   = 0
         document    = DXFDocument()
@@ -76,17 +84,25 @@ class DXFParser(dxf_handler.DXFHandler):
 
         for groupCode, value in groupBuffer:
             linecount += 1
+            if progress and linecount % PROGRESS_GROUPS == 0:
+                progress(0.8*groupBuffer.tell()/len(dxfstring))
             if not self.parseGroup(groupCode, value):
                 break
 
         log.info("Parse Done")
 
-        path = []
+        path = Polylines()
+        entitycount = sum(len(entityList) for layer in document.layers.values()
+                          for entityList in layer.entities.values())
+        done = 0
         for layerName, layer in document.layers.items():
             for entityName, entityList in layer.entities.items():
+                if progress:
+                    progress(0.8 + 0.2*done/entitycount)
+                done += len(entityList)
                 try:
                     for entity in entityList:
-                        path.append(entity.rasterize(tolerance))
+                        path.append_vertices(entity.rasterize(tolerance))
                 except NotImplementedError:
                     pass
 
@@ -6,6 +6,7 @@ import math
 import io
 import logging
 import filereaders.dxf.parser.dxf_parser
+from .polylines import Polylines
 
 logging.basicConfig()
 log = logging.getLogger(__name__)
@@ -28,9 +29,9 @@ class DXFReader:
         self.tolerance2 = tolerance**2
 
         # parsed path data, paths by color
-        # {'#ff0000': [[path0, path1, ..], [path0, ..], ..]}
-        # Each path is a list of vertices which is a list of two floats.        
-        self.boundarys = {'#000000':[]}
+        # {'#ff0000': Polylines, '#0000ff': Polylines}
+        # Each path is a flat array of floats [x,y, x,y, ...].
+        self.boundarys = {'#000000':Polylines()}
         self.black_boundarys = self.boundarys['#000000']
 
         self.metricflag = 1
@@ -40,7 +41,7 @@ class DXFReader:
 
 
 
-    def parse(self, dxfstring):
+    def parse(self, dxfstring, progress=None):
         self.linecount = 0
         self.line = ""
         self.infile = io.StringIO(dxfstring)
@@ -86,7 +87,7 @@ class DXFReader:
         #d = {'#000000': [l]}
         #return {'boundarys': d}
 
-        l = parser.parse(dxfstring, self.tolerance)
+        l = parser.parse(dxfstring, self.tolerance, progress)
 
         d = {'#000000': l}
         return {'boundarys': d}
@@ -135,7 +136,7 @@ class DXFReader:
             y1 = y1*25.4        
             x2 = x2*25.4
             y2 = y2*25.4        
-        self.black_boundarys.append([[x1,y1],[x2,y2]])
+        self.black_boundarys.append([x1,y1, x2,y2])
 
     def do_circle(self):
         cx = float(self.readgroup(10))
@@ -150,7 +151,7 @@ class DXFReader:
         self.addArc(path, cx, cy+r, r, r, 0, 0, 0, cx+r, cy)
         self.addArc(path, cx+r, cy, r, r, 0, 0, 0, cx, cy-r)
         self.addArc(path, cx, cy-r, r, r, 0, 0, 0, cx-r, cy)
-        self.black_boundarys.append(path)
+        self.black_boundarys.append_vertices(path)
 
     def do_arc(self):
         cx = float(self.readgroup(10))
@@ -174,12 +175,11 @@ class DXFReader:
         y2 = cy + r*math.sin(theta2)
         path = []
         self.addArc(path, x1, y1, r, r, 0, large_arc_flag, sweep_flag, x2, y2)
-        self.black_boundarys.append(path)
+        self.black_boundarys.append_vertices(path)
 
     def do_lwpolyline(self):
         numverts = int(self.readgroup(90))
         path = []
-        self.black_boundarys.append(path)
         for i in range(0,numverts):
             x = float(self.readgroup(10))
             y = float(self.readgroup(20))
@@ -187,6 +187,7 @@ class DXFReader:
                 x = x*25.4
                 y = y*25.4
             path.append([x,y])
+        self.black_boundarys.append_vertices(path)
 
     def complain_spline(self):
         print("Encountered a SPLINE at line", self.linecount)
@@ -8,6 +8,10 @@ import re
 import os.path
 import io
 
+from .polylines import Polylines
+
+# lines between two calls of the progress callback
+PROGRESS_LINES = 10000
 
 
 
@@ -22,19 +26,20 @@ class NGCReader:
         self.tolerance2 = tolerance**2
 
         # parsed path data, paths by color
-        # {'#ff0000': [[path0, path1, ..], [path0, ..], ..]}
-        # Each path is a list of vertices which is a list of two floats.        
-        self.boundarys = {'#000000':[]}
+        # {'#ff0000': Polylines, '#0000ff': Polylines}
+        # Each path is a flat array of floats [x,y,z, x,y,z, ...].
+        self.boundarys = {'#000000':Polylines(3)}
         self.black_boundarys = self.boundarys['#000000']
 
 
-    def parse(self, ngcstring):
+    def parse(self, ngcstring, progress=None):
         """This is a total super quick HACK!!!!
             Pretty much only parses the old example files.
+
+            progress(fraction) is called every PROGRESS_LINES lines.
         """
 
-        paths = []
-        current_path = []
+        paths = Polylines(3)
         re_findall_attribs = re.compile('(S|F|X|Y|Z)(-?[0-9]+\.?[0-9]*(?:e-?[0-9]*)?)').findall
 
         intensity = 0.0
@@ -44,7 +49,9 @@ class NGCReader:
 
 
         lines = ngcstring.split('\n')
-        for line in lines:
+        for i, line in enumerate(lines):
+            if progress and i % PROGRESS_LINES == 0:
+                progress(float(i)/len(lines))
             line = line.replace(' ', '')
             if line.startswith('G0'):
                 attribs = re_findall_attribs(line[2:])
@@ -61,8 +68,7 @@ class NGCReader:
             elif line.startswith('G1'):
                 if prev_motion_was_seek:
                     # new path
-                    paths.append([[target[0], target[1], target[2]]])
-                    current_path = paths[-1]
+                    paths.append(target)
                     prev_motion_was_seek = False
                 # new target
                 attribs = re_findall_attribs(line[2:])
@@ -77,7 +83,7 @@ class NGCReader:
                         intensity = float(attr[1])
                     elif attr[0] == 'F':
                         feedrate = float(attr[1])
-                current_path.append([target[0], target[1], target[2]])
+                paths.extend_last(target)
             elif line.startswith('S'):
                 attribs = re_findall_attribs(line)
                 for attr in attribs:
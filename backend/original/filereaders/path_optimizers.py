@@ -1,126 +1,254 @@
 """
 Optimizations of paths.
 
-The format of a path segment is:
-[[x1,y1],[x2,y2],...]
+The paths of a color are stored as Polylines (see polylines.py),
+each path segment is a polyline:
+[x1,y1, x2,y2, ...]
 
-The format of path is:
-[pathseg1, pathseg2, ...] 
-
-This module is typically used by calling the 'optimize' function.
-It takes a list of paths and optimizes in-place.
+This module is typically used by calling the 'optimize_all' function.
+The optimizations return new Polylines, optimize_all replaces the
+paths in the boundarys dict.
 """
 
 __author__ = 'Stefan Hechenberger <stefan@nortd.com>'
 
 
 import math
+import time
 import logging
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from . import kdtree
+from .polylines import Polylines, reverse_vertices
 
 log = logging.getLogger("svg_reader")
 
+# simplifyDP: subchains with more vertices are checked with numpy
+DP_NUMPY_MIN_VERTICES = 64
+# improve_tour: number of nearby path ends tried for each move
+TOUR_NEIGHBORS = 8
+# improve_tour: longest run of paths moved by Or-opt
+OR_OPT_MAX = 3
+# paths between two calls of the progress callback
+PROGRESS_PATHS = 1000
+
 
 
-def connect_segments(path, epsilon2):
+def connect_segments(path, epsilon2, progress=None):
     """
     Optimizes continuity of path.
 
-    This function joins path segments if either the next start point
-    is congruent with the current end point.
+    This function joins path segments whose end points are congruent
+    (closer than epsilon), in any order. Segments are reversed where
+    needed. The end points are looked up in a grid of epsilon sized
+    cells, so this takes about linear time.
+
+    The optional progress(fraction) callback is called every
+    PROGRESS_PATHS segments, like in the other optimizations.
     """
+    dims = path.dims
+    coords = path.coords
+    offsets = path.offsets
+    n = len(path)
+    cell = math.sqrt(epsilon2) or 1.0
+
+    # grid cell -> [(segment index, is end point), ..]
+    grid = {}
+    def _key(pos):
+        return (int(math.floor(coords[pos]/cell)), int(math.floor(coords[pos+1]/cell)))
+    for i in range(n):
+        if offsets[i] == offsets[i+1]:
+            continue  # empty path segment
+        grid.setdefault(_key(offsets[i]), []).append((i, False))
+        grid.setdefault(_key(offsets[i+1]-dims), []).append((i, True))
+
+    used = [False]*n
+    def _take(i):
+        used[i] = True
+        grid[_key(offsets[i])].remove((i, False))
+        grid[_key(offsets[i+1]-dims)].remove((i, True))
+
+    def _find(pos):
+        # lowest unused segment with an end point close to coords[pos]
+        x = coords[pos]
+        y = coords[pos+1]
+        kx, ky = _key(pos)
+        best = None
+        for gx in (kx-1, kx, kx+1):
+            for gy in (ky-1, ky, ky+1):
+                for i, is_end in grid.get((gx, gy), ()):
+                    if best is not None and best <= (i, is_end):
+                        continue
+                    vpos = offsets[i+1]-dims if is_end else offsets[i]
+                    if (x-coords[vpos])**2 + (y-coords[vpos+1])**2 < epsilon2:
+                        best = (i, is_end)
+        return best
+
+    joined = Polylines(dims)
     join_count = 0
-    newIdx = 0
-    for i in range(1,len(path)):
-        lastpathseg = path[newIdx]
-        pathseg = path[i]
-        point = lastpathseg[-1]
-        startpoint = pathseg[0]
-
-        # join into lastpathseg
-        d2_start = (point[0]-startpoint[0])**2 + (point[1]-startpoint[1])**2
-        if d2_start < epsilon2:
-            lastpathseg.extend(pathseg[1:])
-            join_count += 1
+    for i in range(n):
+        if progress and i % PROGRESS_PATHS == 0:
+            progress(float(i)/n)
+        if used[i] or offsets[i] == offsets[i+1]:
             continue
-        
-        # add as is
-        newIdx += 1
-        path[newIdx] = pathseg
-
-    # remove exessive slots
-    for i in range(len(path)-(newIdx+1)):
-        path.pop()
+        _take(i)
+        # chain of (segment index, reversed)
+        chain = [(i, False)]
+        # extend at the end
+        endpos = offsets[i+1]-dims
+        while True:
+            match = _find(endpos)
+            if match is None:
+                break
+            j, is_end = match
+            _take(j)
+            chain.append((j, is_end))
+            endpos = offsets[j] if is_end else offsets[j+1]-dims
+        # extend at the start
+        head = []
+        startpos = offsets[i]
+        while True:
+            match = _find(startpos)
+            if match is None:
+                break
+            j, is_end = match
+            _take(j)
+            head.append((j, not is_end))
+            startpos = offsets[j+1]-dims if not is_end else offsets[j]
+        chain = head[::-1] + chain
+        join_count += len(chain) - 1
+
+        # copy into the result, skipping the duplicate joint vertices
+        for k, (j, rev) in enumerate(chain):
+            pathseg = coords[offsets[j]:offsets[j+1]]
+            if rev:
+                pathseg = reverse_vertices(pathseg, dims)
+            if k == 0:
+                joined.append(pathseg)
+            else:
+                joined.extend_last(pathseg[dims:])
 
     # report if excessive joins
     if join_count > 100:
         log.info("joined many path segments: " + str(join_count))
+    return joined
 
 
 
-def d2(u,v): return (u[0]-v[0])**2 + (u[1]-v[1])**2
-
-
-def simplifyDP(tol2, v, j, k, mk):
-    #  This is the Douglas-Peucker recursive simplification routine
+def simplifyDP(tol2, vx, vy, j, k, mk):
+    #  This is the Douglas-Peucker simplification routine
     #  It just marks vertices that are part of the simplified polyline
     #  for approximating the polyline subchain v[j] to v[k].
+    #  Subchains still to be checked are kept on a stack (instead of
+    #  recursing), long ones are checked with numpy if available.
+    #  vx[], vy[] ... vertex coordinates
     #  mk[] ... array of markers matching vertex array v[]
-    if k <= j+1:  # there is nothing to simplify
-        return
-    # check for adequate approximation by segment S from v[j] to v[k]
-    maxi = j           # index of vertex farthest from S
-    maxd2 = 0          # distance squared of farthest vertex
-    S = [v[j], v[k]]   # segment from v[j] to v[k]
-    # u = diff(S[1], S[0])    # segment direction vector
-    u = [S[1][0]-S[0][0], S[1][1]-S[0][1]]  # segment direction vector
-    # cu = norm2(u)      # segment length squared
-    cu = u[0]**2 + u[1]**2  # segment length squared
-    # test each vertex v[i] for max distance from S
-    # compute using the Feb 2001 Algorithm's dist_Point_to_Segment()
-    # Note: this works in any dimension (2D, 3D, ...)
-    w = None           # vector
-    Pb = None          # point, base of perpendicular from v[i] to S
-    b = 0.0
-    cw = 0.0
-    dv2 = 0.0         # dv2 = distance v[i] to S squared
-    for i in range(j+1, k):
-        # compute distance squared
-        # w = diff(v[i], S[0])
-        w = [v[i][0]-S[0][0], v[i][1]-S[0][1]]  # diff
-        # cw = dot(w,u)
-        cw = w[0]*u[0] + w[1]*u[1]  # dot product
-        if cw <= 0:
-            dv2 = d2(v[i], S[0])
-        elif cu <= cw:
-            dv2 = d2(v[i], S[1])
-        else:
-            b = cw / cu
-            Pb = [S[0][0]+b*u[0], S[0][1]+b*u[1]]
-            dv2 = d2(v[i], Pb)
-        # test with current max distance squared
-        if dv2 <= maxd2:
+    ax = ay = None
+    if numpy is not None and k-j > DP_NUMPY_MIN_VERTICES:
+        ax = numpy.array(vx[j:k+1])
+        ay = numpy.array(vy[j:k+1])
+        offset = j
+    stack = [(j, k)]
+    while stack:
+        j, k = stack.pop()
+        if k <= j+1:  # there is nothing to simplify
             continue
-        # v[i] is a new max vertex
-        maxi = i
-        maxd2 = dv2
-    if maxd2 > tol2:       # error is worse than the tolerance
-        # split the polyline at the farthest vertex from S
-        mk[maxi] = 1       # mark v[maxi] for the simplified polyline
-        # recursively simplify the two subpolylines at v[maxi]
-        simplifyDP(tol2, v, j, maxi, mk)  # polyline v[j] to v[maxi]
-        simplifyDP(tol2, v, maxi, k, mk)  # polyline v[maxi] to v[k]
-    # else the approximation is OK, so ignore intermediate vertices
-    return
-
-
-def simplify(pathseg, tolerance2):
+        if ax is not None and k-j > DP_NUMPY_MIN_VERTICES:
+            maxi, maxd2 = _farthest_numpy(ax, ay, j-offset, k-offset)
+            maxi += offset
+        else:
+            # check for adequate approximation by segment S from v[j] to v[k]
+            maxi = j           # index of vertex farthest from S
+            maxd2 = 0          # distance squared of farthest vertex
+            # S = [v[j], v[k]]   # segment from v[j] to v[k]
+            s0x = vx[j]
+            s0y = vy[j]
+            s1x = vx[k]
+            s1y = vy[k]
+            # u = diff(S[1], S[0])    # segment direction vector
+            ux = s1x-s0x
+            uy = s1y-s0y
+            # cu = norm2(u)      # segment length squared
+            cu = ux**2 + uy**2  # segment length squared
+            # test each vertex v[i] for max distance from S
+            # compute using the Feb 2001 Algorithm's dist_Point_to_Segment()
+            dv2 = 0.0         # dv2 = distance v[i] to S squared
+            for i in range(j+1, k):
+                # compute distance squared
+                x = vx[i]
+                y = vy[i]
+                # w = diff(v[i], S[0])
+                # cw = dot(w,u)
+                cw = (x-s0x)*ux + (y-s0y)*uy  # dot product
+                if cw <= 0:
+                    dv2 = (x-s0x)**2 + (y-s0y)**2
+                elif cu <= cw:
+                    dv2 = (x-s1x)**2 + (y-s1y)**2
+                else:
+                    # Pb ... base of perpendicular from v[i] to S
+                    b = cw / cu
+                    dv2 = (x-(s0x+b*ux))**2 + (y-(s0y+b*uy))**2
+                # test with current max distance squared
+                if dv2 <= maxd2:
+                    continue
+                # v[i] is a new max vertex
+                maxi = i
+                maxd2 = dv2
+        if maxd2 > tol2:       # error is worse than the tolerance
+            # split the polyline at the farthest vertex from S
+            mk[maxi] = 1       # mark v[maxi] for the simplified polyline
+            # simplify the two subpolylines at v[maxi]
+            if k > maxi+1:
+                stack.append((maxi, k))  # polyline v[maxi] to v[k]
+            if maxi > j+1:
+                stack.append((j, maxi))  # polyline v[j] to v[maxi]
+        # else the approximation is OK, so ignore intermediate vertices
+
+
+def _farthest_numpy(ax, ay, j, k):
+    # the farthest vertex from the segment v[j] to v[k] as in the loop
+    # of simplifyDP, with the same operations, so with the same result
+    s0x = ax[j]
+    s0y = ay[j]
+    s1x = ax[k]
+    s1y = ay[k]
+    ux = s1x-s0x
+    uy = s1y-s0y
+    cu = ux*ux + uy*uy
+    x = ax[j+1:k]
+    y = ay[j+1:k]
+    dx = x-s0x
+    dy = y-s0y
+    cw = dx*ux + dy*uy
+    dv2 = dx*dx + dy*dy  # cw <= 0
+    if cu > 0:
+        # with cu == 0, cw is 0 everywhere
+        ex = x-s1x
+        ey = y-s1y
+        dv2 = numpy.where(cw <= 0, dv2, ex*ex + ey*ey)
+        along = (cw > 0) & (cw < cu)
+        b = cw[along] / cu
+        px = x[along]-(s0x+b*ux)
+        py = y[along]-(s0y+b*uy)
+        dv2[along] = px*px + py*py
+    i = int(numpy.argmax(dv2))
+    if dv2[i] <= 0:
+        return j, 0
+    return j+1+i, float(dv2[i])
+
+
+def simplify(pathseg, tolerance2, dims=2):
     """
     Douglas-Peucker polyline simplification.
 
-    pathseg     ... [[x1,y1],[x2,y2],...]
+    pathseg     ... [x1,y1, x2,y2, ...], flat coordinates
     tolerance2  ... approximation tolerance squared
+    dims        ... coordinates per vertex (only x,y are considered)
     ===============================================
     Copyright 2002, softSurfer (www.softsurfer.com)
     This code may be freely used and modified for any purpose
@@ -130,92 +258,381 @@ def simplify(pathseg, tolerance2):
     Users of this code must verify correctness for their application.
     http://softsurfer.com/Archive/algorithm_0205/algorithm_0205.htm
     """
-    
-    n = len(pathseg)
+
+    n = len(pathseg) // dims
+    sPathseg = array('d')
     if n == 0:
-        return []
-    sPathseg = []
-    tPathseg = []                   # vertex buffer, points
+        return sPathseg
+    tIdxs = []                      # vertex buffer, indices into pathseg
 
     # STAGE 1.  Vertex Reduction within tolerance of prior vertex cluster
-    tPathseg.append(pathseg[0])        # start at the beginning
-    k = 1
+    xs = pathseg[0::dims]
+    ys = pathseg[1::dims]
+    tIdxs.append(0)                 # start at the beginning
     pv = 0
     for i in range(1, n):
-        if d2(pathseg[i], pathseg[pv]) < tolerance2:
+        if (xs[i]-xs[pv])**2 + (ys[i]-ys[pv])**2 < tolerance2:
             continue
-        tPathseg.append(pathseg[i])
-        k += 1
+        tIdxs.append(i)
         pv = i
     if pv < n-1:
-        tPathseg.append(pathseg[n-1])  # finish at the end
-        k += 1
+        tIdxs.append(n-1)           # finish at the end
+    k = len(tIdxs)
 
     # STAGE 2.  Douglas-Peucker polyline simplification
-    mk = [None for i in range(k)]    # marker buffer, ints
-    mk[0] = mk[k-1] = 1;              # mark the first and last vertices
-    simplifyDP(tolerance2, tPathseg, 0, k-1, mk)
+    mk = [0]*k                      # marker buffer, ints
+    mk[0] = mk[k-1] = 1             # mark the first and last vertices
+    simplifyDP(tolerance2, [xs[i] for i in tIdxs], [ys[i] for i in tIdxs], 0, k-1, mk)
 
     # copy marked vertices to the output simplified polyline
     for i in range(k):
         if mk[i]:
-            sPathseg.append(tPathseg[i])
+            start = tIdxs[i]*dims
+            sPathseg.extend(pathseg[start:start+dims])
     return sPathseg
 
 
 
-def simplify_all(path, tolerance2):
-    totalverts = 0
-    optiverts = 0
-    for u in range(len(path)):
-        totalverts += len(path[u])
-        path[u] = simplify(path[u], tolerance2)
-        optiverts += len(path[u])
+def simplify_all(path, tolerance2, progress=None):
+    simplified = Polylines(path.dims)
+    for i, pathseg in enumerate(path):
+        if progress and i % PROGRESS_PATHS == 0:
+            progress(float(i)/len(path))
+        simplified.append(simplify(pathseg, tolerance2, path.dims))
+    totalverts = path.num_vertices()
+    optiverts = simplified.num_vertices()
     if totalverts > 0:
-        # report polyline optimizations    
+        # report polyline optimizations
         difflength = totalverts - optiverts
         diffpct = (100*difflength/totalverts)
         if diffpct > 10:  # if diff more than 10%
             log.info("INFO: polylines optimized by " + str(int(diffpct)) + '%')
+    return simplified
 
 
 
-def sort_by_seektime(path, start=[0.0, 0.0]):
-    path_unsorted = []
+def sort_by_seektime(path, start=[0.0, 0.0], progress=None):
+    dims = path.dims
     tree = kdtree.Tree(2)
+    ends = []
     for i in range(len(path)):
-        pathseg = path[i]
-        # copy, so we can place the result in path
-        path_unsorted.append(pathseg)
         # populate kdtree
-        tree.insert(pathseg[0], (i,False))  # startpoint, data
-        tree.insert(pathseg[-1], (i,True))  # endpoint, data
+        ends.append((tree.insert(path.first(i)[:2], (i,False)),  # startpoint, data
+                     tree.insert(path.last(i)[:2], (i,True))))  # endpoint, data
 
     # sort by proximity, greedy
+    path_sorted = Polylines(dims)
     endpoint = start
-    newIdx = 0
-    usedIdxs = {}
-    for p in range(2*len(path_unsorted)):
+    for p in range(len(path)):
+        if progress and p % PROGRESS_PATHS == 0:
+            progress(float(p)/len(path))
         node, distsq = tree.nearest(endpoint, checkempty=True)
         i, rev = node.data
-        node.data = None
-        if i not in usedIdxs:
-            path[newIdx] = path_unsorted[i]
-            if rev:
-                path[newIdx].reverse()
-            endpoint = path[newIdx][-1]  # prime for next iteration
-            newIdx += 1
-            usedIdxs[i] = True
+        # both ends of the path are done
+        tree.remove(ends[i][0])
+        tree.remove(ends[i][1])
+        pathseg = path[i]
+        if rev:
+            pathseg = reverse_vertices(pathseg, dims)
+        path_sorted.append(pathseg)
+        n = len(pathseg)
+        endpoint = [pathseg[n-dims], pathseg[n-dims+1]]  # prime for next iteration
+    return path_sorted
 
 
 
 
 
 
-def optimize_all(boundarys, tolerance):
+def improve_tour(path, time_budget, start=[0.0, 0.0], progress=None):
+    """
+    Shortens the seek moves between the paths.
+
+    Starts from the order of path (e.g. from sort_by_seektime) and
+    applies moves that shorten the total seek distance until no move
+    helps or time_budget seconds have passed:
+    - 2-opt: reverse a run of paths (and each path in it)
+    - Or-opt: move a run of up to OR_OPT_MAX paths elsewhere, possibly
+      reversed
+    Only moves that connect a path end to one of its TOUR_NEIGHBORS
+    nearest path ends are tried.
+
+    progress(fraction) reports the share of the time budget used.
+    """
+    n = len(path)
+    if n < 3 or time_budget <= 0:
+        return path
+    deadline = time.time() + time_budget
+    dims = path.dims
+
+    # path ends: 2*i is the first, 2*i+1 the last vertex of path i,
+    # 2*n is the start position
+    px = []
+    py = []
+    for i in range(n):
+        first = path.first(i)
+        last = path.last(i)
+        px.extend((first[0], last[0]))
+        py.extend((first[1], last[1]))
+    px.append(start[0])
+    py.append(start[1])
+    origin = 2*n
+    tree = kdtree.Tree(2)
+    for k in range(2*n+1):
+        tree.insert((px[k], py[k]), k)
+    neighbors = {}  # path end -> nearest other path ends, looked up on demand
+    def _neighbors(k):
+        near = neighbors.get(k)
+        if near is None:
+            near = [node.data for node, d in tree.nearest_k((px[k], py[k]), TOUR_NEIGHBORS+1)
+                    if node.data != k]
+            neighbors[k] = near
+        return near
+
+    # the tour, paths are entered at s(k) and left at e(k)
+    tour = list(range(n))
+    pos = list(range(n))  # path -> position in tour
+    rev = [False]*n  # path is traversed backwards
+    def s(k):
+        if k == n:
+            return None
+        i = tour[k]
+        return 2*i+1 if rev[i] else 2*i
+    def e(k):
+        if k == -1:
+            return origin
+        i = tour[k]
+        return 2*i if rev[i] else 2*i+1
+    def d(a, b):
+        if a is None or b is None:
+            return 0.0
+        return math.hypot(px[a]-px[b], py[a]-py[b])
+    def place(k):
+        # position of a path end, and whether it is left there
+        if k == origin:
+            return -1, True
+        i = k >> 1
+        return pos[i], (k & 1) != rev[i]
+
+    def total():
+        return sum(d(e(k-1), s(k)) for k in range(n))
+    before = total()
+
+    def two_opt(a, b):
+        # reverse tour[a+1:b+1], joining e(a) with e(b) and s(a+1) with s(b+1)
+        delta = (d(e(a), e(b)) + d(s(a+1), s(b+1))
+                 - d(e(a), s(a+1)) - d(e(b), s(b+1)))
+        if delta > -1e-9:
+            return False
+        run = tour[a+1:b+1]
+        run.reverse()
+        tour[a+1:b+1] = run
+        for k in range(a+1, b+1):
+            i = tour[k]
+            rev[i] = not rev[i]
+            pos[i] = k
+        return True
+
+    def or_opt(k, length):
+        # move tour[k:k+length] between the closest other paths
+        first = s(k)
+        last = e(k+length-1)
+        gain = (d(e(k-1), first) + d(last, s(k+length))
+                - d(e(k-1), s(k+length)))
+        best = None
+        for end in (first, last):
+            for other in _neighbors(end):
+                m, is_exit = place(other)
+                p = m if is_exit else m-1  # insert after p
+                if k-1 <= p < k+length:
+                    continue
+                a = e(p)
+                b = s(p+1)
+                fwd = d(a, first) + d(last, b) - d(a, b)
+                bwd = d(a, last) + d(first, b) - d(a, b)
+                change = min(fwd, bwd) - gain
+                if change < -1e-9 and (best is None or change < best[0]):
+                    best = (change, p, bwd < fwd)
+        if best is None:
+            return False
+        change, p, backwards = best
+        run = tour[k:k+length]
+        if backwards:
+            run.reverse()
+            for i in run:
+                rev[i] = not rev[i]
+        if p < k:
+            tour[p+1:k+length] = run + tour[p+1:k]
+            changed = range(p+1, k+length)
+        else:
+            tour[k:p+1] = tour[k+length:p+1] + run
+            changed = range(k, p+1)
+        for m in changed:
+            pos[tour[m]] = m
+        return True
+
+    improved = True
+    while improved and time.time() < deadline:
+        improved = False
+        for i in range(n):
+            if progress and i % PROGRESS_PATHS == 0:
+                progress(min(1.0 - (deadline - time.time())/time_budget, 1.0))
+            if time.time() > deadline:
+                break
+            for end in (2*i, 2*i+1):
+                m, is_exit = place(end)
+                for other in _neighbors(end):
+                    m2, is_exit2 = place(other)
+                    if is_exit != is_exit2 or m == m2:
+                        continue
+                    if is_exit:
+                        a, b = min(m, m2), max(m, m2)
+                    else:
+                        a, b = min(m, m2)-1, max(m, m2)-1
+                    if two_opt(a, b):
+                        improved = True
+                        m, is_exit = place(end)
+            for length in range(1, OR_OPT_MAX+1):
+                if pos[i]+length <= n and or_opt(pos[i], length):
+                    improved = True
+
+    after = total()
+    if before > 0:
+        log.info("INFO: seek distance shortened by %d%%" % int(100*(before-after)/before))
+    improved_path = Polylines(dims)
+    for i in tour:
+        pathseg = path[i]
+        if rev[i]:
+            pathseg = reverse_vertices(pathseg, dims)
+        improved_path.append(pathseg)
+    return improved_path
+
+
+
+def seek_distance(path, start=[0.0, 0.0]):
+    """Return the total length of the seeks from start through all paths,
+    and the position after the last path."""
+    dims = path.dims
+    coords = path.coords
+    offsets = path.offsets
+    x, y = start[0], start[1]
+    dist = 0.0
+    for i in range(len(path)):
+        if offsets[i] == offsets[i+1]:
+            continue
+        first = offsets[i]
+        last = offsets[i+1] - dims
+        dist += math.hypot(coords[first]-x, coords[first+1]-y)
+        x, y = coords[last], coords[last+1]
+    return dist, [x, y]
+
+
+def optimize_passes(passes, boundarys, start=[0.0, 0.0], order_colors=False, tour_budget=0):
+    """
+    Orders the paths of a whole job to shorten the seeks between colors.
+
+    passes is the list of passes of the job, [{'colors':[..], ..}, ..],
+    in the order they are cut. boundarys maps each color to its
+    Polylines. Each color is sorted starting from where the previous
+    color ended, instead of from the origin. A color used in more than
+    one pass is sorted for its first use only.
+
+    With order_colors, the colors within a pass are reordered, always
+    continuing with the color that has a path end closest to the
+    current position. tour_budget is passed on to improve_tour.
+
+    Returns (passes, boundarys, seek_before, seek_after). The passes
+    and boundarys are new, the arguments are not modified.
+    """
+    seek_before = 0.0
+    pos = start
+    for pass_ in passes:
+        for color in pass_['colors']:
+            if color in boundarys:
+                dist, pos = seek_distance(boundarys[color], pos)
+                seek_before += dist
+
+    num_colors = len(set(color for pass_ in passes for color in pass_['colors'] if color in boundarys))
+    deadline = time.time() + tour_budget
+    sorted_boundarys = dict(boundarys)
+    done = set()
+    new_passes = []
+    seek_after = 0.0
+    pos = start
+    for pass_ in passes:
+        todo = [color for color in pass_['colors'] if color in boundarys]
+        colors = []
+        while todo:
+            if order_colors:
+                color = min(todo, key=lambda c: _closest_end(sorted_boundarys[c], pos, c in done))
+            else:
+                color = todo[0]
+            todo.remove(color)
+            colors.append(color)
+            if color not in done:
+                done.add(color)
+                path = sort_by_seektime(boundarys[color], pos)
+                if tour_budget > 0:
+                    # share the remaining time among the remaining colors
+                    budget = (deadline - time.time()) / (num_colors - len(done) + 1)
+                    path = improve_tour(path, budget, pos)
+                sorted_boundarys[color] = path
+            dist, pos = seek_distance(sorted_boundarys[color], pos)
+            seek_after += dist
+        # colors without paths stay at the end of the pass
+        colors.extend(color for color in pass_['colors'] if color not in boundarys)
+        new_pass = dict(pass_)
+        new_pass['colors'] = colors
+        new_passes.append(new_pass)
+
+    if seek_before > 0:
+        log.info("INFO: job seek distance %d -> %d mm" % (seek_before, seek_after))
+    return new_passes, sorted_boundarys, seek_before, seek_after
+
+
+def _closest_end(path, pos, fixed):
+    # squared distance from pos to where path can be started
+    # (only its first path, if the order is fixed already)
+    dims = path.dims
+    coords = path.coords
+    offsets = path.offsets
+    best = float('inf')
+    for i in range(len(path)):
+        if offsets[i] == offsets[i+1]:
+            continue
+        ends = (offsets[i],) if fixed else (offsets[i], offsets[i+1]-dims)
+        for k in ends:
+            d = (coords[k]-pos[0])**2 + (coords[k+1]-pos[1])**2
+            if d < best:
+                best = d
+        if fixed:
+            break
+    return best
+
+
+
+def optimize_all(boundarys, tolerance, progress=None, tour_budget=0):
+    """Optimize the paths of all colors.
+
+    tour_budget is the time in seconds that improve_tour may spend in
+    total. With 0, the paths are only sorted greedily.
+    """
     tolerance2 = tolerance**2
     epsilon2 = (0.1*tolerance)**2
-    for color in boundarys:
-        connect_segments(boundarys[color], epsilon2)
-        simplify_all(boundarys[color], tolerance2)
-        sort_by_seektime(boundarys[color])
+    deadline = time.time() + tour_budget
+    # each color is split into equal steps for the progress
+    steps = 4 if tour_budget > 0 else 3
+    def _step(i, k):
+        if not progress:
+            return None
+        start = (i + float(k)/steps) / len(boundarys)
+        return lambda fraction: progress('optimizing', start + fraction/steps/len(boundarys))
+    for i, color in enumerate(boundarys):
+        path = connect_segments(boundarys[color], epsilon2, _step(i, 0))
+        path = simplify_all(path, tolerance2, _step(i, 1))
+        path = sort_by_seektime(path, progress=_step(i, 2))
+        if tour_budget > 0:
+            # share the remaining time among the remaining colors
+            budget = (deadline - time.time()) / (len(boundarys) - i)
+            path = improve_tour(path, budget, progress=_step(i, 3))
+        boundarys[color] = path
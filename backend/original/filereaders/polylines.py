@@ -0,0 +1,165 @@
+"""
+Compact storage for many polylines.
+
+All vertices of all polylines are kept in one flat array of floats,
+[x0,y0, x1,y1, ...], and each polyline is a range in that array. A
+2D vertex takes 16 bytes this way, instead of more than 100 bytes as
+a [x,y] list.
+
+The readers produce and the optimizers consume Polylines. The legacy
+format of a path, [[x1,y1],[x2,y2],...], is only used for JSON
+(see tolist()).
+"""
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Per-call overhead makes slicing (and even more so numpy) slower
+# than a plain loop for the short paths typical of SVG files.
+NUMPY_MIN_VERTICES = 64
+SLICING_MIN_VERTICES = 16
+
+
+class Polylines:
+    """A list of polylines.
+
+    Usage:
+    paths = Polylines()
+    paths.append([x1,y1, x2,y2, ...])  # flat coordinates
+    for coords in paths:
+        ...
+    """
+
+    def __init__(self, dims=2):
+        # number of coordinates per vertex (2, or 3 with z)
+        self.dims = dims
+        # coordinates of all vertices
+        self.coords = array('d')
+        # polyline i is coords[offsets[i]:offsets[i+1]]
+        self.offsets = array('q', [0])
+
+    @classmethod
+    def from_list(cls, paths, dims=2):
+        """Build from the legacy format [[[x,y], [x,y], ...], ...]"""
+        polylines = cls(dims)
+        for path in paths:
+            polylines.append_vertices(path)
+        return polylines
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        """Return the flat coordinates of polyline i (a copy)"""
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('polyline index out of range')
+        return self.coords[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        coords = self.coords
+        offsets = self.offsets
+        for i in range(len(offsets) - 1):
+            yield coords[offsets[i]:offsets[i+1]]
+
+    def append(self, coords):
+        """Add a polyline given by its flat coordinates"""
+        self.coords.extend(coords)
+        self.offsets.append(len(self.coords))
+
+    def append_vertices(self, vertices):
+        """Add a polyline given as [[x,y], [x,y], ...]
+
+        Additional coordinates of a vertex (e.g. z with dims=2) are dropped.
+        """
+        coords = self.coords
+        dims = self.dims
+        for vertex in vertices:
+            coords.extend(vertex[:dims])
+        self.offsets.append(len(coords))
+
+    def extend_last(self, coords):
+        """Add vertices to the end of the last polyline"""
+        self.coords.extend(coords)
+        self.offsets[-1] = len(self.coords)
+
+    def num_vertices(self):
+        return len(self.coords) // self.dims
+
+    def first(self, i):
+        """First vertex of polyline i, as a list"""
+        start = self.offsets[i]
+        return self.coords[start:start+self.dims].tolist()
+
+    def last(self, i):
+        """Last vertex of polyline i, as a list"""
+        end = self.offsets[i+1]
+        return self.coords[end-self.dims:end].tolist()
+
+    def transform(self, mat):
+        """Apply the affine matrix [a,b,c,d,e,f] to x,y of all vertices"""
+        transform_coords(mat, self.coords, self.dims)
+
+    def bounds(self):
+        """Return [min_x, min_y, max_x, max_y], or None if empty"""
+        if not self.coords:
+            return None
+        xs = self.coords[0::self.dims]
+        ys = self.coords[1::self.dims]
+        return [min(xs), min(ys), max(xs), max(ys)]
+
+    def tolist(self):
+        """Convert to the legacy format [[[x,y], [x,y], ...], ...]"""
+        dims = self.dims
+        coords = self.coords.tolist()
+        offsets = self.offsets
+        paths = []
+        for i in range(len(offsets) - 1):
+            paths.append([coords[j:j+dims] for j in range(offsets[i], offsets[i+1], dims)])
+        return paths
+
+
+
+def transform_coords(mat, coords, dims=2):
+    """Apply the affine matrix [a,b,c,d,e,f] to flat coordinates in-place.
+
+    x' = a*x + c*y + e
+    y' = b*x + d*y + f
+    Any further coordinates (z) are left unchanged. coords must be an
+    array('d').
+    """
+    a, b, c, d, e, f = mat
+    if numpy is not None and len(coords) >= NUMPY_MIN_VERTICES*dims:
+        v = numpy.frombuffer(coords, dtype=numpy.float64).reshape(-1, dims)
+        xs = v[:,0].copy()
+        ys = v[:,1]
+        v[:,0] = a*xs + c*ys + e
+        v[:,1] = b*xs + d*ys + f
+        del v  # release the buffer, so coords can be resized again
+        return
+    if len(coords) < SLICING_MIN_VERTICES*dims:
+        for i in range(0, len(coords), dims):
+            x = coords[i]
+            y = coords[i+1]
+            coords[i] = a*x + c*y + e
+            coords[i+1] = b*x + d*y + f
+        return
+    xs = coords[0::dims]
+    ys = coords[1::dims]
+    coords[0::dims] = array('d', [a*x + c*y + e for x, y in zip(xs, ys)])
+    coords[1::dims] = array('d', [b*x + d*y + f for x, y in zip(xs, ys)])
+
+
+def reverse_vertices(coords, dims=2):
+    """Return flat coordinates with the order of the vertices reversed."""
+    n = len(coords)
+    rev = array('d', coords)
+    for k in range(dims):
+        rev[k::dims] = coords[n-dims+k::-dims]
+    return rev
@@ -4,6 +4,7 @@ __author__ = 'Stefan Hechenberger <stefan@nortd.com>'
 import re
 import math
 import logging
+from array import array
 
 log = logging.getLogger("svg_reader")
 
@@ -72,7 +73,7 @@ class SVGPathReader:
         cmdPrev = ''
         xPrevCp = 0
         yPrevCp = 0
-        subpath = []
+        subpath = array('d')
 
         while 1:
             cmd = _getNext(d, idx)
@@ -82,63 +83,63 @@ class SVGPathReader:
                 # start new subpath
                 if subpath:
                     node['paths'].append(subpath)
-                    subpath = []
+                    subpath = array('d')
                 while _nextIsNum(d, idx, 2):
                     # subsequent coords are treated
                     # the same as absolute lineto
                     x = _getNext(d, idx)
                     y = _getNext(d, idx)
-                    subpath.append([x, y])
+                    subpath.extend((x, y))
             elif cmd == 'm':  # moveto relative
                 # start new subpath
                 if subpath:
                     node['paths'].append(subpath)
-                    subpath = []
+                    subpath = array('d')
                 if cmdPrev == '':
                     # first treated absolute
                     x = _getNext(d, idx)
                     y = _getNext(d, idx)
-                    subpath.append([x, y])
+                    subpath.extend((x, y))
                 while _nextIsNum(d, idx, 2):
                     # subsequent coords are treated
                     # the same as relative lineto
                     x += _getNext(d, idx)
                     y += _getNext(d, idx)
-                    subpath.append([x, y])
+                    subpath.extend((x, y))
             elif cmd == 'Z' or cmd == 'z':  # closepath
                 # loop and finalize subpath
                 if subpath:
-                    subpath.append([subpath[0][0],subpath[0][1]])  # close
+                    subpath.extend((subpath[0],subpath[1]))  # close
                     node['paths'].append(subpath)
-                    x = subpath[-1][0]
-                    y = subpath[-1][1]
-                    subpath = []
+                    x = subpath[-2]
+                    y = subpath[-1]
+                    subpath = array('d')
             elif cmd == 'L':  # lineto absolute
                 while _nextIsNum(d, idx, 2):
                     x = _getNext(d, idx)
                     y = _getNext(d, idx)
-                    subpath.append([x, y])
+                    subpath.extend((x, y))
             elif cmd == 'l':  # lineto relative
                 while _nextIsNum(d, idx, 2):
                     x += _getNext(d, idx)
                     y += _getNext(d, idx)
-                    subpath.append([x, y])
+                    subpath.extend((x, y))
             elif cmd == 'H':  # lineto horizontal absolute
                 while _nextIsNum(d, idx, 1):
                     x = _getNext(d, idx)
-                    subpath.append([x, y])
+                    subpath.extend((x, y))
             elif cmd == 'h':  # lineto horizontal relative
                 while _nextIsNum(d, idx, 1):
                     x += _getNext(d, idx)
-                    subpath.append([x, y])
+                    subpath.extend((x, y))
             elif cmd == 'V':  # lineto vertical absolute
                 while _nextIsNum(d, idx, 1):
                     y = _getNext(d, idx)
-                    subpath.append([x, y])
+                    subpath.extend((x, y))
             elif cmd == 'v':  # lineto vertical realtive
                 while _nextIsNum(d, idx, 1):
                     y += _getNext(d, idx)
-                    subpath.append([x, y])
+                    subpath.extend((x, y))
             elif cmd == 'C':  # curveto cubic absolute
                 while _nextIsNum(d, idx, 6):
                     x2 = _getNext(d, idx)
@@ -147,9 +148,9 @@ class SVGPathReader:
                     y3 = _getNext(d, idx)
                     x4 = _getNext(d, idx)
                     y4 = _getNext(d, idx)
-                    subpath.append([x,y])
+                    subpath.extend((x,y))
                     self.addCubicBezier(subpath, x, y, x2, y2, x3, y3, x4, y4, 0)
-                    subpath.append([x4,y4])
+                    subpath.extend((x4,y4))
                     x = x4
                     y = y4
                     xPrevCp = x3
@@ -162,9 +163,9 @@ class SVGPathReader:
                     y3 = y + _getNext(d, idx)
                     x4 = x + _getNext(d, idx)
                     y4 = y + _getNext(d, idx)
-                    subpath.append([x,y])
+                    subpath.extend((x,y))
                     self.addCubicBezier(subpath, x, y, x2, y2, x3, y3, x4, y4, 0)
-                    subpath.append([x4,y4])
+                    subpath.extend((x4,y4))
                     x = x4
                     y = y4
                     xPrevCp = x3
@@ -181,9 +182,9 @@ class SVGPathReader:
                     y3 = _getNext(d, idx)
                     x4 = _getNext(d, idx)
                     y4 = _getNext(d, idx)
-                    subpath.append([x,y])
+                    subpath.extend((x,y))
                     self.addCubicBezier(subpath, x, y, x2, y2, x3, y3, x4, y4, 0)
-                    subpath.append([x4,y4])
+                    subpath.extend((x4,y4))
                     x = x4
                     y = y4
                     xPrevCp = x3
@@ -200,9 +201,9 @@ class SVGPathReader:
                     y3 = y + _getNext(d, idx)
                     x4 = x + _getNext(d, idx)
                     y4 = y + _getNext(d, idx)
-                    subpath.append([x,y])
+                    subpath.extend((x,y))
                     self.addCubicBezier(subpath, x, y, x2, y2, x3, y3, x4, y4, 0)
-                    subpath.append([x4,y4])
+                    subpath.extend((x4,y4))
                     x = x4
                     y = y4
                     xPrevCp = x3
@@ -213,9 +214,9 @@ class SVGPathReader:
                     y2 = _getNext(d, idx)
                     x3 = _getNext(d, idx)
                     y3 = _getNext(d, idx)
-                    subpath.append([x,y])
+                    subpath.extend((x,y))
                     self.addQuadraticBezier(subpath, x, y, x2, y2, x3, y3, 0)
-                    subpath.append([x3,y3])
+                    subpath.extend((x3,y3))
                     x = x3
                     y = y3
             elif cmd == 'q':  # curveto quadratic relative
@@ -224,9 +225,9 @@ class SVGPathReader:
                     y2 = y + _getNext(d, idx)
                     x3 = x + _getNext(d, idx)
                     y3 = y + _getNext(d, idx)
-                    subpath.append([x,y])
+                    subpath.extend((x,y))
                     self.addQuadraticBezier(subpath, x, y, x2, y2, x3, y3, 0)
-                    subpath.append([x3,y3])
+                    subpath.extend((x3,y3))
                     x = x3
                     y = y3
             elif cmd == 'T':  # curveto quadratic absolute shorthand
@@ -239,9 +240,9 @@ class SVGPathReader:
                         y2 = y
                     x3 = _getNext(d, idx)
                     y3 = _getNext(d, idx)
-                    subpath.append([x,y])
+                    subpath.extend((x,y))
                     self.addQuadraticBezier(subpath, x, y, x2, y2, x3, y3, 0)
-                    subpath.append([x3,y3])
+                    subpath.extend((x3,y3))
                     x = x3
                     y = y3
                     xPrevCp = x2
@@ -256,9 +257,9 @@ class SVGPathReader:
                         y2 = y
                     x3 = x + _getNext(d, idx)
                     y3 = y + _getNext(d, idx)
-                    subpath.append([x,y])
+                    subpath.extend((x,y))
                     self.addQuadraticBezier(subpath, x, y, x2, y2, x3, y3, 0)
-                    subpath.append([x3,y3])
+                    subpath.extend((x3,y3))
                     x = x3
                     y = y3
                     xPrevCp = x2
@@ -293,7 +294,7 @@ class SVGPathReader:
         # finalize subpath
         if subpath:
             node['paths'].append(subpath)
-            subpath = []
+            subpath = array('d')
 
 
 
@@ -305,77 +306,102 @@ class SVGPathReader:
         # is we want to have control over the deviation to the curve.
         # This mean we subdivide more and have more curve points in
         # curvy areas and less in flatter areas of the curve.
+        #
+        # Iterative version of the recursive subdivision: continue with
+        # the first half right away and keep the second half on a stack.
+        # The points are appended in the same order.
 
-        if level > 18:
-            # protect from deep recursion cases
-            # max 2**18 = 262144 segments
-            return
-        elif level == 0:
+        if level == 0:
             if (x1 == x2 and y1 == y2 and x2 == x3 and y2 == y3) or \
                (x2 == x3 and y2 == y3 and x3 == x4 and y3 == y4):
                 # the tolerance would never reached, but it's a straight line
-                #subpath.append([x1, y1]) # probably not needed
-                subpath.append([x4, y4])
+                #subpath.extend((x1, y1)) # probably not needed
+                subpath.extend((x4, y4))
                 return
 
-        # Calculate all the mid-points of the line segments
-        x12   = (x1 + x2) / 2.0
-        y12   = (y1 + y2) / 2.0
-        x23   = (x2 + x3) / 2.0
-        y23   = (y2 + y3) / 2.0
-        x34   = (x3 + x4) / 2.0
-        y34   = (y3 + y4) / 2.0
-        x123  = (x12 + x23) / 2.0
-        y123  = (y12 + y23) / 2.0
-        x234  = (x23 + x34) / 2.0
-        y234  = (y23 + y34) / 2.0
-        x1234 = (x123 + x234) / 2.0
-        y1234 = (y123 + y234) / 2.0
-
-        # Try to approximate the full cubic curve by a single straight line
-        dx = x4-x1
-        dy = y4-y1
-
-        d2 = abs(((x2 - x4) * dy - (y2 - y4) * dx))
-        d3 = abs(((x3 - x4) * dy - (y3 - y4) * dx))
-
-        if (d2+d3)**2 < 5.0 * self._tolerance2 * (dx*dx + dy*dy):
-            # added factor of 5.0 to match circle resolution
-            subpath.append([x1234, y1234])
-            return
-
-        # Continue subdivision
-        self.addCubicBezier(subpath, x1, y1, x12, y12, x123, y123, x1234, y1234, level+1)
-        self.addCubicBezier(subpath, x1234, y1234, x234, y234, x34, y34, x4, y4, level+1)
+        # added factor of 5.0 to match circle resolution
+        tolerance2 = 5.0 * self._tolerance2
+        extend = subpath.extend
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        while True:
+            # protect from deep subdivision cases
+            # max 2**18 = 262144 segments
+            if level <= 18:
+                # Try to approximate the full cubic curve by a single straight line
+                dx = x4-x1
+                dy = y4-y1
+                d2 = (x2 - x4) * dy - (y2 - y4) * dx
+                d3 = (x3 - x4) * dy - (y3 - y4) * dx
+                if d2 < 0: d2 = -d2
+                if d3 < 0: d3 = -d3
+
+                # Calculate all the mid-points of the line segments
+                # (*0.5 is exactly the same as /2.0, but faster)
+                x12   = (x1 + x2) * 0.5
+                y12   = (y1 + y2) * 0.5
+                x23   = (x2 + x3) * 0.5
+                y23   = (y2 + y3) * 0.5
+                x34   = (x3 + x4) * 0.5
+                y34   = (y3 + y4) * 0.5
+                x123  = (x12 + x23) * 0.5
+                y123  = (y12 + y23) * 0.5
+                x234  = (x23 + x34) * 0.5
+                y234  = (y23 + y34) * 0.5
+                x1234 = (x123 + x234) * 0.5
+                y1234 = (y123 + y234) * 0.5
+
+                if (d2+d3)*(d2+d3) >= tolerance2 * (dx*dx + dy*dy):
+                    # Continue subdivision
+                    level += 1
+                    push((x1234, y1234, x234, y234, x34, y34, x4, y4, level))
+                    x2 = x12; y2 = y12
+                    x3 = x123; y3 = y123
+                    x4 = x1234; y4 = y1234
+                    continue
+                extend((x1234, y1234))
+            if not stack:
+                return
+            x1, y1, x2, y2, x3, y3, x4, y4, level = pop()
 
 
 
     def addQuadraticBezier(self, subpath, x1, y1, x2, y2, x3, y3, level):
-        if level > 18:
-            # protect from deep recursion cases
+        # iterative subdivision, see addCubicBezier
+        # added factor of 5.0 to match circle resolution
+        tolerance2 = 5.0 * self._tolerance2
+        extend = subpath.extend
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        while True:
+            # protect from deep subdivision cases
             # max 2**18 = 262144 segments
-            return
-
-        # Calculate all the mid-points of the line segments
-        x12   = (x1 + x2) / 2.0
-        y12   = (y1 + y2) / 2.0
-        x23   = (x2 + x3) / 2.0
-        y23   = (y2 + y3) / 2.0
-        x123  = (x12 + x23) / 2.0
-        y123  = (y12 + y23) / 2.0
-
-        dx = x3-x1
-        dy = y3-y1
-        d = abs(((x2 - x3) * dy - (y2 - y3) * dx))
-
-        if d*d <= 5.0 * self._tolerance2 * (dx*dx + dy*dy):
-            # added factor of 5.0 to match circle resolution
-            subpath.append([x123, y123])
-            return
-
-        # Continue subdivision
-        self.addQuadraticBezier(subpath, x1, y1, x12, y12, x123, y123, level + 1)
-        self.addQuadraticBezier(subpath, x123, y123, x23, y23, x3, y3, level + 1)
+            if level <= 18:
+                # Calculate all the mid-points of the line segments
+                x12   = (x1 + x2) * 0.5
+                y12   = (y1 + y2) * 0.5
+                x23   = (x2 + x3) * 0.5
+                y23   = (y2 + y3) * 0.5
+                x123  = (x12 + x23) * 0.5
+                y123  = (y12 + y23) * 0.5
+
+                dx = x3-x1
+                dy = y3-y1
+                d = (x2 - x3) * dy - (y2 - y3) * dx
+
+                if d*d > tolerance2 * (dx*dx + dy*dy):
+                    # Continue subdivision
+                    level += 1
+                    push((x123, y123, x23, y23, x3, y3, level))
+                    x2 = x12; y2 = y12
+                    x3 = x123; y3 = y123
+                    continue
+                extend((x123, y123))
+            if not stack:
+                return
+            x1, y1, x2, y2, x3, y3, level = pop()
 
 
 
@@ -444,7 +470,7 @@ class SVGPathReader:
             c4 = _getVertex(t1 + 0.75*tRange)
             if _vertexDistanceSquared(c2, _vertexMiddle(c1,c3)) > tolerance2:
                 _recursiveArc(t1, tHalf, c1, c3, level+1, tolerance2)
-            subpath.append(c3)
+            subpath.extend(c3)
             if _vertexDistanceSquared(c4, _vertexMiddle(c3,c5)) > tolerance2:
                 _recursiveArc(tHalf, t2, c3, c5, level+1, tolerance2)
 
@@ -452,6 +478,6 @@ class SVGPathReader:
         t2Init = 1.0
         c1Init = _getVertex(t1Init)
         c5Init = _getVertex(t2Init)
-        subpath.append(c1Init)
+        subpath.extend(c1Init)
         _recursiveArc(t1Init, t2Init, c1Init, c5Init, 0, self._tolerance2)
-        subpath.append(c5Init)
+        subpath.extend(c5Init)
@@ -6,9 +6,9 @@ import math
 import logging
 
 from .webcolors import hex_to_rgb, rgb_to_hex
-from .utilities import matrixMult, matrixApply
-from .utilities import vertexScale, parseFloats, parseScalar
+from .utilities import matrixMult, parseFloats, parseScalar
 from .svg_tag_reader import SVGTagReader
+from .polylines import Polylines, transform_coords
 
 
 logging.basicConfig()
@@ -24,6 +24,10 @@ except ImportError:
     print(log.warn("Using non-C (slow) XML parser."))
     import xml.etree.ElementTree as ET
 
+# parse_stream: parser events (starts and ends of elements) between two
+# calls of the progress callback
+PROGRESS_EVENTS = 1000
+
 
 # SVG parser for the Lasersaur.
 # Converts SVG DOM to a flat collection of paths.
@@ -68,8 +72,8 @@ class SVGReader:
 
     def __init__(self, tolerance, target_size):
         # parsed path data, paths by color
-        # {'#ff0000': [[[x,y], [x,y], ...], [], ..], '#0000ff':[]}
-        # Each path is a list of vertices which is a list of two floats.
+        # {'#ff0000': Polylines, '#0000ff': Polylines}
+        # Each path is a flat array of floats [x,y, x,y, ...].
         self.boundarys = {}
 
         # the conversion factor to physical dimensions
@@ -106,8 +110,9 @@ class SVGReader:
         data and converts it to polylines of the requested tolerance.
 
         Path data is returned as paths by color:
-        {'#ff0000': [[path0, path1, ..], [path0, ..], ..]}
-        Each path is a list of vertices which is a list of two floats.
+        {'#ff0000': Polylines, '#0000ff': Polylines}
+        See polylines.py, Polylines.tolist() converts to lists of
+        vertices, [[path0, path1, ..], [path0, ..], ..].
 
         Determining Physical Dimensions
         -------------------------------
@@ -142,11 +147,6 @@ class SVGReader:
         self.px2mm = None
         self.boundarys = {}
 
-        vb_x = None
-        vb_y = None
-        vb_w = None
-        vb_h = None
-
         # parse xml
         svgRootElement = ET.fromstring(svgstring)
         tagName = self._tagReader._get_tag(svgRootElement)
@@ -155,6 +155,27 @@ class SVGReader:
             log.error("Invalid file, no 'svg' tag found.")
             return self.boundarys
 
+        # let the fun begin
+        # recursively parse children
+        # output will be in self.boundarys
+        node = self._root_node(svgRootElement.attrib, svgstring[0:400], force_dpi)
+        self.parse_children(svgRootElement, node)
+
+        return self._parse_results()
+
+
+    def _root_node(self, attrib, svghead, force_dpi):
+        """Set px2mm from the svg tag and return the root node.
+
+        attrib are the attributes of the svg tag, svghead is the
+        beginning of the file (to look for known originating apps).
+        See parse() for the strategy.
+        """
+        vb_x = None
+        vb_y = None
+        vb_w = None
+        vb_h = None
+
         # 1. Get px2mm from argument
         if force_dpi is not None:
             self.px2mm = 25.4/force_dpi
@@ -169,8 +190,8 @@ class SVGReader:
             unit = ''
 
             # get width, height, unit
-            width_str = svgRootElement.attrib.get('width')
-            height_str = svgRootElement.attrib.get('height')
+            width_str = attrib.get('width')
+            height_str = attrib.get('height')
             if width_str and height_str:
                 width, width_unit = parseScalar(width_str)
                 height, height_unit = parseScalar(height_str)
@@ -181,7 +202,7 @@ class SVGReader:
 
             # get viewBox
             # http://www.w3.org/TR/SVG11/coords.html#ViewBoxAttribute
-            vb = svgRootElement.attrib.get('viewBox')
+            vb = attrib.get('viewBox')
             if vb:
                 vb_x, vb_y, vb_w, vb_h = parseFloats(vb)
                 log.info("SVG viewBox (%s,%s,%s,%s)." % (vb_x, vb_y, vb_w, vb_h))
@@ -218,7 +239,6 @@ class SVGReader:
                     # no physical units in file
                     # we have to interpret user (px) units
                     # 3. For some apps we can make a good guess.
-                    svghead = svgstring[0:400]
                     if 'Inkscape' in svghead:
                         self.px2mm *= 25.4/90.0
                         log.info("SVG exported with Inkscape -> 90dpi.")
@@ -265,9 +285,6 @@ class SVGReader:
         else:
             ty = 0.0
 
-        # let the fun begin
-        # recursively parse children
-        # output will be in self.boundarys
         node = {
             'xformToWorld': [1,0,0,1,tx,ty],
             'display': 'visible',
@@ -279,8 +296,10 @@ class SVGReader:
             'stroke-opacity': 1.0,
             'opacity': 1.0
         }
-        self.parse_children(svgRootElement, node)
+        return node
+
 
+    def _parse_results(self):
         # build result dictionary
         parse_results = {'boundarys':self.boundarys, 'dpi':round(25.4/self.px2mm)}
         if self.lasertags:
@@ -296,48 +315,129 @@ class SVGReader:
             if self._tagReader.has_handler(child):
                 # 1. setup a new node
                 # and inherit from parent
-                node = {
-                    'paths': [],
-                    'xform': [1,0,0,1,0,0],
-                    'xformToWorld': parentNode['xformToWorld'],
-                    'display': parentNode.get('display'),
-                    'visibility': parentNode.get('visibility'),
-                    'fill': parentNode.get('fill'),
-                    'stroke': parentNode.get('stroke'),
-                    'color': parentNode.get('color'),
-                    'fill-opacity': parentNode.get('fill-opacity'),
-                    'stroke-opacity': parentNode.get('stroke-opacity'),
-                    'opacity': parentNode.get('opacity')
-                }
+                node = self._child_node(parentNode)
 
                 # 2. parse child
                 # with current attributes and transformation
                 self._tagReader.read_tag(child, node)
 
-                # 3. compile boundarys + conversions
-                for path in node['paths']:
-                    if path:  # skip if empty subpath
-                        # 3a.) convert to world coordinates and then to mm units
-                        for vert in path:
-                            # print isinstance(vert[0],float) and isinstance(vert[1],float)
-                            matrixApply(node['xformToWorld'], vert)
-                            vertexScale(vert, self.px2mm)
-                        # 3b.) sort output by color
-                        hexcolor = node['stroke']
-                        if hexcolor in self.boundarys:
-                            self.boundarys[hexcolor].append(path)
-                        else:
-                            self.boundarys[hexcolor] = [path]
-
-                # 4. any lasertags (cut settings)?
-                if 'lasertags' in node:
-                    self.lasertags.extend(node['lasertags'])
+                # 3. + 4. collect paths and lasertags
+                self._compile_node(node)
 
                 # recursive call
                 self.parse_children(child, node)
 
 
 
+    def parse_stream(self, svgfile, force_dpi=None, progress=None):
+        """Parse a SVG document from a file, element by element.
+
+        Same result as parse(svgfile.read(), force_dpi), but the
+        document is never completely in memory. Each tag is handled
+        as soon as it is read and then dropped, so memory use is
+        bounded by the largest element instead of the file size.
+
+        svgfile is a file name or a seekable file object. The optional
+        progress(fraction) callback is called with the share of the
+        file read so far.
+        """
+        if not hasattr(svgfile, 'read'):
+            with open(svgfile, 'rb') as f:
+                return self.parse_stream(f, force_dpi, progress)
+
+        self.px2mm = None
+        self.boundarys = {}
+
+        size = svgfile.seek(0, 2)
+        svgfile.seek(0)
+        svghead = svgfile.read(400)
+        svgfile.seek(0)
+        if isinstance(svghead, bytes):
+            svghead = svghead.decode('utf-8', 'replace')
+
+        # Stack of open elements, with their node or None if the
+        # element and everything in it is ignored (no tag handler).
+        elements = []
+        nodes = []
+        count = 0
+        for event, elem in ET.iterparse(svgfile, events=('start', 'end')):
+            count += 1
+            if progress and count % PROGRESS_EVENTS == 0 and size:
+                # the parser reads ahead, so this is a bit early
+                progress(min(float(svgfile.tell())/size, 1.0))
+            if event == 'start':
+                if not nodes:
+                    # the svg tag
+                    if self._tagReader._get_tag(elem) != 'svg':
+                        log.error("Invalid file, no 'svg' tag found.")
+                        return self.boundarys
+                    node = self._root_node(elem.attrib, svghead, force_dpi)
+                elif nodes[-1] is None or not self._tagReader.has_handler(elem):
+                    node = None
+                else:
+                    node = self._child_node(nodes[-1])
+                    if self._tagReader._get_tag(elem) == 'text':
+                        # text content is complete at the end tag
+                        self._tagReader.read_attribs(elem, node)
+                    else:
+                        self._tagReader.read_tag(elem, node)
+                        self._compile_node(node)
+                elements.append(elem)
+                nodes.append(node)
+            else:
+                node = nodes.pop()
+                elements.pop()
+                if node is not None and self._tagReader._get_tag(elem) == 'text':
+                    self._tagReader.find_cut_settings_tags(elem, node)
+                    self._compile_node(node)
+                # Release processed elements. A text tag looks at the
+                # text of its children, so keep those until its end.
+                if elements and self._tagReader._get_tag(elements[-1]) != 'text':
+                    del elements[-1][:]
+
+        return self._parse_results()
+
+
+
+    def _child_node(self, parentNode):
+        """New node, inheriting from the parent"""
+        return {
+            'paths': [],
+            'xform': [1,0,0,1,0,0],
+            'xformToWorld': parentNode['xformToWorld'],
+            'display': parentNode.get('display'),
+            'visibility': parentNode.get('visibility'),
+            'fill': parentNode.get('fill'),
+            'stroke': parentNode.get('stroke'),
+            'color': parentNode.get('color'),
+            'fill-opacity': parentNode.get('fill-opacity'),
+            'stroke-opacity': parentNode.get('stroke-opacity'),
+            'opacity': parentNode.get('opacity')
+        }
+
+
+    def _compile_node(self, node):
+        """Add the paths and lasertags of a parsed node to the results"""
+        # 3. compile boundarys + conversions
+        # world coordinates and then mm units, as one matrix
+        xformToMM = matrixMult([self.px2mm,0,0,self.px2mm,0,0], node['xformToWorld'])
+        for path in node['paths']:
+            if path:  # skip if empty subpath
+                # 3a.) convert to world coordinates in mm units
+                transform_coords(xformToMM, path)
+                # 3b.) sort output by color
+                hexcolor = node['stroke']
+                if hexcolor not in self.boundarys:
+                    self.boundarys[hexcolor] = Polylines()
+                self.boundarys[hexcolor].append(path)
+        node['paths'] = []
+
+        # 4. any lasertags (cut settings)?
+        if 'lasertags' in node:
+            self.lasertags.extend(node['lasertags'])
+
+
+
 
 
 if __name__ == "__main__":
@@ -58,12 +58,7 @@ class SVGTagReader:
         tagName = self._get_tag(tag)
         if tagName in self._handlers:
             # log.debug("reading tag: " + tagName)
-            # parse own attributes and overwrite in node
-            for attr,value in list(tag.attrib.items()):
-                # log.debug("considering attrib: " + attr)
-                self._attribReader.read_attrib(node, attr, value)
-            # accumulate transformations
-            node['xformToWorld'] = matrixMult(node['xformToWorld'], node['xform'])
+            self.read_attribs(tag, node)
             # read tag
             if (tagName != 'text'):
                 self._handlers[tagName](node)
@@ -71,6 +66,16 @@ class SVGTagReader:
                 self.find_cut_settings_tags(tag, node)
 
 
+    def read_attribs(self, tag, node):
+        """Read the attributes of a tag into node (part of read_tag)."""
+        # parse own attributes and overwrite in node
+        for attr,value in list(tag.attrib.items()):
+            # log.debug("considering attrib: " + attr)
+            self._attribReader.read_attrib(node, attr, value)
+        # accumulate transformations
+        node['xformToWorld'] = matrixMult(node['xformToWorld'], node['xform'])
+
+
     def has_handler(self, tag):
         tagName = self._get_tag(tag)
         return bool(tagName in self._handlers)
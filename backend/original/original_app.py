@@ -3,13 +3,17 @@ import sys, os, time
 import glob, json, argparse, copy
 import tempfile
 import socket, webbrowser
+import uuid
+import multiprocessing
+import concurrent.futures
 
 import tornado
 import tornado.wsgi
 import tornado.httpserver
 
 from bottle import *
-from filereaders import read_svg, read_dxf, read_ngc
+from filereaders import read_svg, read_dxf, read_ngc, to_json_results, optimize_job
+import parse_cache
 
 
 APPNAME = "lasaurapp"
@@ -17,6 +21,8 @@ VERSION = "17.05 (pulseraster branch)"
 COMPANY_NAME = "com.nortd.labs"
 # COOKIE_KEY = 'secret_key_jkn23489hsdf'
 TOLERANCE = 0.08
+PARSE_CACHE_MAX_BYTES = 64*1024*1024
+MAX_TOUR_BUDGET = 60  # seconds, see file_reader_args()
 
 
 def resources_dir():
@@ -264,9 +270,42 @@ def download(filename, dlname):
     print("requesting: " + filename)
     return static_file(filename, root=tempfile.gettempdir(), download=dlname)
 
-@route('/file_reader', method='POST')
-def file_reader():
-    """Parse SVG string."""
+def parse_file(filename, filedata, dimensions, dpi_forced, optimize, tour_budget=0, progress=None):
+    """Parse an uploaded file
+
+    filedata is the file content as a string, or a binary file object.
+    SVG files are parsed from the file object incrementally.
+    """
+    filetype = filename[-4:].lower()
+    if filetype not in ['.dxf', '.svg', '.ngc']:
+        raise ValueError("unsupported file format")
+
+    cache = parse_cache.ParseCache(os.path.join(storage_dir(), 'parse_cache'),
+                                   PARSE_CACHE_MAX_BYTES)
+    key = parse_cache.cache_key(filetype, filedata, TOLERANCE, dpi_forced, dimensions,
+                                optimize, tour_budget)
+    res = cache.get(key)
+    if res is not None:
+        print("using cached parse result")
+        return res
+
+    if hasattr(filedata, 'read') and filetype != '.svg':
+        filedata = filedata.read().decode('utf-8')
+    if filetype == '.dxf':
+        res = read_dxf(filedata, TOLERANCE, optimize, progress, tour_budget)
+    elif filetype == '.svg':
+        res = read_svg(filedata, dimensions, TOLERANCE, dpi_forced, optimize, progress, tour_budget)
+    else:
+        res = read_ngc(filedata, TOLERANCE, optimize, progress)
+    try:
+        cache.put(key, res)
+    except (IOError, OSError) as e:
+        print("warning: could not write parse cache: %s" % e)
+    return res
+
+
+def file_reader_args():
+    """Get the parse_file() arguments from the POST request, or None"""
     filename = request.forms.get('filename')
     filedata = request.forms.get('filedata')
     dimensions = request.forms.get('dimensions')
@@ -289,24 +328,183 @@ def file_reader():
     except:
         pass
 
+    # seconds spent on shortening the seek moves, 0: greedy sort only
+    tour_budget = 0
+    try:
+        tour_budget = min(max(float(request.forms.get('tour_budget')), 0), MAX_TOUR_BUDGET)
+    except:
+        pass
+
     if filename and filedata:
         print("You uploaded %s (%d bytes)." % (filename, len(filedata)))
-        if filename[-4:] in ['.dxf', '.DXF']:
-            res = read_dxf(filedata, TOLERANCE, optimize)
-        elif filename[-4:] in ['.svg', '.SVG']:
-            res = read_svg(filedata, dimensions, TOLERANCE, dpi_forced, optimize)
-        elif filename[-4:] in ['.ngc', '.NGC']:
-            res = read_ngc(filedata, TOLERANCE, optimize)
-        else:
-            print("error: unsupported file format")
+        return (filename, filedata, dimensions, dpi_forced, optimize, tour_budget)
+    return None
+
 
+@route('/file_reader', method='POST')
+def file_reader():
+    """Parse SVG string (blocks the server, see /file_reader/start)."""
+    args = file_reader_args()
+    if args:
+        res = parse_file(*args)
         # print boundarys
-        jsondata = json.dumps(res)
+        jsondata = json.dumps(to_json_results(res))
         # print "returning %d items as %d bytes." % (len(res['boundarys']), len(jsondata))
         return jsondata
     return "You missed a field."
 
 
+### IMPORT JOBS
+# Parsing a large file can take minutes. Import jobs run in a worker
+# process and the client polls for the result, so this server stays
+# responsive in the meantime.
+
+import_executor = None
+import_shared = None  # progress and cancel flags, shared with the worker
+import_jobs = {}  # job id -> {'future', 'started', 'cancelled', 'spool'}
+IMPORT_JOB_EXPIRY = 600  # seconds until an unfetched job is dropped
+
+
+class ImportCancelled(Exception):
+    pass
+
+
+def spool_upload(filedata):
+    """Write the uploaded file to a temporary file, return its name.
+
+    The worker reads the file from there instead of getting a copy of
+    the (possibly huge) string.
+    """
+    fd, spool = tempfile.mkstemp(prefix='lasaur_import_')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(filedata)
+    return spool
+
+
+def import_worker(job_id, shared, args):
+    """Runs in the worker process."""
+    def progress(stage, fraction):
+        if shared.get((job_id, 'cancel')):
+            raise ImportCancelled()
+        shared[(job_id, 'progress')] = (stage, fraction)
+    filename, spool = args[:2]
+    try:
+        with open(spool, 'rb') as f:
+            return parse_file(filename, f, *args[2:], progress=progress)
+    finally:
+        os.remove(spool)
+
+
+def forget_import_job(job_id):
+    del import_jobs[job_id]
+    import_shared.pop((job_id, 'progress'), None)
+    import_shared.pop((job_id, 'cancel'), None)
+
+
+@route('/file_reader/start', method='POST')
+def file_reader_start():
+    """Start parsing in the background, return the job id."""
+    global import_executor, import_shared
+    args = file_reader_args()
+    if not args:
+        return "You missed a field."
+
+    now = time.time()
+    for job_id, job in list(import_jobs.items()):
+        if job['future'].done() and job['started'] < now - IMPORT_JOB_EXPIRY:
+            forget_import_job(job_id)
+
+    if import_executor is None:
+        import_executor = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+        import_shared = multiprocessing.Manager().dict()
+    spool = spool_upload(args[1])
+    args = (args[0], spool) + args[2:]
+    job_id = uuid.uuid4().hex
+    import_jobs[job_id] = {
+        'future': import_executor.submit(import_worker, job_id, import_shared, args),
+        'started': now,
+        'cancelled': False,
+        'spool': spool,
+    }
+    return json.dumps({'job': job_id})
+
+
+@route('/file_reader/status/:job_id')
+def file_reader_status(job_id):
+    """Report progress; includes the parse result once done."""
+    job = import_jobs.get(job_id)
+    if job is None:
+        return json.dumps({'status': 'unknown'})
+    future = job['future']
+    stage, fraction = import_shared.get((job_id, 'progress'), ('queued', 0.0))
+    status = {
+        'stage': stage,
+        'progress': fraction,
+        'elapsed': round(time.time() - job['started'], 1),
+    }
+    if job['cancelled']:
+        status['status'] = 'cancelled'
+        if future.done():
+            forget_import_job(job_id)
+    elif not future.done():
+        status['status'] = 'running' if future.running() else 'pending'
+    else:
+        forget_import_job(job_id)
+        try:
+            status['result'] = to_json_results(future.result())
+            status['status'] = 'done'
+        except Exception as e:
+            print("error: import failed: %r" % e)
+            status['status'] = 'failed'
+            status['error'] = str(e)
+    return json.dumps(status)
+
+
+@route('/file_reader/cancel/:job_id')
+def file_reader_cancel(job_id):
+    job = import_jobs.get(job_id)
+    if job is None:
+        return '0'
+    job['cancelled'] = True
+    if job['future'].cancel():
+        # never started, so the worker does not remove the file
+        os.remove(job['spool'])
+    else:
+        # already running, the worker stops at its next progress report
+        import_shared[(job_id, 'cancel')] = True
+    return '1'
+
+
+@route('/optimize_job', method='POST')
+def optimize_job_handler():
+    """Order the paths of a job across its passes to shorten the seeks.
+
+    Takes the job (job_data) in the format of /queue/save. Optional:
+    order_colors=1 to reorder the colors within a pass, tour_budget
+    (see file_reader_args). Returns the job with 'seek_before' and
+    'seek_after' (mm) added.
+    """
+    job_data = request.forms.get('job_data')
+    if not job_data:
+        return "You missed a field."
+    job = json.loads(job_data)
+    order_colors = False
+    try:
+        order_colors = bool(int(request.forms.get('order_colors')))
+    except:
+        pass
+    tour_budget = 0
+    try:
+        tour_budget = min(max(float(request.forms.get('tour_budget')), 0), MAX_TOUR_BUDGET)
+    except:
+        pass
+    job, seek_before, seek_after = optimize_job(job, order_colors, tour_budget)
+    print("job seek distance: %.0f mm -> %.0f mm" % (seek_before, seek_after))
+    job['seek_before'] = seek_before
+    job['seek_after'] = seek_after
+    return json.dumps(job)
+
+
 
 # def check_user_credentials(username, password):
 #     return username in allowed and allowed[username] == password
@@ -0,0 +1,170 @@
+"""On-disk cache for file_reader results
+
+Parsing and optimizing a large SVG or DXF file takes seconds, and the
+same file is often uploaded again (e.g. after changing pass settings).
+Results are stored by a hash of the file content and all parse options.
+
+The geometry is stored as the arrays of the Polylines (see
+filereaders/polylines.py):
+
+    magic       4 bytes, b'LPC2'
+    length      uint32, size of the JSON header
+    header      JSON: {'results': <all keys except boundarys>,
+                       'colors': [[color, dims, num_paths, num_coords], ...]}
+    arrays      for each color: int64 offsets (num_paths+1 values),
+                then float64 coords (num_coords values)
+
+The least recently used entries are deleted when the cache grows
+beyond its size limit.
+"""
+
+import os
+import sys
+import json
+import struct
+import hashlib
+import tempfile
+from array import array
+
+from filereaders import Polylines
+
+
+MAGIC = b'LPC2'
+LENGTH = struct.Struct('<I')
+
+# part of the cache key, increase it whenever a change to the readers or
+# optimizers gives different results for the same file and options (e.g.
+# how path segments are joined), so that old entries are not used
+PARSER_VERSION = 1
+
+
+def cache_key(filetype, filedata, tolerance, dpi, dimensions, optimize, tour_budget=0):
+    """Hash of the file content and everything that affects the result.
+
+    This includes PARSER_VERSION.
+
+    filedata is a string, bytes, or a binary file object (which is
+    rewound afterwards).
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps([PARSER_VERSION, filetype, tolerance, dpi, dimensions, optimize,
+                         tour_budget]).encode('utf-8'))
+    if hasattr(filedata, 'read'):
+        for chunk in iter(lambda: filedata.read(65536), b''):
+            h.update(chunk)
+        filedata.seek(0)
+    else:
+        if isinstance(filedata, str):
+            filedata = filedata.encode('utf-8')
+        h.update(filedata)
+    return h.hexdigest()
+
+
+def _tobytes(a):
+    if sys.byteorder != 'little':
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+
+def _frombytes(typecode, data):
+    a = array(typecode)
+    a.frombytes(data)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a
+
+
+def dumps(res):
+    colors = []
+    chunks = []
+    for color, paths in res['boundarys'].items():
+        colors.append([color, paths.dims, len(paths), len(paths.coords)])
+        chunks.append(_tobytes(paths.offsets))
+        chunks.append(_tobytes(paths.coords))
+    results = dict((k, v) for k, v in res.items() if k != 'boundarys')
+    header = json.dumps({'results': results, 'colors': colors}).encode('utf-8')
+    return b''.join([MAGIC, LENGTH.pack(len(header)), header] + chunks)
+
+
+def loads(data):
+    if data[:4] != MAGIC:
+        raise ValueError('not a parse cache file')
+    length, = LENGTH.unpack_from(data, 4)
+    pos = 4 + LENGTH.size
+    header = json.loads(data[pos:pos+length].decode('utf-8'))
+    pos += length
+
+    boundarys = {}
+    for color, dims, num_paths, num_coords in header['colors']:
+        paths = Polylines(dims)
+        end = pos + 8*(num_paths+1)
+        paths.offsets = _frombytes('q', data[pos:end])
+        pos = end
+        end = pos + 8*num_coords
+        paths.coords = _frombytes('d', data[pos:end])
+        pos = end
+        boundarys[color] = paths
+    if pos != len(data):
+        raise ValueError('truncated parse cache file')
+    res = header['results']
+    res['boundarys'] = boundarys
+    return res
+
+
+class ParseCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + '.lpc')
+
+    def get(self, key):
+        """Return the cached result, or None."""
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                res = loads(f.read())
+            os.utime(filename, None)  # mark as recently used
+        except (IOError, OSError, ValueError):
+            # also if the entry was evicted meanwhile
+            return None
+        return res
+
+    def put(self, key, res):
+        data = dumps(res)
+        if len(data) > self.max_bytes:
+            return
+        # write atomically, an import worker may be reading at the same time
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmpname, self._filename(key))
+        self.evict()
+
+    def evict(self):
+        """Delete the least recently used entries until below max_bytes."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.lpc'):
+                continue
+            filename = os.path.join(self.directory, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, filename in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
@@ -21,7 +21,6 @@ argparser.add_argument('-o', '--optimize', dest='optimize', action='store_true',
                     default=False, help='optimize by loading c extensions')
 argparser.add_argument('-d', '--debug', dest='debug', action='store_true',
                     default=False, help='verbose debug info')
-args = argparser.parse_args()
 
 
 thislocation = os.path.dirname(os.path.realpath(__file__))
@@ -36,14 +35,16 @@ def main():
     boundarys = read_svg(svgstring, [1220,610], 0.08)
 
 
-if args.profile:
-    profile.run("main()", 'profile.tmp')
-    p = pstats.Stats('profile.tmp')
-    p.sort_stats('cumulative').print_stats(30)
-    os.remove('profile.tmp')
-elif args.timeit:
-    t = timeit.Timer("main()", "from __main__ import main")
-    print(t.timeit(1))
-    # print t.timeit(3)
-else:
-    main()
+if __name__ == '__main__':
+    args = argparser.parse_args()
+    if args.profile:
+        profile.run("main()", 'profile.tmp')
+        p = pstats.Stats('profile.tmp')
+        p.sort_stats('cumulative').print_stats(30)
+        os.remove('profile.tmp')
+    elif args.timeit:
+        t = timeit.Timer("main()", "from __main__ import main")
+        print(t.timeit(1))
+        # print t.timeit(3)
+    else:
+        main()
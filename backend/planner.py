@@ -0,0 +1,379 @@
+"""Execution time model of the firmware planner
+
+The backend knows which moves it queued, and (from the
+CMD_CHUNK_PROCESSED acknowledgements) how many bytes the firmware has
+taken from its serial buffer. To report job progress in execution time
+instead of bytes, this module replays the acceleration planning of
+firmware/src/planner.c: trapezoidal speed profiles with
+driveboard.ACCELERATION, junction speeds limited by
+driveboard.JUNCTION_DEVIATION, and a lookahead of
+driveboard.PLANNER_BLOCKS moves, the newest of which is planned to
+come to a stop.
+
+Usage:
+model = PlannerModel()
+model.queue_move(x, y, z, feedrate, byte_end)  # for every move, in order
+...
+model.update(bytes_processed, idle)  # for every firmware status
+done, total = model.progress()  # seconds
+
+queue_move() only records the move, it is planned in batches (by
+update(), or every PLAN_BATCH moves). add_move() plans it right away,
+as needed by the firmware simulation.
+"""
+import math
+import time
+from array import array
+from bisect import bisect_right
+
+import driveboard
+
+# queued moves are planned at the latest when this many are waiting
+PLAN_BATCH = 4096
+
+
+def move_time(millimeters, entry_speed, exit_speed, nominal_speed):
+    """Seconds for a move with a trapezoidal speed profile
+
+    Speeds are in mm/min. The entry and exit speeds must be reachable
+    within the move (as ensured by the planner).
+    """
+    acc = driveboard.ACCELERATION
+    accelerate = (nominal_speed**2 - entry_speed**2) / (2*acc)
+    decelerate = (nominal_speed**2 - exit_speed**2) / (2*acc)
+    plateau = millimeters - accelerate - decelerate
+    if plateau >= 0:
+        minutes = ((nominal_speed - entry_speed) / acc
+                   + (nominal_speed - exit_speed) / acc
+                   + plateau / nominal_speed)
+    else:
+        # the nominal speed is never reached
+        peak = math.sqrt((2*acc*millimeters + entry_speed**2 + exit_speed**2) / 2)
+        minutes = (peak - entry_speed) / acc + (peak - exit_speed) / acc
+    return 60*minutes
+
+
+class PlannerModel:
+    def __init__(self):
+        self.position = [0.0, 0.0, 0.0]
+        self.relative = False  # targets are offsets (G91)
+        # called with (byte_end, seconds) for every planned move
+        self.on_planned = None
+        # (x, y, z, feedrate, byte_end) from queue_move(), not added yet
+        self.queued = []
+        self.reset()
+
+    def reset(self):
+        """Forget all queued moves (e.g. after a stop)"""
+        del self.queued[:]
+        # for the junction speed, see planner_line() in planner.c
+        self.previous_unit_vec = None
+        self.previous_nominal_speed = 0.0
+        # newest moves, not planned yet: (millimeters, nominal_speed,
+        # junction2, byte_end, can_stop, stop2), see plan_queued(). The
+        # planning works with squared speeds (junction2: of the junction
+        # speed, stop2: of the entry speed if it is the newest move).
+        self.lookahead = []
+        self.entry_speed = 0.0  # of lookahead[0]
+        # planned moves: firmware buffer position after the move, and
+        # the job time (seconds) at its end
+        self.byte_ends = array('q')
+        self.time_ends = array('d')
+        self.first = 0  # older entries are not needed any more
+        self.planned_time = 0.0
+        # from the last update(), see progress()
+        self.done = 0.0
+        self.done_at = None
+        self.latest = 0.0
+        self.total = 0.0
+        self.idle = True
+        self.job_complete = False
+
+    def discard(self):
+        """Forget the moves that are not planned yet
+
+        The firmware clears its block buffer on a stop.
+        """
+        self.plan_queued()  # for the position
+        self.lookahead = []
+        self.entry_speed = 0.0
+        self.previous_unit_vec = None
+
+    def plan_next(self):
+        """Plan the oldest move now (the firmware starts executing it)"""
+        self.plan_queued()
+        if self.lookahead:
+            self._plan_oldest()
+
+    def finish(self):
+        """Plan all remaining moves, the last one comes to a stop"""
+        self.plan_queued()
+        self._plan_oldest(len(self.lookahead))
+        self.previous_unit_vec = None
+
+    def set_position(self, x, y, z):
+        self.plan_queued()
+        self.position = [x, y, z]
+        self.previous_unit_vec = None
+
+    def set_relative(self, relative):
+        """Targets are offsets (G91) or absolute (G90) from now on"""
+        self.plan_queued()
+        self.relative = relative
+
+    def queue_move(self, x, y, z, feedrate, byte_end):
+        """Same as add_move(), but the move is planned later
+
+        This is called for every line of a job (see bench_gcode.py),
+        the planning waits for the next update().
+        """
+        queued = self.queued
+        queued.append((x, y, z, feedrate, byte_end))
+        if len(queued) >= PLAN_BATCH:
+            self.plan_queued()
+
+    def add_move(self, x, y, z, feedrate, byte_end):
+        """A move to x, y, z (None: axis unchanged) with feedrate (mm/min)
+
+        byte_end is the firmware buffer position after the move, see
+        Driveboard.fwbuf_bytes_queued. Returns False if the move is
+        ignored (no motion).
+        """
+        self.queued.append((x, y, z, feedrate, byte_end))
+        return self.plan_queued() > 0
+
+    def plan_queued(self):
+        """Add the queued moves to the lookahead, return how many moved"""
+        if not self.queued:
+            return 0
+        moves = self.queued
+        self.queued = []
+        if self.job_complete:
+            # the firmware was idle, start timing a new job
+            position = self.position
+            self.reset()
+            self.position = position
+        # all in local variables, this runs for every move
+        acc2 = 2*driveboard.ACCELERATION
+        junction_acc = driveboard.ACCELERATION * driveboard.JUNCTION_DEVIATION
+        blocks = driveboard.PLANNER_BLOCKS
+        sqrt = math.sqrt
+        relative = self.relative
+        lookahead = self.lookahead
+        append = lookahead.append
+        added = len(lookahead)
+        px, py, pz = self.position
+        previous = self.previous_unit_vec
+        if previous is not None:
+            qx, qy, qz = previous
+        previous_speed = self.previous_nominal_speed
+        for x, y, z, feedrate, byte_end in moves:
+            if relative:
+                tx = px + (x or 0.0)
+                ty = py + (y or 0.0)
+                tz = pz + (z or 0.0)
+            else:
+                tx = px if x is None else x
+                ty = py if y is None else y
+                tz = pz if z is None else z
+            dx = tx - px
+            dy = ty - py
+            dz = tz - pz
+            px = tx
+            py = ty
+            pz = tz
+            millimeters = sqrt(dx*dx + dy*dy + dz*dz)
+            if millimeters < 1e-6 or feedrate <= 0:
+                continue  # the firmware ignores zero-length moves
+
+            ux = dx/millimeters
+            uy = dy/millimeters
+            uz = dz/millimeters
+            junction2 = 0.0
+            if previous is not None and previous_speed > 0.0:
+                cos_theta = - qx*ux - qy*uy - qz*uz
+                if cos_theta < 0.95:
+                    # (min() written out)
+                    junction2 = feedrate*feedrate if feedrate < previous_speed else previous_speed*previous_speed
+                    if cos_theta > -0.95:
+                        sin_theta_d2 = sqrt(0.5*(1.0 - cos_theta))
+                        limit2 = junction_acc * sin_theta_d2 / (1.0 - sin_theta_d2)
+                        if limit2 < junction2:
+                            junction2 = limit2
+            previous = True
+            qx = ux
+            qy = uy
+            qz = uz
+            previous_speed = feedrate
+
+            # whether the move can decelerate from its junction speed to a
+            # standstill, then its entry speed does not depend on later moves
+            stop2 = acc2*millimeters
+            can_stop = junction2 <= stop2
+            # (min() written out)
+            append((millimeters, feedrate, junction2, byte_end, can_stop,
+                    junction2 if can_stop else stop2))
+        added = len(lookahead) - added
+        self.position = [px, py, pz]
+        if previous is not None:
+            self.previous_unit_vec = (qx, qy, qz)
+        self.previous_nominal_speed = previous_speed
+        # the firmware executes the oldest move while the others are in
+        # its buffer
+        if len(lookahead) >= blocks:
+            self._plan_oldest(len(lookahead) - blocks + 1)
+        return added
+
+    def _plan_oldest(self, count=1):
+        """Plan the count oldest moves of the lookahead
+
+        Each one with the (at most PLANNER_BLOCKS-1) moves after it, as
+        they are in the firmware buffer when it starts executing.
+        """
+        # all in local variables, this runs for every move
+        acc = driveboard.ACCELERATION
+        acc2 = 2*acc
+        blocks = driveboard.PLANNER_BLOCKS
+        sqrt = math.sqrt
+        lookahead = self.lookahead
+        size = len(lookahead)
+        entry_speed = self.entry_speed
+        entry2 = entry_speed**2
+        planned_time = self.planned_time
+        byte_ends = self.byte_ends
+        time_ends = self.time_ends
+        on_planned = self.on_planned
+        planned = []
+        for first in range(count):
+            # reverse pass: the newest move must be able to stop, but the
+            # moves after one that can stop on its own do not matter
+            last = first + 1
+            if last == size:
+                next2 = 0.0
+            elif lookahead[last][4]:
+                next2 = lookahead[last][5]
+            else:
+                stop = first + blocks - 1 if first + blocks < size else size - 1
+                while last < stop and not lookahead[last][4]:
+                    last += 1
+                next2 = lookahead[last][5]
+                # (min() written out)
+                for i in range(last - 1, first, -1):
+                    move = lookahead[i]
+                    speed2 = next2 + acc2*move[0]
+                    next2 = speed2 if speed2 < move[2] else move[2]
+            # forward pass: the exit speed must be reachable from the entry speed
+            millimeters, nominal_speed, junction2, byte_end, can_stop, stop2 = lookahead[first]
+            exit2 = entry2 + acc2*millimeters
+            if next2 < exit2:
+                exit2 = next2
+            exit_speed = sqrt(exit2)
+            # move_time(), written out
+            nominal2 = nominal_speed**2
+            plateau = millimeters - (nominal2 - entry2) / acc2 - (nominal2 - exit2) / acc2
+            if plateau >= 0:
+                minutes = ((nominal_speed - entry_speed) / acc
+                           + (nominal_speed - exit_speed) / acc
+                           + plateau / nominal_speed)
+            else:
+                peak = sqrt((acc2*millimeters + entry2 + exit2) / 2)
+                minutes = (peak - entry_speed) / acc + (peak - exit_speed) / acc
+            planned_time += 60*minutes
+            entry_speed = exit_speed
+            entry2 = exit2
+            byte_ends.append(byte_end)
+            time_ends.append(planned_time)
+            if on_planned is not None:
+                planned.append((byte_end, 60*minutes))
+        del lookahead[:count]
+        self.entry_speed = entry_speed
+        self.planned_time = planned_time
+        for byte_end, seconds in planned:
+            on_planned(byte_end, seconds)
+
+    def _lookahead_ends(self):
+        # (byte_end, time_end) of the moves in the lookahead, as if no
+        # more moves follow
+        acc2 = 2*driveboard.ACCELERATION
+        lookahead = self.lookahead
+        entries = [0.0]*(len(lookahead)+1)
+        for i in range(len(lookahead)-1, 0, -1):
+            millimeters, nominal_speed, junction2, byte_end, can_stop, stop2 = lookahead[i]
+            entries[i] = math.sqrt(min(junction2, entries[i+1]**2 + acc2*millimeters))
+        entries[0] = self.entry_speed
+        ends = []
+        t = self.planned_time
+        for i, (millimeters, nominal_speed, junction2, byte_end, can_stop, stop2) in enumerate(lookahead):
+            entries[i+1] = min(entries[i+1], math.sqrt(entries[i]**2 + acc2*millimeters))
+            t += move_time(millimeters, entries[i], entries[i+1], nominal_speed)
+            ends.append((byte_end, t))
+        return ends
+
+    def update(self, bytes_processed, idle):
+        """A status from the firmware, plans the queued moves
+
+        bytes_processed is the number of bytes the firmware has taken
+        from its buffer (see Driveboard.fwbuf_bytes_processed). idle
+        means that the firmware has nothing left to do.
+        """
+        self.plan_queued()
+        lookahead_ends = self._lookahead_ends()
+        total = lookahead_ends[-1][1] if lookahead_ends else self.planned_time
+
+        # end times of the last moves that the firmware has read, up to
+        # PLANNER_BLOCKS of them may still be waiting in its planner
+        blocks = driveboard.PLANNER_BLOCKS
+        byte_ends = self.byte_ends
+        time_ends = self.time_ends
+        read = bisect_right(byte_ends, bytes_processed, self.first)
+        ends = time_ends[max(self.first, read - blocks - 1):read].tolist()
+        if read == len(byte_ends):
+            ends += [t for byte_end, t in lookahead_ends if byte_end <= bytes_processed]
+            ends = ends[-blocks-1:]
+        latest = ends[-1] if ends else 0.0
+        if idle:
+            # bytes_processed only advances per TX_CHUNK_SIZE bytes, the
+            # last partial chunk of a job is never acknowledged
+            if bytes_processed > self._last_byte_end() - driveboard.TX_CHUNK_SIZE:
+                done = total
+            else:
+                done = latest
+        else:
+            earliest = ends[0] if len(ends) > blocks else 0.0
+            # in between, advance with the clock
+            done = self.done
+            if self.done_at is not None:
+                done += time.time() - self.done_at
+            done = min(max(done, earliest), latest)
+        self.done = done
+        self.done_at = time.time()
+        self.latest = latest
+        self.total = total
+        self.idle = idle
+        if idle and done >= total:
+            self.job_complete = True
+
+        # drop entries that are not needed any more
+        self.first = max(self.first, read - blocks - 1)
+        if self.first > 4096 and 2*self.first > len(byte_ends):
+            del byte_ends[:self.first]
+            del time_ends[:self.first]
+            self.first = 0
+
+    def progress(self):
+        """Return (done, total), the executed and the total job time in seconds
+
+        As of the last update(), the executed time advances with the
+        clock until the firmware reads further moves.
+        """
+        done = self.done
+        if not self.idle and self.done_at is not None:
+            done = min(done + time.time() - self.done_at, self.latest)
+        return done, self.total
+
+    def _last_byte_end(self):
+        if self.lookahead:
+            return self.lookahead[-1][3]
+        if self.byte_ends:
+            return self.byte_ends[-1]
+        return 0
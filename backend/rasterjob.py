@@ -0,0 +1,156 @@
+"""Binary raster jobs
+
+A compact alternative to sending raster images as "G7 ... V1 D<base64>"
+gcode lines. The backend generates the same moves as the gcode produced
+by the raster frontend (makeGcode in rasterlib.service.js).
+
+Format (little-endian):
+
+    header (see HEADER below)
+        magic           4 bytes, b'LSR1'
+        width           uint32, pixels per line
+        height          uint32, number of lines
+        x0, y0          float64, position of the first pixel (mm)
+        pitch_x         float64, distance between pixels (mm)
+        pitch_y         float64, distance between lines (mm)
+        feedrate        float64, raster feedrate (mm/min)
+        travel_feedrate float64, seek feedrate between lines (mm/min)
+        lead_in         float64, acceleration distance before/after a line (mm)
+        flags           uint8, see FLAG_*
+    pixels
+        width * height bytes, pulse durations (0-127) line by line
+"""
+import struct
+
+import driveboard
+
+MAGIC = b'LSR1'
+HEADER = struct.Struct('<4sIIdddddddB')
+
+FLAG_BIDIRECTIONAL = 1  # reverse the direction after each line
+FLAG_SKIP_EMPTY = 2  # do not move over empty pixels at both ends of a line
+FLAG_START_REVERSED = 4  # first line goes from right to left
+
+
+class RasterJobError(Exception):
+    pass
+
+
+class RasterJob:
+    """Turns a streamed binary raster job into moves
+
+    Usage:
+    job = RasterJob(board)  # a gcode.DriveboardGcode
+    job.feed(chunk)
+    while job.process_line():
+        pass
+    job.finish()
+    """
+
+    def __init__(self, board):
+        self.board = board
+        self.buf = bytearray()
+        self.pos = 0  # start of the unprocessed data in buf
+        self.header = None
+        self.lineno = 0
+
+    def feed(self, data):
+        self.buf += data
+
+    def process_line(self):
+        """Execute the next raster line, if enough data has arrived
+
+        Returns False if more data is needed (or the job is complete).
+        """
+        if self.header is None:
+            if len(self.buf) < HEADER.size:
+                return False
+            self._parse_header()
+            self._check(self.board.gcode_line('S0'))
+
+        h = self.header
+        if self.lineno >= h['height']:
+            if len(self.buf) > self.pos:
+                raise RasterJobError('more pixel data than announced in the header')
+            return False
+        end = self.pos + h['width']
+        if len(self.buf) < end:
+            if self.pos > 0:
+                # drop processed lines
+                del self.buf[:self.pos]
+                self.pos = 0
+            return False
+        data = bytes(self.buf[self.pos:end])
+        self.pos = end
+
+        self._raster_line(data)
+        self.lineno += 1
+        return True
+
+    def finish(self):
+        """Check that the job was complete"""
+        if self.header is None:
+            raise RasterJobError('incomplete header')
+        if self.lineno < self.header['height']:
+            raise RasterJobError('got only %d of %d lines' % (self.lineno, self.header['height']))
+
+    def _parse_header(self):
+        (magic, width, height, x0, y0, pitch_x, pitch_y,
+         feedrate, travel_feedrate, lead_in, flags) = HEADER.unpack_from(self.buf)
+        if magic != MAGIC:
+            raise RasterJobError('not a raster job (wrong magic %r)' % magic)
+        if width == 0 or pitch_x <= 0 or pitch_y <= 0:
+            raise RasterJobError('invalid raster size or pitch')
+        if feedrate <= 0 or travel_feedrate <= 0:
+            raise RasterJobError('invalid feedrate')
+        self.header = dict(
+            width=width, height=height, x0=x0, y0=y0,
+            pitch_x=pitch_x, pitch_y=pitch_y,
+            feedrate=feedrate, travel_feedrate=travel_feedrate,
+            lead_in=lead_in, flags=flags)
+        self.direction = -1 if flags & FLAG_START_REVERSED else +1
+        self.pos = HEADER.size
+
+    def _check(self, resp):
+        if resp.startswith('error:'):
+            raise RasterJobError(resp[6:])
+
+    def _raster_line(self, data):
+        h = self.header
+        direction = self.direction
+        pitch_x = h['pitch_x']
+        feedrate = h['feedrate']
+        x = h['x0']
+        y = h['y0'] + self.lineno * h['pitch_y']
+
+        if h['flags'] & FLAG_SKIP_EMPTY:
+            stripped = data.lstrip(b'\0')
+            if not stripped:
+                return  # keeps the direction, like makeGcode
+            x += (len(data) - len(stripped)) * pitch_x
+            data = stripped.rstrip(b'\0')
+
+        if direction == -1:
+            # A raster move always starts with a pulse, and ends with no pulse.
+            #     0---1---2---3---|  forward
+            # |---0---1---2---3      backward
+            data = data[::-1]
+            x += (len(data) - 1) * pitch_x
+
+        self._check(self.board.seek(x - direction*h['lead_in'], y, h['travel_feedrate']))
+        self._check(self.board.seek(x, y, feedrate))
+
+        # split into chunks that fit into the firmware buffer
+        x_start = x
+        x_end = x + direction * len(data) * pitch_x
+        total = len(data)
+        for i in range(0, total, driveboard.RASTER_BYTES_MAX):
+            chunk = data[i:i+driveboard.RASTER_BYTES_MAX]
+            fac = (total - i - len(chunk)) / total
+            px = fac*x_start + (1-fac)*x_end
+            self._check(self.board.raster(px, y, feedrate, chunk))
+
+        self._check(self.board.seek(x_end + direction*h['lead_in'], y, feedrate))
+
+        if h['flags'] & FLAG_BIDIRECTIONAL:
+            self.direction = -direction
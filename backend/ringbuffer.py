@@ -0,0 +1,89 @@
+"""FIFO byte queue backed by a circular buffer
+
+Reading from the front does not move or copy the remaining bytes,
+unlike slicing a bytearray. The buffer grows (doubling its size) when
+more data is queued than fits.
+"""
+
+
+class RingBuffer:
+    def __init__(self, size=4096):
+        self.buf = bytearray(size)
+        self.start = 0  # index of the first queued byte
+        self.length = 0  # number of queued bytes
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length > 0
+
+    def clear(self):
+        self.start = 0
+        self.length = 0
+
+    def extend(self, data):
+        n = len(data)
+        if not n:
+            return
+        if self.length + n > len(self.buf):
+            self._grow(self.length + n)
+        size = len(self.buf)
+        end = self.start + self.length
+        if end >= size:
+            end -= size
+        first = min(n, size - end)
+        if first == n:
+            self.buf[end:end+n] = data
+        else:
+            data = memoryview(data)
+            self.buf[end:size] = data[:first]
+            self.buf[:n-first] = data[first:]
+        self.length += n
+
+    def read(self, n):
+        """Remove up to n bytes from the front and return them"""
+        n = min(n, self.length)
+        start = self.start
+        end = start + n
+        size = len(self.buf)
+        if end <= size:
+            out = bytes(self.buf[start:end])
+        else:
+            end -= size
+            out = bytes(self.buf[start:]) + bytes(self.buf[:end])
+        self.start = end if end < size else 0
+        self.length -= n
+        if not self.length:
+            self.start = 0
+        return out
+
+    def peek(self):
+        """Return a memoryview of the queued bytes at the front
+
+        The view covers only the contiguous part of the queue (up to the
+        end of the circular buffer). It is only valid until the queue is
+        modified, so release it before the next extend() or consume().
+        """
+        end = min(self.start + self.length, len(self.buf))
+        return memoryview(self.buf)[self.start:end]
+
+    def consume(self, n):
+        """Remove n bytes from the front (e.g. after writing a peek())"""
+        n = min(n, self.length)
+        self.length -= n
+        if self.length:
+            self.start = (self.start + n) % len(self.buf)
+        else:
+            self.start = 0
+
+    def _grow(self, needed):
+        size = len(self.buf)
+        while size < needed:
+            size *= 2
+        length = self.length
+        buf = bytearray(size)
+        buf[:length] = self.read(length)
+        self.buf = buf
+        self.start = 0
+        self.length = length
@@ -0,0 +1,542 @@
+#!/usr/bin/env python3
+"""Offline job simulation
+
+Runs a gcode job through DriveboardGcode and the real Driveboard
+protocol code, but instead of a serial port the bytes go to Firmware,
+a model of the firmware's serial and protocol handling (serial.c,
+protocol.c): bytes are checked for the doubled-byte transmission,
+buffered, parsed, and acknowledged with CMD_CHUNK_PROCESSED. Moves are
+timed with the planner model (see planner.py), much faster than real
+time.
+
+Usage:
+sim = Simulation()
+for line in lines:
+    sim.gcode_line(line)
+result = sim.result()
+
+Or from the command line: simulator.py job.gcode
+"""
+import re
+import math
+import json
+import logging
+import argparse
+
+import driveboard
+import gcode
+import planner
+from driveboard import (CMD_RESET_PROTOCOL, CMD_STOP, CMD_RESUME, CMD_STATUS,
+                        CMD_SUPERSTATUS, CMD_CHUNK_PROCESSED, STATUS_END)
+
+
+# firmware constants (config.h)
+FIRMWARE_VERSION = 1600  # VERSION
+INITIAL_FEEDRATE = 6000.0  # CONFIG_INITIAL_FEEDRATE, mm/min
+ORIGIN_OFFSET = (5.0, 5.0, 0.0)  # CONFIG_[XYZ]_ORIGIN_OFFSET, mm
+STEPS_PER_MM = (88.88888888, 90.90909090, 33.33333333)  # CONFIG_[XYZ]_STEPS_PER_MM
+HOMING_SECONDS_PER_STEP = 600e-6  # CONFIG_HOMINGRATE
+STACK_CLEARANCE = 1000  # bytes, reported in the status
+
+# bytes handled by the serial interrupt, not buffered
+re_control = re.compile(b'[\x00-\x1f]').search
+
+MOVE_TYPES = {
+    driveboard.CMD_LINE_SEEK: 'seek',
+    driveboard.CMD_LINE_BURN: 'burn',
+    driveboard.CMD_LINE_RASTER: 'raster',
+}
+
+
+def encode_param(marker, value):
+    """The bytes of serial_write_param() in serial.c"""
+    num = int(round(value*1000)) + 134217728
+    return bytes(((num & 127) + 128,
+                  ((num >> 7) & 127) + 128,
+                  ((num >> 14) & 127) + 128,
+                  ((num >> 21) & 127) + 128,
+                  marker))
+
+
+class Firmware:
+    """The firmware, as seen through the serial port
+
+    receive() takes the bytes written to the serial port, process()
+    executes everything received so far and returns the bytes the
+    firmware writes back. Executed moves are timed by the planner
+    model and summed up in totals (see _line()), with keep_moves they
+    are also recorded in moves.
+    """
+
+    def __init__(self):
+        # serial.c
+        self.rx_buffer = bytearray()
+        self.rx_processed = 0  # bytes read since the last CMD_CHUNK_PROCESSED
+        self.first_transmission = True
+        self.data_prev = None
+        self.tx = bytearray()
+        self.status_requested = False
+        self.superstatus_requested = False
+        self.stop_code = None  # a STOPERROR_* marker
+        self.underruns = 0  # the rx buffer ran empty
+        self.underruns_reported = True
+        self.door_open = False
+        self.chiller_off = False
+
+        # protocol.c
+        self.relative = False
+        self.feedrate = INITIAL_FEEDRATE
+        self.pulse_frequency = 0.0
+        self.pulse_duration = 0.0
+        self.raster_bytes = 0
+        self.offselect = 0  # 0: table offset, 1: custom offset
+        self.target = [0.0, 0.0, 0.0]
+        self.offsets = list(ORIGIN_OFFSET + ORIGIN_OFFSET)
+        self.pdata = []
+        self.raster_move = None  # receiving the raster data of this move
+        self.raster_data = bytearray()
+
+        self.bytes_read = 0  # total
+        self.lineno = 0  # of the gcode line, for the move records
+        self.planner = planner.PlannerModel()
+        self.planner.on_planned = self._on_planned
+        self.keep_moves = False
+        self.moves = []  # only with keep_moves
+        # per move type: number of moves, mm and seconds
+        self.totals = {kind: {'moves': 0, 'distance': 0.0, 'time': 0.0}
+                       for kind in ('seek', 'burn', 'raster', 'homing')}
+        self.laser_time = 0.0
+        # [min_x, min_y, max_x, max_y] of the moves with the laser on
+        self.bbox = [float('inf'), float('inf'), float('-inf'), float('-inf')]
+        self.waiting = False
+        self.unplanned = {}  # byte_end -> move
+        self.homing_time = 0.0
+
+    def receive(self, data):
+        """Bytes from the serial port (see the ISR in serial.c)"""
+        if self.first_transmission and not len(data) % 2:
+            singles = data[0::2]
+            if singles == data[1::2] and not re_control(singles):
+                # fast path, just data
+                self._buffer(singles)
+                return
+        for byte in data:
+            if byte == CMD_RESET_PROTOCOL:
+                self.rx_processed = 0
+                self.first_transmission = True
+                continue
+            if self.first_transmission:
+                self.first_transmission = False
+                self.data_prev = byte
+                continue
+            self.first_transmission = True
+            if byte != self.data_prev:
+                self._stop(driveboard.STOPERROR_TRANSMISSION_ERROR)
+            if byte < 32:
+                if byte == CMD_STOP:
+                    self._stop(driveboard.STOPERROR_SERIAL_STOP_REQUEST)
+                elif byte == CMD_RESUME:
+                    self.stop_code = None
+                elif byte == CMD_STATUS:
+                    self.status_requested = True
+                elif byte == CMD_SUPERSTATUS:
+                    self.superstatus_requested = True
+                else:
+                    self._stop(driveboard.STOPERROR_INVALID_MARKER)
+            else:
+                self._buffer(bytes((byte,)))
+
+    def _buffer(self, data):
+        self.rx_buffer += data
+        if len(self.rx_buffer) > driveboard.FIRMBUF_SIZE:
+            # the other side sent too much data
+            del self.rx_buffer[driveboard.FIRMBUF_SIZE:]
+            self._stop(driveboard.STOPERROR_RX_BUFFER_OVERFLOW)
+
+    def process(self):
+        """Execute the received bytes, return the bytes to send back"""
+        self._read_commands()
+        if self.status_requested or self.superstatus_requested:
+            self.tx += self.status_frame(self.superstatus_requested)
+            self.status_requested = False
+            self.superstatus_requested = False
+        out = bytes(self.tx)
+        del self.tx[:]
+        return out
+
+    def _read_commands(self):
+        rx = self.rx_buffer
+        consumed = 0
+        self.waiting = False
+        for byte in rx:
+            if 64 < byte < 91 and self.raster_move is None and self.stop_code is None \
+                    and self._waiting(byte):
+                # the command has to wait, e.g. for a free planner block
+                self.waiting = True
+                break
+            consumed += 1
+            self.bytes_read += 1
+            self.rx_processed += 1
+            if self.rx_processed == driveboard.TX_CHUNK_SIZE:
+                self.tx.append(CMD_CHUNK_PROCESSED)
+                self.rx_processed = 0
+            if self.stop_code is None:
+                self._on_byte(byte)
+        del rx[:consumed]
+        if self.stop_code is not None:
+            self.pdata = []
+            self.raster_move = None
+
+    def _waiting(self, command):
+        # moves are executed instantly here
+        return False
+
+    def _on_byte(self, byte):
+        # protocol_loop() in protocol.c
+        if self.raster_move is not None:
+            if byte < 128:
+                self._stop(driveboard.STOPERROR_INVALID_DATA)
+                return
+            self.raster_data.append(byte - 128)
+            if len(self.raster_data) == self.raster_bytes:
+                move = self.raster_move
+                self.raster_move = None
+                move['laser'] = sum(self.raster_data) * driveboard.PULSE_SECONDS
+                self._plan(move)
+            return
+        if byte < 128:
+            if 64 < byte < 91:
+                self._on_cmd(byte)
+            elif 96 < byte < 123:
+                self._on_param(byte)
+            else:
+                self._stop(driveboard.STOPERROR_INVALID_MARKER)
+            self.pdata = []
+        elif len(self.pdata) < 4:
+            self.pdata.append(byte)
+        else:
+            self._stop(driveboard.STOPERROR_INVALID_PARAM_DATA)
+
+    def _on_cmd(self, command):
+        if command in MOVE_TYPES:
+            self._line(command)
+        elif command == driveboard.CMD_NONE or command == driveboard.CMD_DWELL:
+            pass
+        elif command == driveboard.CMD_REF_RELATIVE:
+            self.relative = True
+        elif command == driveboard.CMD_REF_ABSOLUTE:
+            self.relative = False
+        elif command == driveboard.CMD_HOMING:
+            self._homing()
+        elif command in (driveboard.CMD_SET_OFFSET_TABLE, driveboard.CMD_SET_OFFSET_CUSTOM):
+            # waits for the moves to finish, then sets the offset to the position
+            self.planner.finish()
+            cs = 1 if command == driveboard.CMD_SET_OFFSET_CUSTOM else 0
+            self.offsets[3*cs:3*cs+3] = self.planner.position
+        elif command == driveboard.CMD_SEL_OFFSET_TABLE:
+            self.offselect = 0
+        elif command == driveboard.CMD_SEL_OFFSET_CUSTOM:
+            self.offselect = 1
+        elif driveboard.CMD_AIR_ENABLE <= command <= driveboard.CMD_AUX2_DISABLE:
+            pass  # air assist and aux outputs
+        else:
+            self._stop(driveboard.STOPERROR_INVALID_COMMAND)
+
+    def _on_param(self, param):
+        if len(self.pdata) != 4:
+            self._stop(driveboard.STOPERROR_INVALID_DATA)
+            return
+        c = self.pdata
+        value = ((c[3]-128)*2097152 + (c[2]-128)*16384 + (c[1]-128)*128 + (c[0]-128)
+                 - 134217728) / 1000.0
+        axis = 'xyz'.find(chr(param))
+        if axis >= 0:
+            if self.relative:
+                self.target[axis] += value
+            else:
+                self.target[axis] = value + self.offsets[3*self.offselect + axis]
+        elif param == driveboard.PARAM_FEEDRATE:
+            self.feedrate = value
+        elif param == driveboard.PARAM_PULSE_FREQUENCY:
+            self.pulse_frequency = value
+        elif param == driveboard.PARAM_PULSE_DURATION:
+            self.pulse_duration = value
+        elif param == driveboard.PARAM_RASTER_BYTES:
+            self.raster_bytes = int(value)
+        elif param in (driveboard.PARAM_OFFTABLE_X, driveboard.PARAM_OFFTABLE_Y, driveboard.PARAM_OFFTABLE_Z):
+            self.offsets[param - driveboard.PARAM_OFFTABLE_X] = value
+        elif param in (driveboard.PARAM_OFFCUSTOM_X, driveboard.PARAM_OFFCUSTOM_Y, driveboard.PARAM_OFFCUSTOM_Z):
+            axis = param - driveboard.PARAM_OFFCUSTOM_X
+            # relative to the table offset
+            self.offsets[3 + axis] = value + self.offsets[axis]
+        else:
+            self._stop(driveboard.STOPERROR_INVALID_PARAMETER)
+
+    def _line(self, command):
+        # a move record, in table coordinates (as the gcode of a job)
+        kind = MOVE_TYPES[command]
+        start = self.planner.position
+        x, y, z = self.target
+        dx = x - start[0]
+        dy = y - start[1]
+        dz = z - start[2]
+        move = {
+            'line': self.lineno,
+            'type': kind,
+            'x': round(x - self.offsets[0], 3),
+            'y': round(y - self.offsets[1], 3),
+            'from_x': round(start[0] - self.offsets[0], 3),
+            'from_y': round(start[1] - self.offsets[1], 3),
+            'distance': math.sqrt(dx*dx + dy*dy + dz*dz),
+            'time': 0.0,
+            'laser_time': 0.0,
+        }
+        if self.keep_moves:
+            self.moves.append(move)
+        totals = self.totals[kind]
+        totals['moves'] += 1
+        totals['distance'] += move['distance']
+        if kind != 'seek' and move['distance'] > 0.0:
+            bbox = self.bbox
+            for x, y in ((move['from_x'], move['from_y']), (move['x'], move['y'])):
+                bbox[0] = min(bbox[0], x)
+                bbox[1] = min(bbox[1], y)
+                bbox[2] = max(bbox[2], x)
+                bbox[3] = max(bbox[3], y)
+        if kind == 'raster':
+            if self.raster_bytes > driveboard.RASTER_BYTES_MAX:
+                self._stop(driveboard.STOPERROR_VALUE_OUT_OF_RANGE)
+                return
+            if self.raster_bytes > 0:
+                # the raster data follows the command
+                self.raster_move = move
+                self.raster_data = bytearray()
+                return
+        if kind != 'seek':
+            # fraction of the time the laser is on
+            duty = self.pulse_frequency * self.pulse_duration * driveboard.PULSE_SECONDS
+            move['duty'] = min(1.0, max(0.0, duty))
+        self._plan(move)
+
+    def _plan(self, move):
+        x, y, z = self.target
+        if self.planner.add_move(x, y, z, self.feedrate, self.bytes_read):
+            self.unplanned[self.bytes_read] = move
+        else:
+            move.pop('duty', None)
+            move.pop('laser', None)
+
+    def _on_planned(self, byte_end, seconds):
+        move = self.unplanned.pop(byte_end)
+        move['time'] = seconds
+        if 'duty' in move:
+            move['laser_time'] = seconds * move.pop('duty')
+        elif 'laser' in move:
+            move['laser_time'] = min(seconds, move.pop('laser'))
+        self.totals[move['type']]['time'] += seconds
+        self.laser_time += move['laser_time']
+
+    def _homing(self):
+        # waits for the moves to finish, then moves to the limit
+        # switches, and to the table offset
+        self.planner.finish()
+        steps = max(abs(p)*s for p, s in zip(self.planner.position, STEPS_PER_MM))
+        seconds = steps * HOMING_SECONDS_PER_STEP
+        self.homing_time += seconds
+        self.totals['homing']['moves'] += 1
+        self.totals['homing']['time'] += seconds
+        if self.keep_moves:
+            self.moves.append({'line': self.lineno, 'type': 'homing',
+                               'x': -self.offsets[0], 'y': -self.offsets[1], 'distance': 0.0,
+                               'time': seconds, 'laser_time': 0.0})
+        self.planner.set_position(0.0, 0.0, 0.0)
+        self.offselect = 0
+        self.target = self.offsets[0:3]
+        self._line(driveboard.CMD_LINE_SEEK)
+
+    def _stop(self, code):
+        if self.stop_code is None:
+            self.stop_code = code
+        self.planner.discard()
+        self.unplanned.clear()
+
+    def position(self):
+        return self.planner.position
+
+    def idle(self):
+        return not self.rx_buffer and not self.planner.lookahead
+
+    def finish(self):
+        """Complete all moves, as the firmware does when no more data follows"""
+        self.planner.finish()
+
+    def status_frame(self, superstatus=False):
+        """The status report of protocol_idle() in protocol.c"""
+        out = bytearray()
+        if self.idle():
+            out.append(driveboard.INFO_IDLE_YES)
+        if self.door_open:
+            out.append(driveboard.INFO_DOOR_OPEN)
+        if self.chiller_off:
+            out.append(driveboard.INFO_CHILLER_OFF)
+        if self.stop_code is not None:
+            out.append(self.stop_code)
+        offset = self.offsets[3*self.offselect:3*self.offselect+3]
+        pos = self.position()
+        out += encode_param(driveboard.INFO_POS_X, pos[0] - offset[0])
+        out += encode_param(driveboard.INFO_POS_Y, pos[1] - offset[1])
+        out += encode_param(driveboard.INFO_POS_Z, pos[2] - offset[2])
+        if not self.underruns_reported:
+            out += encode_param(driveboard.INFO_BUFFER_UNDERRUN, self.underruns)
+            self.underruns_reported = True
+        out += encode_param(driveboard.INFO_STACK_CLEARANCE, STACK_CLEARANCE)
+        out += encode_param(driveboard.INFO_DELAYED_MICROSTEPS, 0)
+        if superstatus:
+            out += encode_param(driveboard.INFO_VERSION, FIRMWARE_VERSION)
+            for axis in range(3):
+                out += encode_param(driveboard.INFO_OFFCUSTOM_X + axis,
+                                    self.offsets[3+axis] - self.offsets[axis])
+            out += encode_param(driveboard.INFO_FEEDRATE, self.feedrate)
+            out += encode_param(driveboard.INFO_PULSE_FREQUENCY, self.pulse_frequency)
+            out += encode_param(driveboard.INFO_PULSE_DURATION, self.pulse_duration)
+        out.append(STATUS_END)
+        return out
+
+
+class SimulatedDriveboard(driveboard.Driveboard):
+    """Driveboard connected to Firmware instead of a serial port
+
+    Every write is processed by the firmware right away, and its
+    acknowledgements let the Driveboard send the next bytes.
+    """
+
+    def __init__(self):
+        # not worth a warning (see _update_status)
+        self.previous_error_report = 'disconnected from serial port'
+        super().__init__('simulated', None)
+        self.status_timer.stop()
+        self.firmware = Firmware()
+        self.in_firmware = False
+
+    def connect(self):
+        # the firmware starts in its initial state, no need to reset
+        # the protocol or to wait for its greeting
+        self.device = self.firmware
+        self.disconnect_reason = None
+        return ''
+
+    def disconnect(self, reason):
+        self.disconnect_reason = reason
+        self.device = None
+
+    def _serial_write(self, data=b''):
+        if not self.device:
+            logging.warning('write ignored (device closed)')
+            return
+        if data:
+            self.firmware.receive(driveboard.double_bytes(data))
+        if self.in_firmware:
+            # an acknowledgement triggered this write, see below
+            return
+        self.in_firmware = True
+        try:
+            while True:
+                out = self.firmware.process()
+                if not out:
+                    break
+                self._serial_received(out)
+        finally:
+            self.in_firmware = False
+
+
+class Simulation:
+    """Dry run of a gcode job, see the module docstring"""
+
+    def __init__(self, keep_moves=False):
+        self.board = gcode.DriveboardGcode(None, None, board=SimulatedDriveboard())
+        self.board.connect()
+        self.firmware = self.board.driveboard.firmware
+        # a record of every move, for the breakdown (memory intensive)
+        self.firmware.keep_moves = keep_moves
+        self.lineno = 0
+
+    def gcode_line(self, line):
+        """Same as DriveboardGcode.gcode_line"""
+        self.lineno += 1
+        self.firmware.lineno = self.lineno
+        if line.startswith(('!', '~')):
+            # stop, resume, pause: nothing to simulate
+            return 'ok'
+        return self.board.gcode_line(line)
+
+    def result(self):
+        """Summary of the job, with keep_moves also a breakdown of all moves
+
+        Times are in seconds, distances in mm, bbox is [min_x, min_y,
+        max_x, max_y] of the moves with the laser on.
+        """
+        firmware = self.firmware
+        firmware.finish()
+        res = {
+            'lines': self.lineno,
+            'bytes': self.board.driveboard.fwbuf_bytes_queued,
+            'time_total': firmware.planner.planned_time + firmware.homing_time,
+            'stops': [],
+        }
+        for kind, totals in firmware.totals.items():
+            res[kind] = dict(totals)
+        res['seek_distance'] = res['seek']['distance']
+        res['burn_distance'] = res['burn']['distance'] + res['raster']['distance']
+        res['laser_time'] = firmware.laser_time
+        bbox = firmware.bbox
+        res['bbox'] = list(bbox) if bbox[0] <= bbox[2] else None
+        if firmware.stop_code is not None:
+            name = driveboard.markers_rx[firmware.stop_code]
+            res['stops'].append(name.split('STOPERROR_')[1].lower())
+        if firmware.keep_moves:
+            res['breakdown'] = firmware.moves
+        return res
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Simulate a gcode job, without a driveboard.')
+    argparser.add_argument('gcodefile', help='the job')
+    argparser.add_argument('-m', '--moves', dest='moves', action='store_true',
+                           default=False, help='list all moves')
+    argparser.add_argument('-j', '--json', dest='json', action='store_true',
+                           default=False, help='print the result as JSON')
+    args = argparser.parse_args()
+    # the protocol warnings of a real connection are just noise here
+    logging.getLogger().setLevel(logging.ERROR)
+
+    sim = Simulation(args.moves)
+    with open(args.gcodefile) as f:
+        for line in f:
+            resp = sim.gcode_line(line)
+            if resp.startswith('error:'):
+                print('line %d: %s' % (sim.lineno, resp[6:]))
+                return 1
+    res = sim.result()
+    if args.json:
+        print(json.dumps(res, indent=1))
+        return 0
+
+    if args.moves:
+        for move in res['breakdown']:
+            print('%6d %-7s %9.3f %9.3f %9.3f mm %8.3f s  laser %8.3f s' % (
+                move['line'], move['type'], move['x'], move['y'],
+                move['distance'], move['time'], move['laser_time']))
+    for kind in ('seek', 'burn', 'raster', 'homing'):
+        r = res[kind]
+        if r['moves']:
+            print('%-7s %7d moves %10.1f mm %9.1f s' % (kind, r['moves'], r['distance'], r['time']))
+    print('total time %.1f s, laser on %.1f s' % (res['time_total'], res['laser_time']))
+    if res['bbox']:
+        print('bbox %.1f, %.1f - %.1f, %.1f mm' % tuple(res['bbox']))
+    if res['stops']:
+        print('stopped: ' + ' '.join(res['stops']))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,10 @@
+"""pytest setup: the backend modules import each other as top-level
+modules, the filereaders as a package of backend/original
+"""
+import os
+import sys
+
+backend = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (backend, os.path.join(backend, 'original')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
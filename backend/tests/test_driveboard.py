@@ -0,0 +1,11 @@
+import driveboard
+
+
+def test_raster_data_is_clamped_with_the_data_bit_set():
+    data = bytes([0, 1, 64, 126, 127, 128, 129, 200, 254, 255])
+    encoded = driveboard.encode_raster_data(data)
+    assert encoded == bytes([128, 129, 192, 254, 255, 255, 255, 255, 255, 255])
+    # every byte is data, none can be taken for a command marker
+    assert min(encoded) >= 128
+    assert driveboard.encode_raster_data(bytearray(data)) == encoded
+
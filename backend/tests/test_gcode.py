@@ -0,0 +1,150 @@
+import base64
+import hashlib
+
+import pytest
+
+import bench_gcode
+import driveboard
+import gcode
+
+
+class RecordingDriveboard:
+    """Collects the firmware bytes, as Driveboard.send_move() encodes them"""
+    fw_stopped = False
+
+    def __init__(self):
+        self.sent = bytearray()
+        self.fwbuf_bytes_queued = 0
+
+    def is_connected(self):
+        return True
+
+    def send_move(self, params, command=None):
+        self._send(driveboard.encode_move(params, command))
+
+    def send_raster_data(self, data):
+        self._send(driveboard.encode_raster_data(data))
+
+    def _send(self, data):
+        self.sent += data
+        self.fwbuf_bytes_queued += len(data)
+
+
+# (line, bytes sent) from the gcode parser and encoder before the fast
+# path and encode_move(), in this order (the modal state carries over)
+GOLDEN = [
+    ('G90',
+     '46'),
+    ('M80',
+     '4c'),
+    ('G0X10Y20F8000',
+     '90ce80c078a09c81c07980a4e8c36652'),
+    ('G1X12.5Y-3.25F2000S200',
+     'd4e180c078cee6ffbf798089fac066fcc5d6c170d8b680c06453'),
+    ('G1 X13 Y14 ; comment',
+     'c8e580c078b0ed80c0798089fac06653'),
+    ('G00 X1 Y2 Z3',
+     'e88780c078d08f80c079b89780c07a80a4e8c36652'),
+    ('G01X5',
+     '88a780c0788089fac06653'),
+    ('S100',
+     'b09796c17088a780c064'),
+    ('G1X6S100',
+     'f0ae80c0788089fac066b09796c17088a780c06453'),
+    ('G1Y7S0',
+     'd8b680c0798089fac066808080c070808080c06453'),
+    ('G1X8 S255',
+     'c0be80c0788089fac0668fe1d4c17090ce80c06453'),
+    ('G91',
+     '45'),
+    ('G1X1Y1',
+     'e88780c078e88780c0798089fac06653'),
+    ('G90',
+     '46'),
+    ('G0Z-1.5',
+     'a4f4ffbf7a80a4e8c36652'),
+    ('G1F1500X0Y0',
+     '808080c078808080c079e0c6dbc06653'),
+    ('M81',
+     '4d'),
+    ('M82',
+     '4e'),
+    ('M83',
+     '4f'),
+    ('M84',
+     '50'),
+    ('M85',
+     '51'),
+    ('G54',
+     '4a'),
+    ('G55',
+     '4b'),
+    ('G10P1L2X10Y20Z0',
+     '90ce80c06ba09c81c06c808080c06d'),
+    ('G10P0L20',
+     '48'),
+    ('G10P1L20',
+     '49'),
+    ('G30',
+     '47'),
+    ('G7X10Y0F3000V1 DAAMGCQwPEhUYGx4hJCcqLTAzNjk8P0JFSEtOUVRXWl1gY2ZpbG9ydXh7fg==',
+     '90ce80c078808080c079c08db7c166f8cf82c07254808386898c8f9295989b9ea1a4a7aaadb0b3b6b9bcbfc2c5c8cbced1d4d7dadde0e3e6e9eceff2f5f8fbfe'),
+    ('G7X10Y0V1 DAAEC',
+     '90ce80c078808080c079c08db7c166b89780c07254808182'),
+    ('G0X134217.727Y-134217.728',
+     'ffffffff78808080807980a4e8c36652'),
+    ('G0X0.0005Y-0.0005',
+     '808080c078808080c07980a4e8c36652'),
+    ('G1X1e2Y3',
+     'a08d86c078b89780c079c08db7c16653'),
+]
+
+# no bytes sent for these
+ERRORS = [
+    'G28',
+    'G1X1Q2',
+    'G99',
+    'X10',
+    'G1Xabc',
+    'S300',
+    'M5',
+    'G1 S-1',
+    'G7X10Y0F3000 DAQI=',
+    'G7X10Y0F3000V2 DAQI=',
+    'G7X10Y0F3000V1',
+]
+
+
+def test_byte_stream_matches_the_previous_encoder():
+    board = gcode.DriveboardGcode(None, None, board=RecordingDriveboard())
+    sent = board.driveboard.sent
+    for line, expected in GOLDEN:
+        before = len(sent)
+        assert board.gcode_line(line) == 'ok', line
+        assert sent[before:].hex() == expected, line
+
+
+@pytest.mark.parametrize('line', ERRORS)
+def test_errors_send_nothing(line):
+    board = gcode.DriveboardGcode(None, None, board=RecordingDriveboard())
+    assert board.gcode_line(line).startswith('error:')
+    assert not board.driveboard.sent
+
+
+def test_g7_without_version_or_data_is_an_error():
+    # the previous parser raised KeyError for these
+    board = gcode.DriveboardGcode(None, None, board=RecordingDriveboard())
+    data = base64.b64encode(b'\x01\x02').decode()
+    assert board.gcode_line('G7X10Y0F3000 D' + data) == 'error:G7 command of unknown version'
+    assert board.gcode_line('G7X10Y0F3000V1') == 'error:G7 command without raster data'
+    assert not board.driveboard.sent
+
+
+def test_synthetic_job_matches_the_previous_encoder():
+    board = gcode.DriveboardGcode(None, None, board=RecordingDriveboard())
+    for line in bench_gcode.synthetic_job(20000):
+        assert board.gcode_line(line) == 'ok'
+    sent = bytes(board.driveboard.sent)
+    assert len(sent) == 318810
+    assert hashlib.sha256(sent).hexdigest() == \
+        '0de7f3c54b6ac876a22470e208826ae43d95ea701ec644d3fc716a7c27569095'
@@ -0,0 +1,47 @@
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+import emulator
+import gcode
+
+# 66 bytes, the last partial TX_CHUNK_SIZE chunk is never acknowledged
+JOB = ['M80', 'G0 X20 Y0 F6000', 'G1 X20 Y20 F3000', 'G1 X0 Y20', 'G0 X0 Y0', 'M81']
+
+
+@gen.coroutine
+def wait_for(board, condition, timeout=10.0):
+    deadline = IOLoop.current().time() + timeout
+    while True:
+        status = board.get_status()
+        if condition(status):
+            return status
+        if IOLoop.current().time() > deadline:
+            raise AssertionError('timeout, last status %r' % status)
+        yield gen.sleep(0.02)
+
+
+@gen.coroutine
+def run_jobs(results):
+    board = gcode.DriveboardGcode(None, None, board=emulator.EmulatedDriveboard(speedup=4.0))
+    board.connect()
+    assert board.is_connected()
+    try:
+        yield wait_for(board, lambda s: s['ready'] and board.driveboard.greeting_timeout is None)
+        for _ in range(3):
+            for line in JOB:
+                assert board.gcode_line(line) == 'ok'
+            yield wait_for(board, lambda s: not s['ready'])
+            status = yield wait_for(board, lambda s: s['ready'] and s['queue']['time_percent'] == 100.0)
+            results.append(status['queue']['time_total'])
+    finally:
+        board.driveboard.disconnect('test done')
+
+
+def test_back_to_back_jobs_complete_and_reset():
+    results = []
+    IOLoop.current().run_sync(lambda: run_jobs(results), timeout=60)
+    # every job reaches 100 % and is timed on its own
+    assert len(results) == 3
+    assert results[0] > 0
+    assert results[1] == results[0]
+    assert results[2] == results[0]
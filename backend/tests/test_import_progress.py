@@ -0,0 +1,75 @@
+import io
+
+import pytest
+
+from filereaders import read_dxf, read_ngc, read_svg
+
+
+class Cancelled(Exception):
+    pass
+
+
+def recorder(calls, cancel_at=None):
+    def progress(stage, fraction):
+        calls.append((stage, fraction))
+        if len(calls) == cancel_at:
+            raise Cancelled()
+    return progress
+
+
+def check_calls(calls):
+    stages = [stage for stage, fraction in calls]
+    assert stages.count('parsing') > 2
+    assert stages.count('optimizing') > 2
+    # parsing comes first, fractions grow within a stage
+    assert stages == sorted(stages, key=['parsing', 'optimizing'].index)
+    for stage in ('parsing', 'optimizing'):
+        fractions = [f for s, f in calls if s == stage]
+        assert fractions == sorted(fractions)
+        assert 0.0 <= fractions[0] and fractions[-1] <= 1.0
+
+
+def svg_file(n):
+    # separate lines, in rows of 500
+    lines = ''.join('<line x1="%d" y1="%d" x2="%d" y2="%d" stroke="#000000"/>\n'
+                    % (i % 500, i//500*10, i % 500, i//500*10 + 5) for i in range(n))
+    return io.BytesIO(('<svg xmlns="http://www.w3.org/2000/svg" width="500mm" height="100mm"'
+                       ' viewBox="0 0 500 100">\n%s</svg>\n' % lines).encode('utf-8'))
+
+
+def dxf_string(n):
+    entities = ''.join('0\nLINE\n8\n0\n10\n%d\n20\n0\n30\n0\n11\n%d\n21\n5\n31\n0\n' % (i, i)
+                       for i in range(n))
+    return '0\nSECTION\n2\nENTITIES\n%s0\nENDSEC\n0\nEOF\n' % entities
+
+
+def test_svg_stream_reports_progress():
+    calls = []
+    res = read_svg(svg_file(5000), [1220, 610], 0.08, progress=recorder(calls), tour_budget=0.1)
+    assert len(res['boundarys']['#000000']) == 5000
+    check_calls(calls)
+
+
+def test_dxf_reports_progress():
+    calls = []
+    res = read_dxf(dxf_string(5000), 0.08, progress=recorder(calls))
+    assert len(res['boundarys']['#000000']) == 5000
+    check_calls(calls)
+
+
+def test_ngc_reports_progress():
+    calls = []
+    ngc = ''.join('G0X%dY0\nG1X%dY5S100\n' % (i, i) for i in range(15000))
+    res = read_ngc(ngc, 0.08, progress=recorder(calls))
+    assert len(res['boundarys']['#000000']) == 15000
+    assert len(calls) > 2
+    assert set(s for s, f in calls) == {'parsing'}
+
+
+@pytest.mark.parametrize('cancel_at', [2, 5])
+def test_raising_from_progress_cancels(cancel_at):
+    # while parsing, and while optimizing
+    calls = []
+    with pytest.raises(Cancelled):
+        read_svg(svg_file(5000), [1220, 610], 0.08, progress=recorder(calls, cancel_at))
+    assert len(calls) == cancel_at
@@ -0,0 +1,68 @@
+import random
+
+import pytest
+
+from filereaders import kdtree
+
+
+def brute_force(points, removed, pos, checkempty, data):
+    candidates = [(((x-pos[0])**2 + (y-pos[1])**2), i) for i, (x, y) in enumerate(points)
+                  if i not in removed and not (checkempty and data[i] is None)]
+    return sorted(candidates)
+
+
+def random_tree(rnd, n):
+    tree = kdtree.Tree(2)
+    points = [(rnd.uniform(0, 100), rnd.uniform(0, 100)) for _ in range(n)]
+    nodes = [tree.insert(list(p), i) for i, p in enumerate(points)]
+    return tree, points, nodes
+
+
+def test_nearest_matches_brute_force_with_removals():
+    rnd = random.Random(2)
+    tree, points, nodes = random_tree(rnd, 500)
+    data = list(range(len(points)))
+    removed = set()
+    for step in range(450):
+        pos = (rnd.uniform(-10, 110), rnd.uniform(-10, 110))
+        checkempty = step % 2 == 0
+        node, distsq = tree.nearest(pos, checkempty=checkempty)
+        expected = brute_force(points, removed, pos, checkempty, data)
+        assert distsq == pytest.approx(expected[0][0])
+        assert node.pos == list(points[node.index])
+        # remove some points (enough to trigger rebuilds), empty others
+        i = rnd.choice([i for i in range(len(points)) if i not in removed])
+        if rnd.random() < 0.7:
+            tree.remove(nodes[i])
+            removed.add(i)
+        else:
+            nodes[i].data = None
+            data[i] = None
+    assert len(tree) == len(points) - len(removed)
+
+
+def test_nearest_k_matches_brute_force():
+    rnd = random.Random(3)
+    tree, points, nodes = random_tree(rnd, 300)
+    removed = set(rnd.sample(range(300), 100))
+    for i in removed:
+        tree.remove(nodes[i])
+    data = list(range(300))
+    for _ in range(100):
+        pos = (rnd.uniform(0, 100), rnd.uniform(0, 100))
+        k = rnd.randrange(1, 12)
+        found = tree.nearest_k(pos, k)
+        expected = brute_force(points, removed, pos, False, data)[:k]
+        assert [d for node, d in found] == pytest.approx([d for d, i in expected])
+
+
+def test_empty_and_exhausted_tree():
+    tree = kdtree.Tree(2)
+    assert tree.nearest([0, 0]) == (None, None)
+    a = tree.insert([1, 1], 'a')
+    assert tree.nearest([0, 0])[0].data == 'a'
+    a.data = None
+    assert tree.nearest([0, 0], checkempty=True) == (None, None)
+    tree.remove(a)
+    assert tree.nearest([0, 0]) == (None, None)
+    assert tree.nearest_k([0, 0], 3) == []
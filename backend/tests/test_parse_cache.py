@@ -0,0 +1,51 @@
+import os
+
+import parse_cache
+from filereaders import Polylines
+
+
+def result():
+    paths = Polylines()
+    paths.append([0.0, 0.0, 10.0, 5.0])
+    return {'boundarys': {'#000000': paths}, 'lasertags': []}
+
+
+def test_put_and_get(tmp_path):
+    cache = parse_cache.ParseCache(str(tmp_path), 1 << 20)
+    assert cache.get('a') is None
+    cache.put('a', result())
+    res = cache.get('a')
+    assert res['lasertags'] == []
+    assert list(res['boundarys']['#000000'].coords) == [0.0, 0.0, 10.0, 5.0]
+
+
+def test_get_of_an_entry_deleted_after_reading_is_a_miss(tmp_path, monkeypatch):
+    cache = parse_cache.ParseCache(str(tmp_path), 1 << 20)
+    cache.put('a', result())
+
+    def utime(filename, times):
+        # e.g. evicted by another import worker after the read
+        os.remove(filename)
+        raise FileNotFoundError(filename)
+    monkeypatch.setattr(parse_cache.os, 'utime', utime)
+    assert cache.get('a') is None
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = parse_cache.ParseCache(str(tmp_path), 1 << 20)
+    cache.put('a', result())
+    size = os.path.getsize(os.path.join(str(tmp_path), 'a.lpc'))
+    cache.max_bytes = 2*size
+    cache.put('b', result())
+    os.utime(os.path.join(str(tmp_path), 'a.lpc'), (1, 1))  # least recently used
+    cache.put('c', result())
+    assert cache.get('a') is None
+    assert cache.get('b') is not None and cache.get('c') is not None
+
+
+def test_cache_key_depends_on_the_parser_version(monkeypatch):
+    args = ('svg', b'<svg/>', 0.08, None, [1220, 610], True)
+    key = parse_cache.cache_key(*args)
+    assert parse_cache.cache_key(*args) == key
+    monkeypatch.setattr(parse_cache, 'PARSER_VERSION', parse_cache.PARSER_VERSION + 1)
+    assert parse_cache.cache_key(*args) != key
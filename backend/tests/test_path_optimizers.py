@@ -0,0 +1,239 @@
+import math
+import random
+
+import pytest
+
+import filereaders
+from filereaders import path_optimizers
+from filereaders.polylines import Polylines
+
+
+def vertices(coords):
+    return [tuple(coords[i:i+2]) for i in range(0, len(coords), 2)]
+
+
+def random_polylines(rnd, n, length):
+    # random walks, far enough apart that they do not touch
+    paths = []
+    for _ in range(n):
+        x, y = rnd.uniform(0, 1000), rnd.uniform(0, 1000)
+        path = [(x, y)]
+        for _ in range(length):
+            x += rnd.uniform(-5, 5)
+            y += rnd.uniform(-5, 5)
+            path.append((x, y))
+        paths.append(path)
+    return paths
+
+
+def test_connect_segments_joins_pieces_in_any_order():
+    rnd = random.Random(4)
+    originals = random_polylines(rnd, 20, 30)
+    pieces = []
+    for path in originals:
+        # cut into pieces that share their end vertices
+        cuts = sorted(rnd.sample(range(1, len(path)-1), 4))
+        for a, b in zip([0] + cuts, cuts + [len(path)-1]):
+            piece = path[a:b+1]
+            if rnd.random() < 0.5:
+                piece = piece[::-1]
+            pieces.append(piece)
+    rnd.shuffle(pieces)
+    segments = Polylines()
+    for piece in pieces:
+        segments.append([c for v in piece for c in v])
+
+    joined = path_optimizers.connect_segments(segments, 0.01**2)
+
+    assert len(joined) == len(originals)
+    expected = set()
+    for path in originals:
+        expected.add(tuple(path))
+        expected.add(tuple(path[::-1]))
+    for pathseg in joined:
+        assert tuple(vertices(pathseg)) in expected
+
+
+def test_connect_segments_keeps_separate_paths():
+    segments = Polylines.from_list([[[0, 0], [1, 0]], [[5, 5], [6, 6]], [], [[1, 1], [1, 0]]])
+    joined = path_optimizers.connect_segments(segments, 0.01**2)
+    assert [list(pathseg) for pathseg in joined] == [[0, 0, 1, 0, 1, 1], [5, 5, 6, 6]]
+
+
+def test_improve_tour_is_a_permutation_and_no_longer():
+    rnd = random.Random(5)
+    originals = random_polylines(rnd, 200, 3)
+    path = Polylines()
+    for p in originals:
+        path.append([c for v in p for c in v])
+    greedy = path_optimizers.sort_by_seektime(path)
+    improved = path_optimizers.improve_tour(greedy, 5.0)
+
+    # every path exactly once, possibly reversed
+    expected = sorted(tuple(p) for p in originals)
+    found = []
+    for pathseg in improved:
+        v = vertices(pathseg)
+        found.append(tuple(v) if tuple(v) in expected else tuple(v[::-1]))
+    assert sorted(found) == expected
+    before, _ = path_optimizers.seek_distance(greedy)
+    after, _ = path_optimizers.seek_distance(improved)
+    assert after <= before + 1e-9
+    assert after < before  # 200 random paths, greedy is never optimal
+
+
+def test_improve_tour_without_budget_keeps_order():
+    path = Polylines.from_list([[[0, 0], [1, 0]], [[5, 5], [6, 6]], [[1, 1], [2, 2]]])
+    assert path_optimizers.improve_tour(path, 0) is path
+
+
+def segment_dist2(x, y, ax, ay, bx, by):
+    ux, uy = bx-ax, by-ay
+    cu = ux*ux + uy*uy
+    t = 0.0 if cu == 0 else max(0.0, min(1.0, ((x-ax)*ux + (y-ay)*uy) / cu))
+    return (x-ax-t*ux)**2 + (y-ay-t*uy)**2
+
+
+@pytest.mark.skipif(path_optimizers.numpy is None, reason='numpy not installed')
+def test_simplify_dp_numpy_matches_pure_python(monkeypatch):
+    rnd = random.Random(6)
+    for length in (10, 100, 1000, 5000):
+        walk = random_polylines(rnd, 1, length)[0]
+        vx = [x for x, y in walk]
+        vy = [y for x, y in walk]
+        for tol2 in (0.01, 1.0, 25.0):
+            with_numpy = [0]*len(walk)
+            path_optimizers.simplifyDP(tol2, vx, vy, 0, len(walk)-1, with_numpy)
+            pure = [0]*len(walk)
+            with monkeypatch.context() as m:
+                m.setattr(path_optimizers, 'numpy', None)
+                path_optimizers.simplifyDP(tol2, vx, vy, 0, len(walk)-1, pure)
+            assert with_numpy == pure
+
+
+def test_simplify_stays_within_tolerance():
+    rnd = random.Random(7)
+    walk = random_polylines(rnd, 1, 500)[0]
+    coords = [c for v in walk for c in v]
+    tol2 = 4.0
+    simplified = vertices(path_optimizers.simplify(coords, tol2))
+    assert simplified[0] == walk[0] and simplified[-1] == walk[-1]
+    assert len(simplified) < len(walk)
+    # every vertex is close to the simplified polyline (the vertex
+    # reduction stage may add up to one more tolerance)
+    for x, y in walk:
+        d2 = min(segment_dist2(x, y, ax, ay, bx, by)
+                 for (ax, ay), (bx, by) in zip(simplified, simplified[1:]))
+        assert d2 <= 4*tol2
+
+
+def path_set(path):
+    # paths may be reversed by the sorting
+    return sorted(min(tuple(vertices(p)), tuple(vertices(p)[::-1])) for p in path)
+
+
+def test_seek_distance():
+    path = Polylines.from_list([[[3, 4], [10, 4]], [], [[10, 0], [0, 0], [0, 10]]])
+    dist, pos = path_optimizers.seek_distance(path)
+    assert dist == pytest.approx(5 + 4)
+    assert pos == [0, 10]
+    dist, pos = path_optimizers.seek_distance(path, [10, 4])
+    assert dist == pytest.approx(7 + 4)
+    assert path_optimizers.seek_distance(Polylines(), [1, 2]) == (0.0, [1, 2])
+
+
+def job_boundarys(rnd):
+    # colors spread over the bed, in random order
+    boundarys = {}
+    for color in ('#ff0000', '#00ff00', '#0000ff'):
+        paths = random_polylines(rnd, 40, 3)
+        rnd.shuffle(paths)
+        boundarys[color] = Polylines.from_list(paths)
+    return boundarys
+
+
+def job_seek_distance(passes, boundarys):
+    # a color used again is cut again, from where the job is
+    dist = 0.0
+    pos = [0.0, 0.0]
+    for pass_ in passes:
+        for color in pass_['colors']:
+            if color in boundarys:
+                d, pos = path_optimizers.seek_distance(boundarys[color], pos)
+                dist += d
+    return dist
+
+
+PASSES = [{'colors': ['#ff0000', '#00ff00'], 'feedrate': 1000, 'intensity': 50},
+          {'colors': ['#0000ff', '#ffff00', '#ff0000'], 'feedrate': 2000, 'intensity': 90}]
+
+
+def test_optimize_passes_shortens_seeks():
+    boundarys = job_boundarys(random.Random(8))
+    originals = dict((color, list(path)) for color, path in boundarys.items())
+
+    passes, sorted_boundarys, before, after = path_optimizers.optimize_passes(PASSES, boundarys)
+
+    # the arguments are not modified
+    assert dict((color, list(path)) for color, path in boundarys.items()) == originals
+    assert PASSES[1]['colors'] == ['#0000ff', '#ffff00', '#ff0000']
+    # same passes and paths, colors without paths move to the end
+    assert [p['colors'] for p in passes] == [['#ff0000', '#00ff00'],
+                                            ['#0000ff', '#ff0000', '#ffff00']]
+    assert [p['feedrate'] for p in passes] == [1000, 2000]
+    for color, path in boundarys.items():
+        assert path_set(sorted_boundarys[color]) == path_set(path)
+    assert before == pytest.approx(job_seek_distance(PASSES, boundarys))
+    assert after == pytest.approx(job_seek_distance(passes, sorted_boundarys))
+    assert after < 0.5 * before
+
+
+def test_optimize_passes_continues_from_previous_color():
+    # each color is sorted from where the previous one ended, which
+    # beats sorting each color from the origin (as optimize_all does)
+    boundarys = job_boundarys(random.Random(9))
+    from_origin = dict((color, path_optimizers.sort_by_seektime(path))
+                       for color, path in boundarys.items())
+    passes, sorted_boundarys, before, after = path_optimizers.optimize_passes(PASSES, from_origin)
+    assert before == pytest.approx(job_seek_distance(PASSES, from_origin))
+    assert after < before
+
+
+def test_optimize_passes_order_colors():
+    # two colors far apart, the job starts next to the second one
+    near = Polylines.from_list([[[1, 1], [2, 2]], [[3, 3], [4, 4]]])
+    far = Polylines.from_list([[[900, 500], [901, 501]]])
+    boundarys = {'#ff0000': far, '#000000': near}
+    passes = [{'colors': ['#ff0000', '#000000', '#00ff00']}]
+
+    res = path_optimizers.optimize_passes(passes, boundarys)
+    assert res[0][0]['colors'] == ['#ff0000', '#000000', '#00ff00']
+
+    res = path_optimizers.optimize_passes(passes, boundarys, order_colors=True)
+    # the color without paths stays at the end
+    assert res[0][0]['colors'] == ['#000000', '#ff0000', '#00ff00']
+    assert res[3] < res[2]
+
+
+def test_optimize_passes_with_tour_budget():
+    boundarys = job_boundarys(random.Random(10))
+    improved = path_optimizers.optimize_passes(PASSES, boundarys, tour_budget=0.5)
+    assert improved[3] < 0.5 * improved[2]
+    assert improved[3] == pytest.approx(job_seek_distance(improved[0], improved[1]))
+    for color, path in boundarys.items():
+        assert path_set(improved[1][color]) == path_set(path)
+
+
+def test_optimize_job_frontend_format():
+    job = {'passes': [{'colors': ['#000000', '#ff0000'], 'feedrate': 1500, 'intensity': 30}],
+           'paths_by_color': {'#000000': [[[50, 50], [60, 50]], [], [[5, 0], [0, 0]]],
+                              '#ff0000': [[[55, 55, 1], [70, 70, 1]]]},
+           'name': 'test'}
+    res, before, after = filereaders.optimize_job(job)
+    assert res['name'] == 'test'
+    assert res['passes'] == job['passes']
+    # empty paths are dropped, z coordinates kept
+    assert res['paths_by_color'] == {'#000000': [[[0, 0], [5, 0]], [[50, 50], [60, 50]]],
+                                     '#ff0000': [[[55, 55, 1], [70, 70, 1]]]}
+    assert before == pytest.approx(math.hypot(50, 50) + math.hypot(55, 50) + math.hypot(55, 55))
+    assert after == pytest.approx(math.hypot(45, 50) + math.hypot(5, 5))
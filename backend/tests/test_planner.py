@@ -0,0 +1,107 @@
+import pytest
+
+import driveboard
+import planner
+
+
+def acked(bytes_queued):
+    # the firmware acknowledges every TX_CHUNK_SIZE bytes, the last
+    # partial chunk of a job is never acknowledged
+    return bytes_queued - bytes_queued % driveboard.TX_CHUNK_SIZE
+
+
+def progress(model, bytes_processed, idle):
+    model.update(bytes_processed, idle)
+    return model.progress()
+
+
+def run_job(model, moves, byte_start):
+    byte_end = byte_start
+    for x, y in moves:
+        byte_end += 21
+        model.queue_move(x, y, None, 6000.0, byte_end)
+    return byte_end
+
+
+def test_move_time_trapezoid_and_triangle():
+    acc = driveboard.ACCELERATION
+    # long move: accelerate, cruise, decelerate
+    speed = 6000.0
+    ramp = speed**2 / (2*acc)
+    minutes = 2*speed/acc + (1000.0 - 2*ramp)/speed
+    assert planner.move_time(1000.0, 0.0, 0.0, speed) == pytest.approx(60*minutes)
+    # short move: the nominal speed is never reached
+    assert planner.move_time(0.1, 0.0, 0.0, speed) < 60*(0.1/speed + 2*speed/acc)
+
+
+def test_progress_completes_back_to_back_jobs():
+    model = planner.PlannerModel()
+    job = [(100.0, 0.0), (100.0, 100.0), (0.0, 100.0), (0.0, 0.0)]
+
+    byte_end = run_job(model, job, 0)
+    assert byte_end % driveboard.TX_CHUNK_SIZE  # a partial last chunk
+    done, total = progress(model, 0, False)
+    assert done == 0.0 and total > 0.0
+    first_total = total
+    done, total = progress(model, acked(byte_end), True)
+    assert done == total == pytest.approx(first_total)
+    assert model.job_complete
+
+    # the next job is timed on its own
+    byte_end = run_job(model, job, byte_end)
+    done, total = progress(model, acked(byte_end) - 2*driveboard.TX_CHUNK_SIZE, False)
+    assert total == pytest.approx(first_total)
+    assert done < total
+    done, total = progress(model, acked(byte_end), True)
+    assert done == total == pytest.approx(first_total)
+
+
+def test_progress_idle_before_the_last_chunk_is_not_complete():
+    # e.g. an idle status from before the job was sent
+    model = planner.PlannerModel()
+    byte_end = run_job(model, [(100.0, 0.0), (100.0, 100.0)], 0)
+    done, total = progress(model, 0, True)
+    assert done < total
+    assert not model.job_complete
+    done, total = progress(model, acked(byte_end), True)
+    assert done == total
+
+
+def test_progress_is_a_query():
+    model = planner.PlannerModel()
+    byte_end = run_job(model, [(100.0, 0.0), (100.0, 100.0)], 0)
+    assert model.progress() == (0.0, 0.0)  # queued, not planned yet
+    model.update(acked(byte_end), True)
+    done, total = model.progress()
+    assert done == total > 0.0
+    assert model.progress() == (done, total)
+    # the next job is planned at the next update
+    run_job(model, [(0.0, 0.0)], byte_end)
+    assert model.progress() == (done, total)
+    model.update(acked(byte_end), False)
+    assert model.progress()[1] < total
+
+
+def test_queued_moves_are_planned_like_added_moves():
+    moves = []
+    byte_end = 0
+    for i in range(3*planner.PLAN_BATCH // 2):
+        byte_end += 21
+        # zig-zag with a few repeated (ignored) and relative moves
+        moves.append(((i % 7)*3.0, (i % 5)*2.0, None, 2000.0 + 100*(i % 3), byte_end))
+        if i % 50 == 0:
+            moves.append(moves[-1])
+    eager = planner.PlannerModel()
+    lazy = planner.PlannerModel()
+    for i, move in enumerate(moves):
+        if i == 1000:
+            eager.relative = True
+            lazy.set_relative(True)
+        eager.add_move(*move)
+        lazy.queue_move(*move)
+    assert len(lazy.byte_ends) > 0  # a full batch was planned on the way
+    eager.finish()
+    lazy.finish()
+    assert lazy.time_ends == eager.time_ends
+    assert lazy.byte_ends == eager.byte_ends
+    assert lazy.position == eager.position
@@ -0,0 +1,65 @@
+import random
+from array import array
+
+import pytest
+
+from filereaders import polylines
+
+
+MAT = [0.8, -0.6, 0.3, 1.2, 15.0, -7.5]
+
+
+def reference(mat, coords, dims):
+    a, b, c, d, e, f = mat
+    res = list(coords)
+    for i in range(0, len(coords), dims):
+        x, y = coords[i], coords[i+1]
+        res[i] = a*x + c*y + e
+        res[i+1] = b*x + d*y + f
+    return res
+
+
+def random_coords(rnd, vertices, dims):
+    return array('d', [rnd.uniform(-500, 500) for i in range(vertices*dims)])
+
+
+def check_transform(vertices, dims):
+    rnd = random.Random(vertices*dims)
+    coords = random_coords(rnd, vertices, dims)
+    expected = reference(MAT, coords, dims)
+    polylines.transform_coords(MAT, coords, dims)
+    assert list(coords) == pytest.approx(expected, rel=1e-12, abs=1e-12)
+    # the array stays usable (numpy must not keep the buffer exported)
+    coords.append(1.0)
+
+
+@pytest.mark.parametrize('dims', [2, 3])
+def test_loop(monkeypatch, dims):
+    monkeypatch.setattr(polylines, 'numpy', None)
+    for vertices in (0, 1, 2, polylines.SLICING_MIN_VERTICES - 1):
+        check_transform(vertices, dims)
+
+
+@pytest.mark.parametrize('dims', [2, 3])
+def test_slicing(monkeypatch, dims):
+    monkeypatch.setattr(polylines, 'numpy', None)
+    for vertices in (polylines.SLICING_MIN_VERTICES, polylines.NUMPY_MIN_VERTICES, 1000):
+        check_transform(vertices, dims)
+
+
+@pytest.mark.skipif(polylines.numpy is None, reason='numpy not installed')
+@pytest.mark.parametrize('dims', [2, 3])
+def test_numpy(dims):
+    for vertices in (polylines.NUMPY_MIN_VERTICES, 1000):
+        check_transform(vertices, dims)
+
+
+def test_polylines_transform():
+    paths = polylines.Polylines.from_list([
+        [[0.0, 0.0], [10.0, 0.0], [10.0, 5.0]],
+        [[float(i), float(i % 3)] for i in range(200)]])
+    offsets = list(paths.offsets)
+    expected = reference(MAT, paths.coords, 2)
+    paths.transform(MAT)
+    assert list(paths.offsets) == offsets
+    assert list(paths.coords) == pytest.approx(expected, rel=1e-12, abs=1e-12)
@@ -0,0 +1,140 @@
+import base64
+
+import pytest
+
+import driveboard
+import gcode
+import rasterjob
+
+
+class RecordingDriveboard:
+    """Collects the firmware bytes, as Driveboard.send_move() encodes them"""
+    fw_stopped = False
+
+    def __init__(self):
+        self.sent = bytearray()
+        self.fwbuf_bytes_queued = 0
+
+    def is_connected(self):
+        return True
+
+    def send_move(self, params, command=None):
+        self._send(driveboard.encode_move(params, command))
+
+    def send_raster_data(self, data):
+        self._send(driveboard.encode_raster_data(data))
+
+    def _send(self, data):
+        self.sent += data
+        self.fwbuf_bytes_queued += len(data)
+
+
+def make_gcode(pixels, w, h, params):
+    """makeGcode() from frontend/admin/rasterlib.service.js"""
+    result = []
+    pos = {}
+
+    def move(x, y, feedrate):
+        result.append('G0 X%.3f Y%.3f F%.3f' % (x, y, feedrate))
+        pos['x'], pos['y'] = x, y
+
+    def raster_move(target_x, target_y, feedrate, data):
+        bytes_total = len(data)
+        first = True
+        while data:
+            chunk, data = data[:60], data[60:]
+            fac = len(data) / bytes_total
+            px = fac*pos['x'] + (1-fac)*target_x
+            py = fac*pos['y'] + (1-fac)*target_y
+            feedrate_param = ''
+            if first:
+                first = False
+                feedrate_param = ' F%.3f' % feedrate
+            result.append('G7 X%.3f Y%.3f%s V1 D%s' % (
+                px, py, feedrate_param, base64.b64encode(chunk).decode('ascii')))
+        pos['x'], pos['y'] = target_x, target_y
+
+    ppmm = params['ppmm']
+    lead_in = params['lead_in']
+    result.append('S0')
+    direction = +1
+    for lineno in range(h):
+        y = params['pos_y'] + lineno/ppmm
+        x = params['pos_x']
+        data = pixels[w*lineno:w*(lineno+1)]
+
+        if params['skip_empty']:
+            nonzero = [i for i, v in enumerate(data) if v != 0]
+            if not nonzero:
+                continue
+            x += nonzero[0]/ppmm
+            data = data[nonzero[0]:nonzero[-1]+1]
+
+        if direction == -1:
+            data = data[::-1]
+            x += (len(data)-1)/ppmm
+
+        move(x - direction*lead_in, y, params['travel_feedrate'])
+        move(x, y, params['raster_feedrate'])
+        x += direction*len(data)/ppmm
+        raster_move(x, y, params['raster_feedrate'], data)
+        move(x + direction*lead_in, y, params['raster_feedrate'])
+
+        if params['bidirectional']:
+            direction *= -1
+    return result
+
+
+def make_lsr1(pixels, w, h, params):
+    flags = 0
+    if params['bidirectional']:
+        flags |= rasterjob.FLAG_BIDIRECTIONAL
+    if params['skip_empty']:
+        flags |= rasterjob.FLAG_SKIP_EMPTY
+    pitch = 1.0 / params['ppmm']
+    return rasterjob.HEADER.pack(
+        rasterjob.MAGIC, w, h, params['pos_x'], params['pos_y'], pitch, pitch,
+        params['raster_feedrate'], params['travel_feedrate'], params['lead_in'],
+        flags) + pixels
+
+
+def small_image():
+    # 130 pixels per line (three G7 chunks), margins, an empty line
+    w = 130
+    lines = [
+        bytes(5) + bytes(range(1, 121)) + bytes(5),
+        bytes(w),
+        bytes([127]) * w,
+        bytes(70) + bytes([3, 0, 9]) + bytes(57),
+        bytes(i % 128 for i in range(w)),
+    ]
+    return b''.join(lines), w, len(lines)
+
+
+@pytest.mark.parametrize('bidirectional', [False, True])
+@pytest.mark.parametrize('skip_empty', [False, True])
+def test_binary_job_matches_gcode(bidirectional, skip_empty):
+    pixels, w, h = small_image()
+    # pitch 1/8 mm keeps all coordinates exact at 3 decimals
+    params = dict(pos_x=10.0, pos_y=20.0, ppmm=8, lead_in=2.5,
+                  raster_feedrate=3000.0, travel_feedrate=6000.0,
+                  bidirectional=bidirectional, skip_empty=skip_empty)
+
+    gcode_board = gcode.DriveboardGcode(None, None, board=RecordingDriveboard())
+    for line in make_gcode(pixels, w, h, params):
+        assert gcode_board.gcode_line(line) == 'ok', line
+
+    job_board = gcode.DriveboardGcode(None, None, board=RecordingDriveboard())
+    job = rasterjob.RasterJob(job_board)
+    data = make_lsr1(pixels, w, h, params)
+    # in uneven pieces, like a streamed request body
+    for i in range(0, len(data), 97):
+        job.feed(data[i:i+97])
+        while job.process_line():
+            pass
+    job.finish()
+
+    assert job_board.driveboard.sent == gcode_board.driveboard.sent
+    for board in (gcode_board, job_board):
+        board.planner.update(0, False)
+    assert job_board.planner.progress() == pytest.approx(gcode_board.planner.progress())
@@ -0,0 +1,73 @@
+import random
+
+from ringbuffer import RingBuffer
+
+
+def test_fifo_order_across_wraparound():
+    queue = RingBuffer(8)
+    queue.extend(b'abcdef')
+    assert queue.read(4) == b'abcd'
+    queue.extend(b'ghijk')  # wraps around the end of the buffer
+    assert len(queue) == 7
+    assert queue.read(100) == b'efghijk'
+    assert not queue
+    assert queue.read(1) == b''
+
+
+def test_grow_keeps_queued_bytes():
+    queue = RingBuffer(4)
+    queue.extend(b'abc')
+    queue.read(2)
+    queue.extend(b'defghij')  # wrapped, then grown
+    assert len(queue.buf) >= 8
+    assert queue.read(8) == b'cdefghij'
+
+
+def test_peek_and_consume():
+    queue = RingBuffer(8)
+    queue.extend(b'abcdef')
+    queue.read(5)
+    queue.extend(b'ghijk')
+    view = queue.peek()
+    assert bytes(view) == b'fgh'  # up to the end of the buffer
+    view.release()
+    queue.consume(3)
+    assert bytes(queue.peek()) == b'ijk'
+    queue.consume(10)
+    assert len(queue) == 0 and queue.start == 0
+
+
+def test_clear():
+    queue = RingBuffer(8)
+    queue.extend(b'abcdef')
+    queue.clear()
+    assert not queue
+    queue.extend(b'xy')
+    assert queue.read(2) == b'xy'
+
+
+def test_random_operations_match_bytearray():
+    rnd = random.Random(1)
+    queue = RingBuffer(16)
+    reference = bytearray()
+    for _ in range(5000):
+        op = rnd.random()
+        if op < 0.4:
+            data = bytes(rnd.getrandbits(8) for _ in range(rnd.randrange(40)))
+            queue.extend(data)
+            reference += data
+        elif op < 0.7:
+            n = rnd.randrange(50)
+            assert queue.read(n) == bytes(reference[:n])
+            del reference[:n]
+        else:
+            view = queue.peek()
+            chunk = bytes(view)
+            view.release()
+            assert reference.startswith(chunk)
+            assert chunk or not reference
+            n = rnd.randrange(len(chunk) + 1)
+            queue.consume(n)
+            del reference[:n]
+        assert len(queue) == len(reference)
+        assert bool(queue) == bool(reference)
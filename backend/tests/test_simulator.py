@@ -0,0 +1,41 @@
+import base64
+
+import pytest
+
+import simulator
+
+JOB = [
+    'G90', 'G0 X10 Y10', 'G1 X20 S100 F1000', 'G1 X20 Y30',
+    'G7 X30 V1 D' + base64.b64encode(bytes(range(50))).decode(),
+    'G0 X0 Y0', 'G30', 'G0 X5 Y5',
+]
+
+
+def simulate(keep_moves):
+    sim = simulator.Simulation(keep_moves)
+    for line in JOB:
+        assert sim.gcode_line(line) == 'ok'
+    return sim, sim.result()
+
+
+def test_moves_are_only_kept_on_request():
+    sim, res = simulate(False)
+    assert sim.firmware.moves == []
+    assert 'breakdown' not in res
+    assert res['burn']['moves'] == 2 and res['raster']['moves'] == 1
+
+
+def test_totals_match_the_breakdown():
+    sim, res = simulate(True)
+    breakdown = res['breakdown']
+    for kind in ('seek', 'burn', 'raster', 'homing'):
+        moves = [move for move in breakdown if move['type'] == kind]
+        assert res[kind]['moves'] == len(moves)
+        assert res[kind]['distance'] == pytest.approx(sum(move['distance'] for move in moves))
+        assert res[kind]['time'] == pytest.approx(sum(move['time'] for move in moves))
+    assert res['laser_time'] == pytest.approx(sum(move['laser_time'] for move in breakdown))
+    assert res['bbox'] == [10.0, 10.0, 30.0, 30.0]
+    # the same without the breakdown
+    sim, summary = simulate(False)
+    del res['breakdown']
+    assert summary == res
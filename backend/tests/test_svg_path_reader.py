@@ -0,0 +1,112 @@
+import random
+from array import array
+
+import pytest
+
+from filereaders import SVGReader
+from filereaders.svg_path_reader import SVGPathReader
+
+
+# The recursive subdivision from before the iterative addCubicBezier
+# and addQuadraticBezier, as the reference.
+
+def cubic_reference(tolerance2, subpath, x1, y1, x2, y2, x3, y3, x4, y4, level):
+    if level > 18:
+        return
+    elif level == 0:
+        if (x1 == x2 and y1 == y2 and x2 == x3 and y2 == y3) or \
+           (x2 == x3 and y2 == y3 and x3 == x4 and y3 == y4):
+            subpath.extend((x4, y4))
+            return
+    x12   = (x1 + x2) / 2.0
+    y12   = (y1 + y2) / 2.0
+    x23   = (x2 + x3) / 2.0
+    y23   = (y2 + y3) / 2.0
+    x34   = (x3 + x4) / 2.0
+    y34   = (y3 + y4) / 2.0
+    x123  = (x12 + x23) / 2.0
+    y123  = (y12 + y23) / 2.0
+    x234  = (x23 + x34) / 2.0
+    y234  = (y23 + y34) / 2.0
+    x1234 = (x123 + x234) / 2.0
+    y1234 = (y123 + y234) / 2.0
+    dx = x4-x1
+    dy = y4-y1
+    d2 = abs(((x2 - x4) * dy - (y2 - y4) * dx))
+    d3 = abs(((x3 - x4) * dy - (y3 - y4) * dx))
+    if (d2+d3)**2 < 5.0 * tolerance2 * (dx*dx + dy*dy):
+        subpath.extend((x1234, y1234))
+        return
+    cubic_reference(tolerance2, subpath, x1, y1, x12, y12, x123, y123, x1234, y1234, level+1)
+    cubic_reference(tolerance2, subpath, x1234, y1234, x234, y234, x34, y34, x4, y4, level+1)
+
+
+def quadratic_reference(tolerance2, subpath, x1, y1, x2, y2, x3, y3, level):
+    if level > 18:
+        return
+    x12   = (x1 + x2) / 2.0
+    y12   = (y1 + y2) / 2.0
+    x23   = (x2 + x3) / 2.0
+    y23   = (y2 + y3) / 2.0
+    x123  = (x12 + x23) / 2.0
+    y123  = (y12 + y23) / 2.0
+    dx = x3-x1
+    dy = y3-y1
+    d = abs(((x2 - x3) * dy - (y2 - y3) * dx))
+    if d*d <= 5.0 * tolerance2 * (dx*dx + dy*dy):
+        subpath.extend((x123, y123))
+        return
+    quadratic_reference(tolerance2, subpath, x1, y1, x12, y12, x123, y123, level + 1)
+    quadratic_reference(tolerance2, subpath, x123, y123, x23, y23, x3, y3, level + 1)
+
+
+def path_reader(tolerance):
+    return SVGPathReader(SVGReader(tolerance, [1220, 610]))
+
+
+def random_points(rnd, n):
+    return [rnd.choice([rnd.uniform(-100, 100), rnd.randint(-3, 3)]) for i in range(2*n)]
+
+
+@pytest.mark.parametrize('tolerance', [0.001, 0.08, 5.0])
+def test_cubic_matches_recursive(tolerance):
+    rnd = random.Random(10)
+    reader = path_reader(tolerance)
+    curves = [random_points(rnd, 4) for i in range(500)]
+    # straight and degenerate curves
+    curves += [[0, 0, 0, 0, 0, 0, 5, 5], [0, 0, 5, 5, 5, 5, 5, 5],
+               [0, 0, 1, 1, 2, 2, 3, 3], [1, 1, 1, 1, 1, 1, 1, 1],
+               [0, 0, 10, 10, 0, 10, 0, 0]]
+    for coords in curves:
+        for level in (0, 17):
+            subpath = array('d', coords[:2])
+            reader.addCubicBezier(subpath, *(coords + [level]))
+            expected = array('d', coords[:2])
+            cubic_reference(reader._tolerance2, expected, *(coords + [level]))
+            assert subpath == expected
+
+
+@pytest.mark.parametrize('tolerance', [0.001, 0.08, 5.0])
+def test_quadratic_matches_recursive(tolerance):
+    rnd = random.Random(11)
+    reader = path_reader(tolerance)
+    curves = [random_points(rnd, 3) for i in range(500)]
+    curves += [[0, 0, 0, 0, 5, 5], [0, 0, 5, 5, 5, 5],
+               [1, 1, 1, 1, 1, 1], [0, 0, 10, 10, 0, 0]]
+    for coords in curves:
+        for level in (0, 17):
+            subpath = array('d', coords[:2])
+            reader.addQuadraticBezier(subpath, *(coords + [level]))
+            expected = array('d', coords[:2])
+            quadratic_reference(reader._tolerance2, expected, *(coords + [level]))
+            assert subpath == expected
+
+
+def test_depth_limit():
+    # a curve that never gets flat enough stops at 2**18 segments
+    reader = path_reader(1e-9)
+    subpath = array('d', [0.0, 0.0])
+    reader.addCubicBezier(subpath, 0.0, 0.0, 0.0, 1000.0, 1000.0, 1000.0, 1000.0, 0.0, 8)
+    expected = array('d', [0.0, 0.0])
+    cubic_reference(reader._tolerance2, expected, 0.0, 0.0, 0.0, 1000.0, 1000.0, 1000.0, 1000.0, 0.0, 8)
+    assert subpath == expected
@@ -0,0 +1,69 @@
+import io
+import os
+
+import pytest
+
+from filereaders import SVGReader
+
+
+TEST_SVGS = os.path.join(os.path.dirname(__file__), '..', 'original', 'test_svgs')
+
+# nested groups with transforms, lasertags in text tags (also in a
+# group and in tspans), ignored tags and text that is no lasertag
+NESTED_SVG = b'''<?xml version="1.0"?>
+<svg xmlns="http://www.w3.org/2000/svg" width="200mm" height="100mm" viewBox="10 5 400 200">
+  <g transform="translate(20,10) rotate(30)" stroke="#ff0000">
+    <path d="M 0,0 C 10,40 50,40 60,0 Q 80,-30 100,0" fill="none"/>
+    <g transform="scale(2,0.5) matrix(1,0.2,0,1,5,5)" style="stroke:#0000ff">
+      <rect x="1" y="2" width="30" height="20" rx="4"/>
+      <g transform="skewX(10)">
+        <circle cx="50" cy="50" r="12"/>
+        <text x="0" y="0">=pass2:1200:80:#0000ff=</text>
+      </g>
+    </g>
+    <polyline points="0,0 10,10 20,0 30,10"/>
+  </g>
+  <metadata><path d="M 0,0 L 100,100" stroke="#00ff00"/></metadata>
+  <text x="5" y="5">=pass1:550mm/min:90%:#ff0000=<tspan>=pass3:4000:100:#000000=</tspan>
+    not a tag<tspan/></text>
+  <text>just text</text>
+  <ellipse cx="150" cy="100" rx="40" ry="20" stroke="#000000" transform="rotate(-15 150 100)"/>
+</svg>
+'''
+
+
+def results(parse_results):
+    res = dict(parse_results)
+    res['boundarys'] = dict((color, paths.tolist())
+                            for color, paths in parse_results['boundarys'].items())
+    return res
+
+
+@pytest.mark.parametrize('name', ['full-bed.svg', 'rosetta.svg'])
+def test_parse_stream_matches_parse(name):
+    path = os.path.join(TEST_SVGS, name)
+    with open(path, 'rb') as f:
+        svgstring = f.read()
+    expected = results(SVGReader(0.08, [1220, 610]).parse(svgstring.decode('utf-8')))
+    assert expected['boundarys']
+    # from a file name and from a file object
+    assert results(SVGReader(0.08, [1220, 610]).parse_stream(path)) == expected
+    assert results(SVGReader(0.08, [1220, 610]).parse_stream(io.BytesIO(svgstring))) == expected
+    if name == 'rosetta.svg':
+        assert [tag[0] for tag in expected['lasertags']] == [1, 2, 3]
+
+
+def test_parse_stream_nested_groups_and_text():
+    expected = results(SVGReader(0.08, [1220, 610]).parse(NESTED_SVG.decode('utf-8')))
+    assert sorted(expected['boundarys']) == ['#000000', '#0000ff', '#ff0000']
+    assert [tag[0] for tag in expected['lasertags']] == [2, 1, 3]
+    assert results(SVGReader(0.08, [1220, 610]).parse_stream(io.BytesIO(NESTED_SVG))) == expected
+
+
+def test_parse_stream_progress():
+    fractions = []
+    with open(os.path.join(TEST_SVGS, 'full-bed.svg'), 'rb') as f:
+        SVGReader(0.08, [1220, 610]).parse_stream(f, progress=fractions.append)
+    assert len(fractions) > 2
+    assert fractions == sorted(fractions)
+    assert 0.0 < fractions[0] and fractions[-1] <= 1.0
@@ -0,0 +1,88 @@
+import driveboard
+import underruns
+from simulator import encode_param
+
+
+def job_log():
+    # a seek, then raster moves of 100 bytes each
+    log = underruns.UnderrunLog()
+    log.on_move(0, 'seek')
+    for start in range(20, 420, 100):
+        log.on_move(start, 'raster')
+    return log
+
+
+def test_underruns_are_counted_per_move_type():
+    log = job_log()
+    log.on_report(7, 0)  # the first report is the baseline
+    assert log.summary()['total'] == 0
+    log.on_report(8, 10)
+    log.on_report(10, 150)
+    log.on_report(10, 200)  # unchanged
+    assert log.summary() == {'seek': 1, 'burn': 0, 'raster': 2, 'total': 3}
+    assert [entry[1:] for entry in log.job['series']] == [[1, 'seek', 10], [2, 'raster', 150]]
+
+
+def test_counter_wraps_around():
+    log = job_log()
+    log.on_report(65535, 0)
+    log.on_report(1, 100)
+    assert log.summary()['total'] == 2
+
+
+def test_end_job_drops_the_underrun_after_the_job():
+    log = job_log()
+    log.on_report(0, 0)
+    log.on_report(1, 100)
+    # the firmware read the whole job (420 bytes), then waited for more
+    log.on_report(2, 420)
+    log.end_job(420)
+    assert log.job is None
+    job = log.jobs[-1]
+    assert job['underruns'] == 1 and job['by_type']['raster'] == 1
+    # the empty series entry is gone
+    assert [entry[1:] for entry in job['series']] == [[1, 'raster']]
+    assert log.summary()['total'] == 1
+
+
+def test_end_job_keeps_underruns_within_the_job():
+    log = job_log()
+    log.on_report(0, 0)
+    log.on_report(1, 300)
+    log.end_job(420)
+    assert log.jobs[-1]['underruns'] == 1
+    assert log.report() == {'jobs': [log.jobs[-1]], 'running': False}
+
+
+def status(*params, idle=True):
+    frame = bytearray()
+    if idle:
+        frame.append(driveboard.INFO_IDLE_YES)
+    for marker, value in params:
+        frame += encode_param(marker, value)
+    frame.append(driveboard.STATUS_END)
+    return bytes(frame)
+
+
+def test_status_replies_are_matched_to_their_requests():
+    board = driveboard.Driveboard('unused', 57600)
+    board.status_timer.stop()
+    log = board.underrun_log
+    log.on_move(0, 'burn')
+
+    board.fwbuf_bytes_queued = 50  # the job is partially sent
+    board._request_status('CMD_STATUS')
+    board.fwbuf_bytes_queued = 100  # all of it
+    board._request_status('CMD_STATUS')
+
+    # a superstatus nobody asked for (e.g. after a firmware reset) does
+    # not answer the first request
+    board._serial_received(status((driveboard.INFO_VERSION, 1.0)))
+    assert log.job is not None
+    # about the first 50 bytes, the firmware was idle for a moment
+    board._serial_received(status())
+    assert log.job is not None
+    # about the whole job
+    board._serial_received(status())
+    assert log.job is None and len(log.jobs) == 1
+    assert not board.status_requests
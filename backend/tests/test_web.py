@@ -0,0 +1,360 @@
+import datetime
+import json
+import struct
+import time
+from unittest import mock
+
+import tornado.web
+import tornado.websocket
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, gen_test
+
+import emulator
+import gcode
+import web
+
+
+class GcodeHandlerTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.board = gcode.DriveboardGcode(None, None, board=emulator.EmulatedDriveboard(speedup=10.0))
+        self.board.connect()
+        return tornado.web.Application([(r"/gcode", web.GcodeHandler, dict(board=self.board))])
+
+    def tearDown(self):
+        self.board.driveboard.disconnect('test done')
+        super().tearDown()
+
+    def post(self, body):
+        return self.http_client.fetch(self.get_url('/gcode'), method='POST', body=body,
+                                      headers={'Content-Type': 'text/plain'}, raise_error=False)
+
+    @gen_test(timeout=5)
+    def test_pause_does_not_wait_for_the_job_upload(self):
+        # a job upload holds the lock until it is queued completely
+        lock = web.GcodeHandler.gcode_sender_lock
+        yield lock.acquire()
+        try:
+            resp = yield self.post('!pause')
+            self.assertEqual(resp.code, 200)
+            self.assertTrue(self.board.driveboard.paused)
+            resp = yield self.post('!unpause\n')
+            self.assertEqual(resp.code, 200)
+            self.assertFalse(self.board.driveboard.paused)
+            # other lines still wait
+            job = self.post('G0 X1\n')
+            yield gen.sleep(0.2)
+            self.assertFalse(job.done())
+        finally:
+            lock.release()
+        resp = yield job
+        self.assertEqual(resp.code, 200)
+
+    @gen_test(timeout=5)
+    def test_job_releases_the_lock(self):
+        resp = yield self.post('G0 X1\nG0 X2\n')
+        self.assertEqual(resp.code, 200)
+        lock = web.GcodeHandler.gcode_sender_lock
+        yield lock.acquire(timeout=datetime.timedelta(seconds=0.1))
+        lock.release()
+        self.assertFalse(self.board.uploading)
+
+
+class GcodeBatchTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.board = gcode.DriveboardGcode(None, None, board=emulator.EmulatedDriveboard(speedup=10.0))
+        self.board.connect()
+        self.lines = []
+        gcode_line = self.board.gcode_line
+        def record(line):
+            self.lines.append(line)
+            return gcode_line(line)
+        self.board.gcode_line = record
+        return tornado.web.Application([(r"/gcode", web.GcodeHandler, dict(board=self.board))])
+
+    def tearDown(self):
+        self.board.driveboard.disconnect('test done')
+        super().tearDown()
+
+    @gen.coroutine
+    def post_observed(self, body):
+        """Post body, return the numbers of lines seen by other callbacks"""
+        response = self.http_client.fetch(self.get_url('/gcode'), method='POST', body=body,
+                                          headers={'Content-Type': 'text/plain'})
+        seen = set()
+        while not response.done():
+            seen.add(len(self.lines))
+            yield gen.moment
+        yield response
+        return seen
+
+    @gen_test(timeout=5)
+    def test_lines_within_the_window_are_one_batch(self):
+        body = ''.join('G0 X%d Y1\n' % i for i in range(200))
+        with mock.patch.object(web, 'BATCH_SECONDS', 10.0):
+            seen = yield self.post_observed(body)
+        self.assertEqual(self.lines, body.splitlines())
+        # the first line is processed on its own (see process_one_line)
+        self.assertTrue(seen <= {0, 1, 200}, sorted(seen))
+
+    @gen_test(timeout=5)
+    def test_other_callbacks_run_between_batches(self):
+        body = ''.join('G0 X%d Y1\n' % i for i in range(200))
+        with mock.patch.object(web, 'BATCH_SECONDS', 0.0), \
+             mock.patch.object(self.board, 'needs_refill', return_value=False):
+            seen = yield self.post_observed(body)
+        self.assertEqual(self.lines, body.splitlines())
+        self.assertGreater(len(seen - {0, 1, 200}), 100)
+
+
+class SimulateHandlerTest(AsyncHTTPTestCase):
+    def get_app(self):
+        return tornado.web.Application([(r"/gcode/simulate", web.SimulateHandler)])
+
+    def post(self, body):
+        return self.http_client.fetch(self.get_url('/gcode/simulate'), method='POST', body=body,
+                                      headers={'Content-Type': 'text/plain'}, raise_error=False)
+
+    @gen_test(timeout=5)
+    def test_last_line_without_newline_is_simulated(self):
+        resp = yield self.post('G0X10\nG1X20S100')
+        self.assertEqual(resp.code, 200)
+        res = json.loads(resp.body)
+        self.assertEqual(res['lines'], 2)
+        self.assertAlmostEqual(res['burn_distance'], 10.0)
+
+    @gen_test(timeout=5)
+    def test_error_in_the_last_line(self):
+        resp = yield self.post('G0X10\nG99')
+        self.assertEqual(resp.code, 400)
+        self.assertTrue(resp.body.startswith(b'line 2: '))
+
+
+def test_time_total_is_extrapolated_while_uploading():
+    board = gcode.DriveboardGcode(None, None, board=emulator.EmulatedDriveboard())
+    board.planner.add_move(100.0, 0.0, None, 6000.0, 100)
+    board.planner.finish()
+    total = board.get_status()['queue']['time_total']
+    board.upload_progress(0.25)
+    queue = board.get_status()['queue']
+    assert queue['upload_percent'] == 25.0
+    assert queue['time_total'] == round(4*total, 1)
+    board.upload_progress(None)  # unknown size
+    assert board.get_status()['queue']['upload_percent'] is None
+    board.upload_done()
+    queue = board.get_status()['queue']
+    assert queue['upload_percent'] == 100.0 and queue['time_total'] == total
+
+
+class StatusBoard:
+    """Just the status, for the websockets"""
+    def __init__(self):
+        self.status = {'ready': True, 'queue': 0, 'pos': {'x': 0.0, 'y': 0.0, 'z': 0.0}}
+        self.status_listeners = []
+
+    def get_status(self):
+        return json.loads(json.dumps(self.status))  # a copy
+
+    def add_status_listener(self, listener):
+        self.status_listeners.append(listener)
+
+
+class StatusWebsocketTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.board = StatusBoard()
+        # fresh class state, broadcasts only when the test calls it
+        patcher = mock.patch.multiple(
+            web.StatusWebsocket, create=True, started=True, board=self.board,
+            clients=set(), status=None, message=None, heartbeat_due=0.0, HEARTBEAT=0.2,
+            totals={'sent': 0, 'dropped': 0, 'evicted': 0})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return tornado.web.Application([(r"/ws/status", web.StatusWebsocket, dict(board=self.board))])
+
+    @gen.coroutine
+    def connect(self, query=''):
+        url = 'ws://127.0.0.1:%d/ws/status%s' % (self.get_http_port(), query)
+        conn = yield tornado.websocket.websocket_connect(url)
+        return conn
+
+    @gen.coroutine
+    def read(self, conn):
+        message = yield conn.read_message()
+        return json.loads(message)
+
+    @gen_test(timeout=5)
+    def test_full_status_on_connect(self):
+        delta = yield self.connect('?delta=1')
+        self.assertEqual((yield self.read(delta)), self.board.status)
+        # also when nothing changed since the last broadcast
+        self.board.status['queue'] = 5
+        web.StatusWebsocket.broadcast()
+        self.assertEqual((yield self.read(delta)), {'queue': 5})
+        late = yield self.connect('?delta=1')
+        self.assertEqual((yield self.read(late)), self.board.status)
+        full = yield self.connect()
+        self.assertEqual((yield self.read(full)), self.board.status)
+
+    @gen_test(timeout=5)
+    def test_delta_omits_unchanged_fields(self):
+        delta = yield self.connect('?delta=1')
+        full = yield self.connect()
+        yield self.read(delta)
+        yield self.read(full)
+        self.board.status['ready'] = False
+        self.board.status['pos']['y'] = 12.5
+        web.StatusWebsocket.broadcast()
+        self.assertEqual((yield self.read(delta)), {'ready': False, 'pos': {'y': 12.5}})
+        self.assertEqual((yield self.read(full)), self.board.status)
+
+    @gen_test(timeout=5)
+    def test_heartbeat(self):
+        delta = yield self.connect('?delta=1')
+        full = yield self.connect()
+        yield self.read(delta)
+        yield self.read(full)
+        # nothing changed: only the full client gets a message
+        web.StatusWebsocket.broadcast()
+        self.assertEqual((yield self.read(full)), self.board.status)
+        self.board.status['queue'] = 1
+        web.StatusWebsocket.broadcast()
+        self.assertEqual((yield self.read(delta)), {'queue': 1})
+        # an empty object after HEARTBEAT seconds without changes
+        yield gen.sleep(web.StatusWebsocket.HEARTBEAT)
+        web.StatusWebsocket.broadcast()
+        self.assertEqual((yield self.read(delta)), {})
+        web.StatusWebsocket.broadcast()
+        self.board.status['queue'] = 2
+        web.StatusWebsocket.broadcast()
+        self.assertEqual((yield self.read(delta)), {'queue': 2})
+
+
+class RecordingWebsocket(web.BroadcastWebsocket):
+    """A BroadcastWebsocket without a connection, the test completes the writes"""
+    clients = set()
+    totals = None
+
+    def __init__(self):
+        self.request = mock.Mock(remote_ip='127.0.0.1')
+        self.written = []  # (message, future)
+        self.closed = False
+
+    def write_message(self, message, binary=False):
+        future = Future()
+        self.written.append((message, future))
+        return future
+
+    def close(self, code=None, reason=None):
+        self.closed = True
+
+    def complete_write(self):
+        self.written[-1][1].set_result(None)
+
+
+class BroadcastWebsocketTest(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        RecordingWebsocket.clients = set()
+        RecordingWebsocket.totals = {'sent': 0, 'dropped': 0, 'evicted': 0}
+        self.client = RecordingWebsocket()
+        self.client.open()
+
+    def messages(self):
+        return [message for message, future in self.client.written]
+
+    @gen_test
+    def test_queued_messages_are_coalesced(self):
+        client = self.client
+        client.send('1')
+        # while '1' is in flight, only the latest message waits
+        client.send('2')
+        client.send('3')
+        client.send('delta 4', 'full 4')
+        self.assertEqual(self.messages(), ['1'])
+        client.complete_write()
+        yield gen.moment
+        self.assertEqual(self.messages(), ['1', 'full 4'])
+        client.complete_write()
+        yield gen.moment
+        client.send('5')
+        self.assertEqual(self.messages(), ['1', 'full 4', '5'])
+        self.assertEqual((client.sent, client.dropped), (3, 2))
+        report = RecordingWebsocket.report()
+        self.assertEqual((report['sent'], report['dropped'], report['evicted']), (3, 2, 0))
+        self.assertEqual(report['clients'][0]['remote_ip'], '127.0.0.1')
+
+    @gen_test
+    def test_stalled_client_is_dropped(self):
+        client = self.client
+        client.send('1')
+        now = time.time()
+        with mock.patch('time.time', return_value=now + web.BroadcastWebsocket.MAX_BEHIND - 0.1):
+            client.send('2')
+        self.assertFalse(client.closed)
+        self.assertIn(client, RecordingWebsocket.clients)
+        with mock.patch('time.time', return_value=now + web.BroadcastWebsocket.MAX_BEHIND + 0.1):
+            client.send('3')
+        self.assertTrue(client.closed)
+        self.assertNotIn(client, RecordingWebsocket.clients)
+        self.assertEqual(RecordingWebsocket.totals['evicted'], 1)
+        # nothing more for an evicted client
+        client.complete_write()
+        yield gen.moment
+        self.assertEqual(self.messages(), ['1'])
+
+
+class PositionBoard:
+    def __init__(self):
+        self.position_listeners = []
+
+    def add_position_listener(self, listener):
+        self.position_listeners.append(listener)
+
+
+class PositionWebsocketTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.board = PositionBoard()
+        patcher = mock.patch.multiple(
+            web.PositionWebsocket, started=False, clients=set(),
+            totals={'sent': 0, 'dropped': 0, 'evicted': 0})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return tornado.web.Application([(r"/ws/position", web.PositionWebsocket, dict(board=self.board))])
+
+    @gen.coroutine
+    def connect(self, query=''):
+        url = 'ws://127.0.0.1:%d/ws/position%s' % (self.get_http_port(), query)
+        conn = yield tornado.websocket.websocket_connect(url)
+        # open() has run when the server sees the client
+        while len(web.PositionWebsocket.clients) < self.expected_clients:
+            yield gen.moment
+        return conn
+
+    @gen_test(timeout=5)
+    def test_samples_and_interval(self):
+        self.expected_clients = 1
+        every = yield self.connect()
+        self.expected_clients = 2
+        slow = yield self.connect('?interval=500')
+        self.assertEqual(self.board.position_listeners, [web.PositionWebsocket.broadcast])
+
+        for i in range(13):
+            timestamp = 1000.0 + i/10.0
+            web.PositionWebsocket.broadcast(timestamp, i, -i/4.0, 0.5)
+            message = yield every.read_message()
+            self.assertIsInstance(message, bytes)
+            self.assertEqual(len(message), 20)
+            self.assertEqual(struct.unpack('<dfff', message), (timestamp, i, -i/4.0, 0.5))
+            if i % 5 == 0:
+                # at most one sample per 500 ms
+                message = yield slow.read_message()
+                self.assertEqual(struct.unpack('<dfff', message)[0], timestamp)
+
+        # the grid stays despite jitter, and restarts after a gap
+        for timestamp, sent in ((1001.32, False), (1001.53, True), (1001.98, False),
+                                (1002.0, True), (1003.7, True), (1004.1, False), (1004.2, True)):
+            web.PositionWebsocket.broadcast(timestamp, 0.0, 0.0, 0.0)
+            yield every.read_message()
+            if sent:
+                message = yield slow.read_message()
+                self.assertEqual(struct.unpack('<dfff', message)[0], timestamp)
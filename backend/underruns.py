@@ -0,0 +1,130 @@
+"""Firmware buffer underruns, per job and per move type
+
+The firmware counts an underrun whenever its protocol loop finds the
+serial buffer empty, and reports the (cumulative) count in its status
+when it changed. An underrun in the middle of a job means the machine
+may have had to wait for data; on raster lines that shows as banding.
+
+UnderrunLog attributes every increase to the job and to the move that
+the firmware was reading at the time (from the firmware buffer
+position), and keeps a time series of them.
+
+Usage:
+log = UnderrunLog()
+log.on_move(bytes_queued, 'raster')  # before queuing each move
+...
+log.on_report(count, bytes_processed)  # INFO_BUFFER_UNDERRUN
+log.end_job(bytes_end)  # when the firmware is idle
+"""
+import time
+from array import array
+from bisect import bisect_right
+from collections import deque
+
+
+MOVE_TYPES = ('seek', 'burn', 'raster')
+# time series entries kept per job, later underruns are only counted
+SERIES_MAX = 10000
+# completed jobs kept for report()
+JOBS_MAX = 10
+
+
+class UnderrunLog:
+    def __init__(self):
+        self.count = None  # last count reported by the firmware
+        self.job = None
+        self.jobs = deque(maxlen=JOBS_MAX)
+        # firmware buffer position where each move starts (its
+        # parameters, and the raster data after it), and its type
+        self.move_starts = array('q')
+        self.move_types = bytearray()  # index into MOVE_TYPES
+        self.first = 0  # older entries are not needed any more
+        self.last_entry = None  # of the time series
+
+    def reset(self):
+        """After (re)connecting, the next report is the new baseline"""
+        self.count = None
+
+    def on_move(self, byte_start, move_type):
+        if self.job is None:
+            self.job = {
+                'started': time.time(),
+                'duration': 0.0,
+                'underruns': 0,
+                'by_type': dict.fromkeys(MOVE_TYPES, 0),
+                # [seconds since the start, underruns, move type, bytes processed]
+                'series': [],
+            }
+        self.move_starts.append(byte_start)
+        self.move_types.append(MOVE_TYPES.index(move_type))
+
+    def on_report(self, count, bytes_processed):
+        """The firmware reported count underruns since it started"""
+        count = int(count)
+        previous = self.count
+        self.count = count
+        if previous is None:
+            return
+        # the counter is an uint16_t, and resets with the firmware
+        new = (count - previous) % 65536
+        if not new or self.job is None:
+            return
+        # the move containing the next byte to read
+        i = bisect_right(self.move_starts, bytes_processed, self.first) - 1
+        move_type = MOVE_TYPES[self.move_types[max(i, self.first)]]
+        job = self.job
+        job['underruns'] += new
+        job['by_type'][move_type] += new
+        entry = [round(time.time() - job['started'], 3), new, move_type, bytes_processed]
+        if len(job['series']) < SERIES_MAX:
+            job['series'].append(entry)
+        self.last_entry = entry
+
+        # drop entries that are not needed any more
+        self.first = max(self.first, i)
+        if self.first > 4096 and 2*self.first > len(self.move_starts):
+            del self.move_starts[:self.first]
+            del self.move_types[:self.first]
+            self.first = 0
+
+    def end_job(self, bytes_end):
+        """The firmware has read the whole job and is idle
+
+        bytes_end is where the firmware has processed the whole job
+        (as far as known).
+        """
+        job = self.job
+        if job is None:
+            return
+        entry = self.last_entry
+        if entry is not None and entry[3] >= bytes_end:
+            # the firmware then counted one more, waiting for data
+            # after the job
+            entry[1] -= 1
+            job['underruns'] -= 1
+            job['by_type'][entry[2]] -= 1
+        job['series'] = [e[:3] for e in job['series'] if e[1]]
+        self.last_entry = None
+        job['duration'] = round(time.time() - job['started'], 3)
+        self.jobs.append(job)
+        self.job = None
+        del self.move_starts[:]
+        del self.move_types[:]
+        self.first = 0
+
+    def summary(self):
+        """Underruns of the current (or last) job, for the status"""
+        job = self.job or (self.jobs[-1] if self.jobs else None)
+        if job is None:
+            return dict(dict.fromkeys(MOVE_TYPES, 0), total=0)
+        return dict(job['by_type'], total=job['underruns'])
+
+    def report(self):
+        """The last jobs, with their time series, oldest first"""
+        jobs = list(self.jobs)
+        if self.job is not None:
+            current = dict(self.job)
+            current['series'] = [e[:3] for e in current['series']]
+            current['duration'] = round(time.time() - current['started'], 3)
+            jobs.append(current)
+        return {'jobs': jobs, 'running': self.job is not None}
@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
+import time
+import struct
 import logging
+import tornado.escape
 import tornado.options
 import tornado.web
 import tornado.websocket
@@ -8,6 +11,12 @@ from tornado import gen, locks
 
 import build
 import flash
+import rasterjob
+import simulator
+
+# uploads are processed in batches of this many seconds, between them
+# other work on the IOLoop (e.g. status updates) gets a turn
+BATCH_SECONDS = 0.005
 
 
 class FirmwareHandler(tornado.web.RequestHandler):
@@ -62,35 +71,240 @@ class StatusHandler(tornado.web.RequestHandler):
         self.write(self.board.get_status())
 
 
-class StatusWebsocket(tornado.websocket.WebSocketHandler):
+class UnderrunsHandler(StatusHandler):
+    """Firmware buffer underruns of the last jobs, with time series
+    """
+    def get(self):
+        self.write(self.board.underrun_report())
+
+
+def status_delta(old, new):
+    """The fields of status new that differ from old
+
+    Nested dicts are compared field by field, other values (e.g. the
+    list of stops) are replaced as a whole.
+    """
+    delta = {}
+    for key, value in new.items():
+        previous = old.get(key)
+        if value == previous:
+            continue
+        if isinstance(value, dict) and isinstance(previous, dict):
+            value = status_delta(previous, value)
+        delta[key] = value
+    return delta
+
+
+class BroadcastWebsocket(tornado.websocket.WebSocketHandler):
+    """Base class for websockets that send the same messages to many clients
+
+    Each client has at most one message in flight. Messages for a
+    client that has not taken the previous one yet are coalesced: only
+    the latest one waits, older ones are dropped. A client that has not
+    taken a message for MAX_BEHIND seconds is disconnected. See
+    report() for the counters.
+
+    Subclasses have their own clients and totals.
+    """
+    MAX_BEHIND = 5.0  # seconds
+    clients = None
+    totals = None
+
+    def open(self):
+        self.sending_since = None  # the message in flight was written then
+        self.waiting = None  # the next message, while one is in flight
+        self.sent = 0
+        self.dropped = 0
+        self.clients.add(self)
+
+    def on_close(self):
+        self.clients.discard(self)
+
+    def send(self, message, latest=None):
+        """Send message, or keep latest (default: message) if the client is behind"""
+        if self.sending_since is None:
+            self._write(message)
+            return
+        if self.waiting is not None:
+            self.dropped += 1
+            self.totals['dropped'] += 1
+        self.waiting = message if latest is None else latest
+        if time.time() - self.sending_since > self.MAX_BEHIND:
+            logging.warning('%s: evicting %s, no message taken for %.1f s (%d dropped)',
+                            type(self).__name__, self.request.remote_ip,
+                            time.time() - self.sending_since, self.dropped)
+            self.totals['evicted'] += 1
+            self.clients.discard(self)
+            self.close()
+
+    def _write(self, message):
+        try:
+            future = self.write_message(message, binary=isinstance(message, bytes))
+        except tornado.websocket.WebSocketClosedError:
+            self.clients.discard(self)
+            return
+        self.sending_since = time.time()
+        self.sent += 1
+        self.totals['sent'] += 1
+        future.add_done_callback(self._on_written)
+
+    def _on_written(self, future):
+        self.sending_since = None
+        if future.exception() is not None:
+            return  # closed, see on_close()
+        if self.waiting is not None and self in self.clients:
+            message = self.waiting
+            self.waiting = None
+            self._write(message)
+
+    def client_report(self):
+        behind = 0.0
+        if self.sending_since is not None:
+            behind = round(time.time() - self.sending_since, 3)
+        return {
+            'remote_ip': self.request.remote_ip,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'behind': behind,
+        }
+
+    @classmethod
+    def report(cls):
+        """Message counters, in total and of the connected clients"""
+        clients = [client.client_report() for client in cls.clients]
+        return dict(cls.totals, clients=clients)
+
+    def check_origin(self, origin):
+        return True  # anyone may listen to status changes
+
+
+class StatusWebsocket(BroadcastWebsocket):
     """Websocket for status updates (to avoid HTTP GET polling)
+
+    Every client gets the full status every 200 ms, and right away on
+    important changes (see Driveboard.add_status_listener). The status
+    is serialized only once for all clients.
+
+    With ws/status?delta=1 the client gets the full status once, then
+    only the fields that changed (see status_delta), or an empty object
+    as heartbeat when nothing changed for HEARTBEAT seconds. A delta
+    client that is behind gets the full status next (see
+    BroadcastWebsocket).
     """
+    HEARTBEAT = 1.0  # seconds
     clients = set()
     started = False
+    status = None  # last broadcast
+    message = None  # the same, serialized
+    heartbeat_due = 0.0
+    totals = {'sent': 0, 'dropped': 0, 'evicted': 0}
 
     def initialize(self, board):
         if not StatusWebsocket.started:
-            def status_timer_cb():
-                status = board.get_status()
-                for client in StatusWebsocket.clients:
-                    client.new_status(status)
+            StatusWebsocket.board = board
             polling_interval = 200  # milliseconds
-            PeriodicCallback(status_timer_cb, polling_interval).start()
+            PeriodicCallback(StatusWebsocket.broadcast, polling_interval).start()
+            board.add_status_listener(StatusWebsocket.broadcast)
             StatusWebsocket.started = True
 
     def open(self):
-        StatusWebsocket.clients.add(self)
+        self.delta = self.get_argument('delta', '0') == '1'
+        super().open()
+        if StatusWebsocket.message is None:
+            StatusWebsocket.broadcast()
+        else:
+            self.send(StatusWebsocket.message)
+
+    @classmethod
+    def broadcast(cls):
+        status = cls.board.get_status()
+        message = tornado.escape.json_encode(status)
+        previous = cls.status
+        cls.status = status
+        cls.message = message
+        delta_message = None
+        if any(client.delta for client in cls.clients):
+            delta_message = cls.delta_message(previous, status)
+        for client in list(cls.clients):
+            if client.delta:
+                if delta_message is not None:
+                    client.send(delta_message, message)
+            else:
+                # we always send it (even if not changed) to allow the
+                # client to detect the lack of messages with a simple timeout
+                client.send(message)
+
+    @classmethod
+    def delta_message(cls, previous, status):
+        now = time.time()
+        delta = status_delta(previous or {}, status)
+        if delta:
+            cls.heartbeat_due = now + cls.HEARTBEAT
+            return tornado.escape.json_encode(delta)
+        if now >= cls.heartbeat_due:
+            cls.heartbeat_due = now + cls.HEARTBEAT
+            return '{}'
+        return None
+
+    def client_report(self):
+        return dict(super().client_report(), delta=self.delta)
+
+
+class PositionWebsocket(BroadcastWebsocket):
+    """Websocket for the head position, at the firmware status rate
+
+    Sends a binary message for every status from the firmware (every
+    100 ms while connected): the time and the x, y, z position as
+    little-endian double and 3 floats, see SAMPLE_FORMAT.
+
+    With ws/position?interval=<ms> the client gets at most one sample
+    per interval, e.g. interval=500 for a slow display.
+    """
+    SAMPLE_FORMAT = '<dfff'  # time.time(), x, y, z (mm)
+    clients = set()
+    started = False
+    totals = {'sent': 0, 'dropped': 0, 'evicted': 0}
 
-    def on_close(self):
-        StatusWebsocket.clients.remove(self)
+    def initialize(self, board):
+        if not PositionWebsocket.started:
+            board.add_position_listener(PositionWebsocket.broadcast)
+            PositionWebsocket.started = True
 
-    def new_status(self, status):
-        # we always send it (even if not changed) to allow the client
-        # to detect the lack of messages with a simple timeout
-        self.write_message(status)
+    def open(self):
+        try:
+            self.interval = max(0.0, float(self.get_argument('interval', '0')) / 1000.0)
+        except ValueError:
+            self.close(1008, 'interval must be a number (milliseconds)')
+            return
+        self.next_sample = 0.0
+        super().open()
 
-    def check_origin(self, origin):
-        return True  # anyone may listen to status changes
+    @classmethod
+    def broadcast(cls, timestamp, x, y, z):
+        if not cls.clients:
+            return
+        message = struct.pack(cls.SAMPLE_FORMAT, timestamp, x, y, z)
+        for client in list(cls.clients):
+            if timestamp >= client.next_sample:
+                # on a grid, to keep the average rate despite jitter,
+                # which restarts after a gap (e.g. the first sample)
+                client.next_sample += client.interval
+                if client.next_sample <= timestamp:
+                    client.next_sample = timestamp + client.interval
+                client.send(message)
+
+    def client_report(self):
+        return dict(super().client_report(), interval=self.interval)
+
+
+class WebsocketStatsHandler(StatusHandler):
+    """Messages sent and dropped by the websockets, see BroadcastWebsocket.report()
+    """
+    def get(self):
+        self.write({
+            'status': StatusWebsocket.report(),
+            'position': PositionWebsocket.report(),
+        })
 
 
 class ConfigHandler(tornado.web.RequestHandler):
@@ -122,6 +336,11 @@ class GcodeHandler(tornado.web.RequestHandler):
         self.unprocessed = b''
         self.error = None
         self.lineno = 0
+        self.locked = False  # holding gcode_sender_lock
+        self.received = 0  # bytes of the body
+        self.length = self.request.headers.get('Content-Length')  # None if chunked
+        if self.length is not None:
+            self.length = int(self.length)
 
         mtype = self.request.headers.get('Content-Type')
         if not mtype.startswith('text'):
@@ -129,63 +348,255 @@ class GcodeHandler(tornado.web.RequestHandler):
 
     @gen.coroutine
     def data_received(self, chunk):
+        if self.error:
+            return
+        self.received += len(chunk)
         self.unprocessed += chunk
-        lines = self.unprocessed.split(b'\n')
-        self.unprocessed = lines.pop()  # incomplete line
-        for line in lines:
-            # stay responsive to status updates
-            yield gen.moment
-            yield self.process_one_line(line)
+        # decode all complete lines at once, keep the incomplete one
+        end = self.unprocessed.rfind(b'\n') + 1
+        lines = self.unprocessed[:end].decode('utf-8', 'ignore').split('\n')
+        lines.pop()  # empty, after the last newline
+        self.unprocessed = self.unprocessed[end:]
+        start = 0
+        if self.lineno == 0 and lines:
+            # may have to wait, see process_one_line()
+            yield self.process_one_line(lines[0])
+            start = 1
+        if start < len(lines):
+            yield self.lock_sender()
+
+        # in batches, then stay responsive to status updates (unless
+        # the firmware is about to run out of data)
+        process_line = self.process_line
+        deadline = time.time() + BATCH_SECONDS
+        for i in range(start, len(lines)):
+            process_line(lines[i])
+            if time.time() > deadline:
+                if self.error:
+                    return
+                self.report_upload(sum(len(line) + 1 for line in lines[i+1:]))
+                if self.queue_full():
+                    # flow control, the rest of the body waits
+                    yield self.board.wait_queue_low()
+                elif not self.needs_refill():
+                    yield gen.moment
+                deadline = time.time() + BATCH_SECONDS
+        self.report_upload()
+        if self.queue_full():
+            yield self.board.wait_queue_low()
+
+    @gen.coroutine
+    def lock_sender(self):
+        """Wait until the previous job is fully queued"""
+        if not self.locked:
+            yield GcodeHandler.gcode_sender_lock.acquire()
+            self.locked = True
+
+    def report_upload(self, pending=0):
+        # for the job progress while the rest of the job is not queued
+        # yet, pending bytes are received but not processed (counted
+        # as characters, the same for ASCII gcode)
+        if self.locked:
+            processed = self.received - len(self.unprocessed) - pending
+            fraction = None
+            if self.length:
+                fraction = min(1.0, float(processed) / self.length)
+            self.board.upload_progress(fraction)
+
+    def needs_refill(self):
+        return self.board.needs_refill()
+
+    def queue_full(self):
+        return self.board.queue_full()
 
     @gen.coroutine
     def process_one_line(self, line):
-        if self.error:
+        """Process a line, the first one may have to wait for the previous job"""
+        if self.lineno > 0:
+            if line.strip():
+                yield self.lock_sender()
+                self.process_line(line)
             return
 
-        line = line.decode('utf-8', 'ignore').strip()
+        line = line.strip()
         self.lineno += 1
 
-        if self.lineno == 1:
-            if line.startswith('!'):
-                # stop, pause, unpause:
-                # do not wait until previous job is fully queued
-                resp = self.board.special_line(line)
-                yield GcodeHandler.gcode_sender_lock.acquire()
-            elif line.startswith('~'):
-                # recover from stop or error:
-                # wait until previous job stops adding new commands to the queue
-                yield GcodeHandler.gcode_sender_lock.acquire()
-
-                # wait until firmware stops executing (otherwise, we risk error in buffer tracking)
-                self.board.get_status()  # trigger status update, just in case
-                yield gen.sleep(0.8)  # make sure we have an updated status
-                while not self.board.get_status()['ready']:
-                    logging.info('resume command: waiting for ready status...')
-                    # XXX need to unpause() here too?
-                    yield gen.sleep(0.8)
-
-                # finally, resume
-                resp = self.board.special_line(line)
-            else:
-                # no special command:
-                # just wait until previous job is fully queued
-                yield GcodeHandler.gcode_sender_lock.acquire()
-                resp = self.board.gcode_line(line)
+        if line.startswith('!'):
+            # stop, pause, unpause:
+            # do not wait until previous job is fully queued (that
+            # can take as long as the job, see wait_queue_low)
+            resp = self.board.special_line(line)
+        elif line.startswith('~'):
+            # recover from stop or error:
+            # wait until previous job stops adding new commands to the queue
+            yield self.lock_sender()
+
+            # wait until firmware stops executing (otherwise, we risk error in buffer tracking)
+            self.board.get_status()  # trigger status update, just in case
+            yield gen.sleep(0.8)  # make sure we have an updated status
+            while not self.board.get_status()['ready']:
+                logging.info('resume command: waiting for ready status...')
+                # XXX need to unpause() here too?
+                yield gen.sleep(0.8)
+
+            # finally, resume
+            resp = self.board.special_line(line)
         else:
+            # no special command:
+            # just wait until previous job is fully queued
+            yield self.lock_sender()
             resp = self.board.gcode_line(line)
+        self._check(resp)
 
+    def process_line(self, line):
+        # gcode_line() strips the line
+        if self.error:
+            return
+        self.lineno += 1
+        self._check(self.board.gcode_line(line))
+
+    def _check(self, resp):
         if resp.startswith('error:'):
             self.error = 'line %d: %s' % (self.lineno, resp[6:])
             logging.warning(self.error)
 
+    @gen.coroutine
     def post(self):
         # execute final piece if newline was missing
-        self.process_one_line(self.unprocessed)
+        yield self.process_one_line(self.unprocessed.decode('utf-8', 'ignore'))
 
         if self.error:
             self.set_status(400)
             self.write(self.error)
 
     def on_finish(self):
-        if self.lineno > 0:
+        if self.locked:
+            self.board.upload_done()
+            GcodeHandler.gcode_sender_lock.release()
+
+
+@tornado.web.stream_request_body
+class SimulateHandler(GcodeHandler):
+    """Dry run of a gcode job (see simulator.py)
+
+    Nothing is sent to the driveboard. Responds with the estimated job
+    time, distances, etc. With ?moves=1 also a breakdown of all moves.
+    """
+    def initialize(self):
+        pass
+
+    def prepare(self):
+        super(SimulateHandler, self).prepare()
+        # the breakdown keeps a record of every move, only on request
+        moves = self.get_argument('moves', '') not in ('', '0')
+        self.simulation = simulator.Simulation(keep_moves=moves)
+
+    @gen.coroutine
+    def process_one_line(self, line):
+        self.process_line(line)  # no gcode_sender_lock
+
+    def process_line(self, line):
+        if self.error:
+            return
+        self.lineno += 1
+        resp = self.simulation.gcode_line(line.strip())
+        if resp.startswith('error:'):
+            self.error = 'line %d: %s' % (self.lineno, resp[6:])
+
+    @gen.coroutine
+    def post(self):
+        if self.unprocessed:
+            yield self.process_one_line(self.unprocessed.decode('utf-8', 'ignore'))
+
+        if self.error:
+            self.set_status(400)
+            self.write(self.error)
+        else:
+            self.write(self.simulation.result())
+
+    def needs_refill(self):
+        return False  # nothing is streamed
+
+    def queue_full(self):
+        return False
+
+    @gen.coroutine
+    def lock_sender(self):
+        pass  # no gcode_sender_lock
+
+    def on_finish(self):
+        pass  # no gcode_sender_lock
+
+
+@tornado.web.stream_request_body
+class RasterHandler(tornado.web.RequestHandler):
+    """Binary raster jobs (see rasterjob.py)
+
+    Faster alternative to posting G7 gcode lines with base64 data.
+    """
+    def initialize(self, board):
+        self.board = board
+
+    def set_default_headers(self):
+        self.set_header("Access-Control-Allow-Origin", "*")
+
+    @gen.coroutine
+    def prepare(self):
+        self.error = None
+        self.locked = False
+        self.job = rasterjob.RasterJob(self.board)
+
+        mtype = self.request.headers.get('Content-Type', '')
+        if mtype != 'application/octet-stream':
+            raise tornado.web.HTTPError(400, 'raster POST handler supports only application/octet-stream content-type')
+
+        # wait until previous job is fully queued
+        yield GcodeHandler.gcode_sender_lock.acquire()
+        self.locked = True
+
+    @gen.coroutine
+    def data_received(self, chunk):
+        if self.error:
+            return
+        self.job.feed(chunk)
+        try:
+            deadline = time.time() + BATCH_SECONDS
+            while self.job.process_line():
+                if time.time() > deadline:
+                    self.report_upload()
+                    if self.board.queue_full():
+                        # flow control, the rest of the body waits
+                        yield self.board.wait_queue_low()
+                    elif not self.board.needs_refill():
+                        # stay responsive to status updates, unless the
+                        # firmware is about to run out of data
+                        yield gen.moment
+                    deadline = time.time() + BATCH_SECONDS
+            self.report_upload()
+            if self.board.queue_full():
+                yield self.board.wait_queue_low()
+        except rasterjob.RasterJobError as e:
+            self.error = 'raster line %d: %s' % (self.job.lineno + 1, e)
+            logging.warning(self.error)
+
+    def report_upload(self):
+        # for the job progress while the rest of the job is not queued yet
+        header = self.job.header
+        if header is not None and header['height'] > 0:
+            self.board.upload_progress(float(self.job.lineno) / header['height'])
+
+    def post(self):
+        if not self.error:
+            try:
+                self.job.finish()
+            except rasterjob.RasterJobError as e:
+                self.error = str(e)
+
+        if self.error:
+            self.set_status(400)
+            self.write(self.error)
+
+    def on_finish(self):
+        if self.locked:
+            self.board.upload_done()
             GcodeHandler.gcode_sender_lock.release()
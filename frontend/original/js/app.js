@@ -109,7 +109,7 @@ function send_gcode(gcode, success_msg, progress) {
 
 function update_progress() {
   $.get(new_api + '/status', function(data) {
-    var pct = data.queue.job_percent;
+    var pct = data.queue.time_percent;
     var busy = !data.ready;
     if (pct != 100 || busy) {
       $("#progressbar").show();
@@ -10,6 +10,7 @@ $(document).ready(function(){
 
   var path_optimize = 1;
   var forceSvgDpiTo = undefined;
+  var importJob = undefined;  // id of the running import job
 
   /// big canvas init
   var w = app_settings.canvas_dimensions[0];
@@ -93,9 +94,10 @@ $(document).ready(function(){
     if (filedata.length > 102400) {
       $().uxmessage('notice', "Importing large files may take a few minutes.");
     }
+    // parsing runs in the background, poll for the result
     $.ajax({
       type: "POST",
-      url: "/file_reader",
+      url: "/file_reader/start",
       data: {'filename':filename,
              'filedata':filedata,
              'dpi':forceSvgDpiTo,
@@ -103,30 +105,73 @@ $(document).ready(function(){
              'dimensions':JSON.stringify(app_settings.work_area_dimensions)},
       dataType: "json",
       success: function (data) {
-        if (ext == '.svg' || ext == '.SVG') {
-          $().uxmessage('success', "SVG parsed.");
-          $('#dpi_import_info').html('Using <b>' + data.dpi + '</b> for converting units.');
-        } else if (ext == '.dxf' || ext == '.DXF') {
-          $().uxmessage('success', "DXF parsed.");
-          $('#dpi_import_info').html('Assuming mm units in DXF file.');
-        } else if (ext == '.ngc' || ext == '.NGC') {
-          $().uxmessage('success', "G-Code parsed.");
-        } else {
+        importJob = data.job;
+        $('#import_progress_text').html('uploaded');
+        $('#import_progress').show();
+        pollImport(data.job, ext);
+      },
+      error: function (data) {
+        $().uxmessage('error', "backend error.");
+        importFinished();
+      }
+    });
+  }
+
+  function pollImport(job, ext) {
+    $.ajax({
+      type: "GET",
+      url: "/file_reader/status/" + job,
+      dataType: "json",
+      success: function (data) {
+        if (data.status == 'pending' || data.status == 'running') {
+          $('#import_progress_text').html(data.stage + ' ' + Math.round(100*data.progress) + '%');
+          setTimeout(function() { pollImport(job, ext); }, 500);
+          return;
+        }
+        if (data.status == 'done') {
+          if (ext == '.svg' || ext == '.SVG') {
+            $().uxmessage('success', "SVG parsed.");
+            $('#dpi_import_info').html('Using <b>' + data.result.dpi + '</b> for converting units.');
+          } else if (ext == '.dxf' || ext == '.DXF') {
+            $().uxmessage('success', "DXF parsed.");
+            $('#dpi_import_info').html('Assuming mm units in DXF file.');
+          } else if (ext == '.ngc' || ext == '.NGC') {
+            $().uxmessage('success', "G-Code parsed.");
+          }
+          // alert(JSON.stringify(data));
+          handleParsedGeometry(data.result);
+        } else if (data.status == 'cancelled') {
+          $().uxmessage('notice', "import cancelled.");
+        } else if (data.status == 'failed' && data.error == 'unsupported file format') {
           $().uxmessage('warning', "File extension not supported. Import SVG, DXF, or G-Code files.");
+        } else {
+          $().uxmessage('error', "import " + data.status + ". " + (data.error || ''));
         }
-        // alert(JSON.stringify(data));
-        handleParsedGeometry(data);
+        importFinished();
       },
       error: function (data) {
         $().uxmessage('error', "backend error.");
-      },
-      complete: function (data) {
-        $('#file_import_btn').button('reset');
-        forceSvgDpiTo = undefined;  // reset
+        importFinished();
       }
     });
   }
 
+  function importFinished() {
+    $('#file_import_btn').button('reset');
+    $('#import_progress').hide();
+    importJob = undefined;
+    forceSvgDpiTo = undefined;  // reset
+  }
+
+  // the next poll reports the job as cancelled
+  $('#import_cancel_btn').click(function(e){
+    if (importJob) {
+      $.get("/file_reader/cancel/" + importJob);
+      $('#import_progress_text').html('cancelling ...');
+    }
+    return false;
+  });
+
   function handleParsedGeometry(data) {
     // data is a dict with the following keys [boundarys, dpi, lasertags]
     var boundarys = data.boundarys;